@@ -0,0 +1,86 @@
+"""corpus.py.
+
+Compare the corpus cache layouts: one JSON file per document, JSON Lines shards
+and gzip-compressed JSON Lines shards. For each layout, measure the time to
+write a synthetic corpus, its size on disk, and the time for a notebook to read
+every document, read one field of every document and fetch single documents.
+
+Run from the repository root with `python -m benchmarks.corpus [--count N]`.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from bson import ObjectId
+
+from project.corpus import CorpusWriter
+from project.reader import CorpusReader
+
+WORDS = ['humanities', 'crisis', 'university', 'students', 'funding', 'liberal', 'arts', 'public', 'value',
+         'history', 'literature', 'philosophy', 'science', 'education', 'culture', 'research', 'degree']
+LAYOUTS = [
+    ('files, indent 2', {'layout': 'files', 'indent': 2}),
+    ('jsonl', {'layout': 'jsonl'}),
+    ('jsonl, gzip', {'layout': 'jsonl', 'compression': 'gzip'})
+]
+
+
+def make_documents(count, words=800):
+    """Yield documents shaped like WE1S news articles."""
+    rng = random.Random(0)
+    for i in range(count):
+        yield {
+            '_id': ObjectId(),
+            'name': 'doc%06d' % i,
+            'metapath': 'Corpus,guardian,RawData',
+            'title': ' '.join(rng.choice(WORDS) for _ in range(8)),
+            'pub_date': '2019-%02d-%02d' % (1 + i % 12, 1 + i % 28),
+            'content': ' '.join(rng.choice(WORDS) for _ in range(words))
+        }
+
+
+def disk_usage(path):
+    """Get the bytes allocated on disk to the files in a folder."""
+    total = 0
+    for base, _, files in os.walk(path):
+        for file in files:
+            total += os.stat(os.path.join(base, file)).st_blocks * 512
+    return total
+
+
+def timed(fn):
+    """Return the time taken by fn in seconds."""
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main():
+    """Write the synthetic corpus in each layout and time reading it back."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--count', type=int, default=20000, help='number of documents')
+    args = parser.parse_args()
+    documents = list(make_documents(args.count))
+    names = [document['name'] for document in random.Random(1).sample(documents, min(1000, args.count))]
+    print('{} documents'.format(args.count))
+    print('{:<18} {:>10} {:>10} {:>10} {:>10} {:>12}'.format('layout', 'write s', 'disk MB', 'read s', 'field s', 'get ms'))
+    for label, options in LAYOUTS:
+        project_dir = tempfile.mkdtemp()
+        try:
+            write = timed(lambda: CorpusWriter(project_dir, **options).write(iter(documents)))
+            with CorpusReader(project_dir) as reader:
+                read = timed(lambda: sum(1 for _ in reader))
+                field = timed(lambda: sum(1 for _ in reader.select(['pub_date'])))
+                get = timed(lambda: [reader.get(name) for name in names]) / len(names)
+            print('{:<18} {:>10.2f} {:>10.1f} {:>10.2f} {:>10.2f} {:>12.3f}'.format(
+                label, write, disk_usage(project_dir) / 1048576, read, field, get * 1000))
+        finally:
+            shutil.rmtree(project_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""imports.py.
+
+Measure the time taken to import `project.Project` in a fresh interpreter and
+check it against a budget. The import must not load pymongo or nbformat or
+create a database client. Exits with status 1 if the budget is exceeded.
+
+Run from the repository root with `python -m benchmarks.imports [--budget MS]`.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+# Import time budget in milliseconds
+IMPORT_BUDGET_MS = 150
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import project.Project
+elapsed = (time.perf_counter() - start) * 1000
+from project import db
+loaded = [name for name in ['pymongo', 'nbformat']
+          if name in sys.modules and type(sys.modules[name]).__name__ != '_LazyModule']
+print(json.dumps({'ms': elapsed, 'loaded': loaded, 'client': db._client is not None}))
+'''
+
+
+def measure(repeat=5):
+    """Import the module in a fresh interpreter several times and return the fastest run."""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', PROBE])
+        runs.append(json.loads(output.decode('utf-8')))
+    return min(runs, key=lambda run: run['ms'])
+
+
+def main():
+    """Report the import time and fail if it exceeds the budget or touches the database."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET_MS, help='budget in milliseconds')
+    args = parser.parse_args()
+    run = measure()
+    print('import project.Project: {:.1f} ms (budget {:.0f} ms)'.format(run['ms'], args.budget))
+    print('eagerly loaded: {}'.format(', '.join(run['loaded']) or 'none'))
+    print('database client created: {}'.format(run['client']))
+    if run['ms'] > args.budget or run['loaded'] or run['client']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
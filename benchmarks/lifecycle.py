@@ -0,0 +1,233 @@
+"""lifecycle.py.
+
+Time the project lifecycle against synthetic corpora of realistic news articles:
+launching a new project, saving with and without changes, exporting through
+each of the three export branches, save as, copy and deleting a version. For
+each operation, record the wall time, the stage timings reported by the
+project's instrumentation, the process's peak RSS, the peak Python allocation
+and the bytes written.
+
+The corpus is written to the scratch database set up by
+`benchmarks.projects.get_database()`. Version files are kept in a local blob
+store in a scratch folder. The results are written as JSON so that runs from
+different releases can be compared.
+
+Run from the repository root with
+`python -m benchmarks.lifecycle [--mongo URL] [--sizes 1000,100000,1000000] [--output FILE] [--compare FILE]`.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from bson import ObjectId
+
+from benchmarks.corpus import WORDS
+from benchmarks.projects import get_database
+from config import config
+from project.Project import Project
+
+NOTEBOOK = {'cells': [{'cell_type': 'code', 'execution_count': 1, 'metadata': {}, 'outputs': [],
+                       'source': ['import json\n', 'print(len(documents))\n']}],
+            'metadata': {}, 'nbformat': 4, 'nbformat_minor': 2}
+
+
+def make_articles(count, seed=0):
+    """Yield documents shaped like WE1S news articles, with lengths spread around 700 words."""
+    rng = random.Random(seed)
+    for i in range(count):
+        words = max(50, int(rng.lognormvariate(6.5, 0.6)))
+        yield {
+            '_id': ObjectId(),
+            'name': 'guardian-%07d' % i,
+            'metapath': 'Corpus,guardian,RawData',
+            'namespace': 'we1sv2.0',
+            'title': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 12))).capitalize(),
+            'pub': 'The Guardian',
+            'pub_date': '20%02d-%02d-%02d' % (10 + i % 10, 1 + i % 12, 1 + i % 28),
+            'length': words,
+            'content': ' '.join(rng.choice(WORDS) for _ in range(words))
+        }
+
+
+def seed_corpus(db, count):
+    """Replace the corpus with count synthetic articles."""
+    db.Corpus.drop()
+    batch = []
+    for document in make_articles(count):
+        batch.append(document)
+        if len(batch) == 1000:
+            db.Corpus.insert_many(batch)
+            batch = []
+    if batch:
+        db.Corpus.insert_many(batch)
+
+
+def bytes_written():
+    """Get the bytes this process has passed to write calls, or None where /proc is not available."""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+def peak_rss_kb():
+    """Get the peak resident set size of this process in KB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KB
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def measure(label, fn):
+    """Run fn once and return its measurements and result."""
+    written = bytes_written()
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    if isinstance(result, str):
+        result = json.loads(result)
+    timings = result.get('timings', {}) if isinstance(result, dict) else {}
+    row = {
+        'operation': label,
+        'seconds': round(seconds, 4),
+        'result': result.get('result') if isinstance(result, dict) else None,
+        'peak_rss_kb': peak_rss_kb(),
+        'python_peak_bytes': timings.get('memory_peak_bytes'),
+        'bytes_written': None if written is None else bytes_written() - written,
+        'stages': timings.get('stages', {}),
+        'counters': timings.get('counters', {})
+    }
+    return row, result
+
+
+def load(project, templates_dir, workspace_dir, temp_dir):
+    """Load a fresh Project for a saved project from the database."""
+    manifest = project.projects_db.find_one({'_id': ObjectId(project._id)})
+    return Project(manifest, templates_dir, workspace_dir, temp_dir)
+
+
+def run_size(db, count, scratch):
+    """Run the lifecycle for a corpus of count documents and return the measurements."""
+    rows = []
+    start = time.perf_counter()
+    seed_corpus(db, count)
+    rows.append({'operation': 'seed corpus', 'seconds': round(time.perf_counter() - start, 4), 'peak_rss_kb': peak_rss_kb()})
+    templates_dir = os.path.join(scratch, 'templates')
+    workspace_dir = os.path.join(scratch, 'workspace')
+    temp_dir = os.path.join(scratch, 'temp')
+    os.makedirs(os.path.join(templates_dir, 'topic_modeling'))
+    os.makedirs(temp_dir)
+    with open(os.path.join(templates_dir, 'topic_modeling', 'model.ipynb'), 'w') as f:
+        f.write(json.dumps(NOTEBOOK))
+    project = Project({'name': 'benchmark'}, templates_dir, workspace_dir, temp_dir)
+
+    row, result = measure('launch new project', lambda: project.launch('topic_modeling'))
+    rows.append(row)
+    project_dir = result['project_dir']
+    # Version 1 has no stored files yet, so it is exported from its folder in the Workspace
+    rows.append(measure('export from workspace folder', lambda: project.export(1))[0])
+    rows.append(measure('save with changes', lambda: project.save(project_dir))[0])
+    rows.append(measure('save without changes', lambda: project.save(project_dir))[0])
+    with open(os.path.join(project_dir, 'model.ipynb'), 'w') as f:
+        f.write(json.dumps(dict(NOTEBOOK, metadata={'edited': True})))
+    rows.append(measure('save new version', lambda: project.save(project_dir))[0])
+    rows.append(measure('export from blob store', lambda: project.export())[0])
+    # A version with neither stored files nor a folder is rebuilt from the templates and the database
+    number = project.get_latest_version_number() + 1
+    date = datetime.today().strftime('%Y%m%d%H%M%S')
+    project.set_version({'version_number': number, 'version_date': date, 'version_workflow': 'topic_modeling',
+                         'version_name': date + '_v%d_rebuilt' % number})
+    rows.append(measure('export rebuilt from database', lambda: project.export(number))[0])
+    project.remove_version(number)
+
+    saved_as = load(project, templates_dir, workspace_dir, temp_dir)
+    rows.append(measure('save_as', lambda: saved_as.save_as(project_dir, 'benchmark_copy'))[0])
+    copied = load(project, templates_dir, workspace_dir, temp_dir)
+    rows.append(measure('copy', lambda: copied.copy('benchmark_copy2'))[0])
+    rows.append(measure('delete version', lambda: project.delete(1))[0])
+    for row in rows:
+        row['documents'] = count
+    return rows
+
+
+def revision():
+    """Get the git revision of the working tree, if there is one."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous_file):
+    """Print the ratio of each operation's time to its time in an earlier results file."""
+    with open(previous_file, 'r') as f:
+        previous = json.loads(f.read())
+    baseline = {(row['documents'], row['operation']): row['seconds'] for row in previous['runs']}
+    print('Compared with {} ({})'.format(previous.get('revision'), previous.get('date')), file=sys.stderr)
+    for row in results['runs']:
+        before = baseline.get((row['documents'], row['operation']))
+        if before:
+            print('  {:>9} {:<30} {:>8.2f}x'.format(row['documents'], row['operation'], row['seconds'] / before),
+                  file=sys.stderr)
+
+
+def main():
+    """Run the lifecycle for each corpus size and write the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--mongo', help='MongoDB url; uses mongomock if omitted')
+    parser.add_argument('--sizes', default='1000', help='comma-separated corpus sizes, e.g. 1000,100000,1000000')
+    parser.add_argument('--output', help='file to write the JSON results to; prints them if omitted')
+    parser.add_argument('--compare', help='an earlier results file to compare the times with')
+    args = parser.parse_args()
+    db = get_database(args.mongo)
+    config.INSTRUMENT_TRACE_MEMORY = True
+    config.QUERY_CACHE_DIR = None
+    config.BLOB_STORE = 'local'
+    results = {
+        'benchmark': 'lifecycle',
+        'revision': revision(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': 'mongodb' if args.mongo else 'mongomock',
+        'runs': []
+    }
+    for count in [int(size) for size in args.sizes.split(',')]:
+        scratch = tempfile.mkdtemp()
+        config.BLOB_DIR = os.path.join(scratch, 'blobs')
+        try:
+            rows = run_size(db, count, scratch)
+        finally:
+            shutil.rmtree(scratch)
+            db.Projects.drop()
+        results['runs'] += rows
+        print('{} documents'.format(count), file=sys.stderr)
+        for row in rows:
+            print('  {:<30} {:>10.3f} s {:>10} KB RSS {:>14} bytes written'.format(
+                row['operation'], row['seconds'], row['peak_rss_kb'], str(row.get('bytes_written'))), file=sys.stderr)
+    if args.mongo is not None:
+        db.client.drop_database('we1s_benchmark')
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(results, indent=2))
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
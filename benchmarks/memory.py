@@ -0,0 +1,82 @@
+"""memory.py.
+
+Measure the memory held by Project objects built from project records whose
+older versions carry zip archives, as in records saved before manifests. For
+each archive size, compare Projects built from full records with Projects
+loaded by `Project.load()`, which keeps handles on the archives instead.
+
+The memory held by a Project is the size of every object reachable from its
+manifest and version index. mongomock copies whole records while it reads
+them, so the peak allocation while building the Projects is only meaningful
+against a server.
+
+Run from the repository root with
+`python -m benchmarks.memory [--mongo URL] [--count N] [--sizes 65536,1048576,8388608]`.
+"""
+
+import argparse
+import sys
+import tempfile
+import tracemalloc
+
+from benchmarks.projects import get_database, make_projects
+from project.Project import Project
+from project.versions import Version, VersionIndex
+
+
+def held_bytes(obj, seen=None):
+    """Get the size of an object and of the manifest values and versions reachable from it."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(held_bytes(key, seen) + held_bytes(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(held_bytes(item, seen) for item in obj)
+    elif isinstance(obj, Version):
+        size += sum(held_bytes(obj.raw(key), seen) for key in obj)
+    elif isinstance(obj, VersionIndex):
+        size += held_bytes(obj.__dict__, seen)
+    return size
+
+
+def measure(build, ids):
+    """Build a Project for each id and return the bytes held and the peak allocation per Project."""
+    tracemalloc.start()
+    projects = [build(_id) for _id in ids]
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    held = sum(held_bytes([project.manifest, project.reduced_manifest, project.versions]) for project in projects)
+    return held // len(ids), peak // len(ids)
+
+
+def main():
+    """Populate the scratch database for each archive size and measure both ways of building Projects."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--mongo', help='MongoDB url; uses mongomock if omitted')
+    parser.add_argument('--count', type=int, default=20, help='number of projects for each archive size')
+    parser.add_argument('--sizes', default='65536,1048576,8388608', help='comma-separated archive sizes in bytes')
+    args = parser.parse_args()
+    db = get_database(args.mongo)
+    scratch = tempfile.gettempdir()
+    print('{} projects of 5 versions ({})'.format(args.count, args.mongo or 'mongomock'))
+    print('{:>12}  {:<14} {:>16} {:>16}'.format('archive', 'built from', 'held/project', 'peak/project'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        db.Projects.drop()
+        ids = db.Projects.insert_many(list(make_projects(args.count, payload_size=size))).inserted_ids
+        rows = [
+            ('full record', measure(lambda _id: Project(db.Projects.find_one({'_id': _id}), scratch, scratch, scratch), ids)),
+            ('Project.load', measure(lambda _id: Project.load(_id, scratch, scratch, scratch), ids))
+        ]
+        for label, (held, peak) in rows:
+            print('{:>12}  {:<14} {:>16} {:>16}'.format(size, label, held, peak))
+    db.Projects.drop()
+    if args.mongo is not None:
+        db.client.drop_database('we1s_benchmark')
+
+
+if __name__ == '__main__':
+    main()
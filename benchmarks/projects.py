@@ -0,0 +1,96 @@
+"""projects.py.
+
+Measure the latency of the project listing and search API for a large number
+of projects. Uses mongomock if it is installed and no MongoDB url is given;
+otherwise the benchmark data is written to a scratch `we1s_benchmark` database
+on the given server, which is dropped afterwards.
+
+Run from the repository root with `python -m benchmarks.projects [--mongo URL] [--count N]`.
+"""
+
+import argparse
+import os
+import time
+
+import bson
+
+from config import config
+from project.db import set_client
+from project.Project import Project
+
+WORKFLOWS = ['topic_modeling', 'word_embeddings', 'dendrogram', 'pyldavis']
+
+
+def get_database(url=None):
+    """Use a scratch database on a MongoDB server or a mongomock stand-in for every Project."""
+    if url is None:
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        import pymongo
+        client = pymongo.MongoClient(url)
+    set_client(client)
+    config.MONGO_DATABASE = 'we1s_benchmark'
+    return client.we1s_benchmark
+
+
+def make_projects(count, versions=5, payload_size=2048):
+    """Yield project records whose older versions carry zip payloads, as in records saved before manifests."""
+    payload = os.urandom(payload_size)
+    for i in range(count):
+        content = []
+        for v in range(1, versions + 1):
+            date = '2019%02d%02d120000' % (1 + i % 12, 1 + v)
+            content.append({'version_number': v, 'version_date': date, 'version_name': date + '_v%d_project%05d' % (v, i),
+                            'version_workflow': WORKFLOWS[i % len(WORKFLOWS)], 'version_zipfile': payload})
+        yield {'name': 'project%05d' % i, 'title': 'Project %d' % i, 'metapath': 'Projects', 'content': content}
+
+
+def timed(fn, repeat=5):
+    """Return the best of several runs of fn in milliseconds, and the BSON size of its documents in KB."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    if isinstance(result, dict):
+        result = result['projects']
+    return best, sum(len(bson.encode(doc)) for doc in result) / 1024
+
+
+def main():
+    """Populate the scratch database, then time the listing API against full-document reads."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--mongo', help='MongoDB url; uses mongomock if omitted')
+    parser.add_argument('--count', type=int, default=10000, help='number of projects')
+    args = parser.parse_args()
+    db = get_database(args.mongo)
+    db.Projects.drop()
+    batch = []
+    for record in make_projects(args.count):
+        batch.append(record)
+        if len(batch) == 1000:
+            db.Projects.insert_many(batch)
+            batch = []
+    if batch:
+        db.Projects.insert_many(batch)
+    Project.ensure_indexes()
+    name = 'project%05d' % (args.count // 2)
+    results = [
+        ('full documents, first page', timed(lambda: list(db.Projects.find().sort('name').limit(50)))),
+        ('list_projects, first page', timed(lambda: Project.list_projects())),
+        ('list_projects, last page', timed(lambda: Project.list_projects(page=args.count // 50))),
+        ('search_projects by name', timed(lambda: Project.search_projects(name=name))),
+        ('search_projects by workflow', timed(lambda: Project.search_projects(workflow='dendrogram'))),
+        ('search_projects by date', timed(lambda: Project.search_projects(date_from='20190301', date_to='20190331')))
+    ]
+    print('{} projects ({})'.format(args.count, args.mongo or 'mongomock'))
+    for label, (ms, kb) in results:
+        print('{:<32} {:>10.2f} ms {:>10.1f} KB'.format(label, ms, kb))
+    if args.mongo is not None:
+        db.client.drop_database('we1s_benchmark')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""versions.py.
+
+Compare the cost of version lookups using a linear scan of the manifest's
+`content` list with the cost using a `VersionIndex`, as the number of versions
+grows. Run from the repository root with `python -m benchmarks.versions`.
+"""
+
+import timeit
+
+from project.versions import VersionIndex
+
+SIZES = [10, 100, 1000, 10000]
+
+
+def make_versions(n):
+    """Create n version dicts."""
+    return [{'version_number': i, 'version_date': '2019%010d' % i, 'version_name': '2019%010d_v%d_test' % (i, i)}
+            for i in range(1, n + 1)]
+
+
+def scan_latest(content):
+    """Find the latest version with a linear scan, as in the original Project.get_latest_version()."""
+    latest_number = max(int(version['version_number']) for version in content)
+    for version in content:
+        if str(version['version_number']) == str(latest_number):
+            return version
+
+
+def scan_version(content, value, key='number'):
+    """Find a version with a linear scan, as in the original Project.get_version()."""
+    for version in content:
+        if str(version['version_' + key]) == str(value):
+            return version
+
+
+def main(number=200):
+    """Time lookups by number and name and of the latest version, in microseconds per call."""
+    print('{:>8} {:>14} {:>14} {:>14} {:>14}'.format('versions', 'scan latest', 'index latest', 'scan name', 'index name'))
+    for n in SIZES:
+        content = make_versions(n)
+        index = VersionIndex(list(content))
+        name = content[n // 2]['version_name']
+        timings = [
+            timeit.timeit(lambda: scan_latest(content), number=number),
+            timeit.timeit(lambda: index.latest(), number=number),
+            timeit.timeit(lambda: scan_version(content, name, 'name'), number=number),
+            timeit.timeit(lambda: index.get(name, 'name'), number=number)
+        ]
+        print('{:>8} {:>14.2f} {:>14.2f} {:>14.2f} {:>14.2f}'.format(n, *[t / number * 1e6 for t in timings]))
+
+
+if __name__ == '__main__':
+    main()
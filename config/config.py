@@ -4,8 +4,117 @@ import os
 
 '''configurations'''
 MONGO_CLIENT = 'mongodb://localhost:27017'
+MONGO_DATABASE = 'we1s'
+# Connection pool and timeouts for the MongoClient, which is created on first use
+MONGO_MAX_POOL_SIZE = 100
+MONGO_MIN_POOL_SIZE = 0
+MONGO_CONNECT_TIMEOUT_MS = 20000
+MONGO_TIMEOUT_MS = 30000
 
 '''file dir'''
 TEMPLATES_DIR = 'projects/templates'
 WORKSPACE_DIR = 'projects/projects-wms'
-TEMP_DIR = 'projects/projects-wms/tmp'
\ No newline at end of file
+TEMP_DIR = 'projects/projects-wms/tmp'
+
+'''corpus'''
+# Number of documents fetched from the database per round trip
+CORPUS_BATCH_SIZE = 1000
+# Default projection for corpus documents, e.g. {'bag_of_words': False}; None returns all fields
+CORPUS_PROJECTION = None
+# Indent for the caches/json files; None writes compact JSON
+CORPUS_INDENT = 2
+# 'files' writes one caches/json file per document; 'jsonl' writes sharded JSON Lines to caches/jsonl
+CORPUS_LAYOUT = 'files'
+# Number of documents per JSON Lines shard
+CORPUS_SHARD_SIZE = 10000
+# None, or 'gzip' to compress 'jsonl' shards in independently readable blocks
+CORPUS_COMPRESSION = None
+# Uncompressed size of each compressed block; smaller blocks make single documents faster to read
+CORPUS_BLOCK_SIZE = 256 * 1024
+# Number of encoding workers; None uses the number of CPUs
+CORPUS_WORKERS = None
+# 'thread' or 'process'
+CORPUS_EXECUTOR = 'thread'
+
+'''versions'''
+# 'gridfs' stores version files in the database; 'local' stores them in BLOB_DIR
+BLOB_STORE = 'gridfs'
+BLOB_DIR = 'projects/blobs'
+# Remove the blobs no other version refers to when a version or project is deleted
+BLOB_GC_ON_DELETE = True
+# Blobs stored more recently than this (in seconds) are never removed, since a save may be about to use them
+BLOB_GC_GRACE = 3600
+
+'''archives'''
+# zlib level for zip archives; 0 stores every member uncompressed
+ZIP_COMPRESSLEVEL = 6
+# Number of threads compressing archive members; None uses the number of CPUs
+ZIP_WORKERS = None
+
+'''launch'''
+# If True, launching a stored version returns once the notebooks are written and fills in caches/ in the background
+LAZY_LAUNCH = False
+# Number of times a new version is renumbered if a concurrent save takes its number
+VERSION_RETRIES = 5
+# Least number of seconds between saves of the journal which lets an interrupted launch, restore or export resume
+JOURNAL_INTERVAL = 1.0
+
+'''preview'''
+# Number of matching documents encoded to estimate the size of a query's corpus
+PREVIEW_SAMPLE_SIZE = 100
+# Seed for sampled launches; the same seed, query and corpus always give the same sample
+SAMPLE_SEED = 0
+
+'''notebooks'''
+# Number of processes used to clean notebooks; None uses the number of CPUs
+CLEAN_PROCESSES = None
+# Smaller projects are cleaned in one process, since starting the pool would take longer than the cleaning
+CLEAN_POOL_MIN_NOTEBOOKS = 8
+CLEAN_POOL_MIN_BYTES = 4 * 1024 ** 2
+
+'''cloning'''
+# If True, save as hard links the files in caches/ when the filesystem cannot reflink them
+CLONE_HARDLINKS = True
+
+'''query cache'''
+# A corpus field holding each document's modification time, used to detect changes; None uses _id and counts only
+CORPUS_MODIFIED_FIELD = None
+# Folder for serialised corpus query results shared across launches; None disables the cache.
+# Without CORPUS_MODIFIED_FIELD, documents edited in place would not invalidate cached results, so it is off by default
+QUERY_CACHE_DIR = 'projects/query-cache' if CORPUS_MODIFIED_FIELD else None
+# Least recently used results are evicted above this total size
+QUERY_CACHE_MAX_BYTES = 10 * 1024 ** 3
+
+'''jobs'''
+# SQLite database holding the queue of background export and snapshot jobs
+JOB_DB = 'projects/jobs.sqlite3'
+# Number of jobs run at once by all the workers sharing the queue
+JOB_WORKERS = 2
+# Seconds between checks for new jobs by an idle worker
+JOB_POLL_SECONDS = 0.5
+
+'''bulk operations'''
+# Number of writes sent to the database in each bulk_write call
+BULK_BATCH_SIZE = 1000
+# Number of projects exported at once by bulk exports
+BULK_WORKERS = 4
+
+'''instrumentation'''
+# If True, log the timings of each Project operation as JSON to the 'project.instrument' logger
+INSTRUMENT_LOG = False
+# Path of a Prometheus text file kept up to date with operation totals; None disables it
+INSTRUMENT_PROMETHEUS_FILE = None
+# If True, run each operation under cProfile; the report is kept in Project.instrument.last['profile']
+INSTRUMENT_PROFILE = False
+# If True, record each operation's peak memory allocation with tracemalloc
+INSTRUMENT_TRACE_MEMORY = False
+
+'''workspace'''
+# Disk budget for project folders, exports and temporary files in the Workspace; None disables eviction
+WORKSPACE_MAX_BYTES = None
+# Temporary files older than this many seconds are removed when the budget is enforced
+TEMP_MAX_AGE = 24 * 3600
+# Export archives written less than this many seconds ago are never evicted, since they may still be in use
+EXPORT_MIN_AGE = 600
+# Launches and exports in the same process enforce the budget at most once in this many seconds
+WORKSPACE_CHECK_INTERVAL = 60
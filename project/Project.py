@@ -1,30 +1,56 @@
 """Project.py."""
 
-import glob
 import hashlib
 import json
 import re
 import os
-import nbformat
-import pymongo
 import sys
+import threading
 import zipfile
-from bson import BSON, Binary, json_util, ObjectId
-from collections import defaultdict
+from bson import BSON, json_util, ObjectId
 from datetime import datetime
 from io import BytesIO
-from pymongo import MongoClient, ReturnDocument
-from shutil import copytree, ignore_patterns, rmtree
+from shutil import rmtree
 
 from config import config
+from project.archive import entries_from_dir, entries_from_manifest, entry_from_bytes, iter_archive, write_archive
+from project.blobstore import DEFERRED_DIR, JOURNAL_FILE, MANIFEST_FILE, PENDING_FILE, DigestMismatch, GridFSBlobStore, \
+    collect_garbage, get_blob_store, load_local_manifest, load_manifest, restore_file, restore_manifest, save_local_manifest, \
+    scan_manifest, stat_manifest, store_manifest
+from project.cache import QueryCache, corpus_marker, query_key
+from project.clone import clone_tree
+from project.corpus import CorpusWriter, JsonlShards, encode, load_sync_index, save_sync_index, signature, write_replace
+from project.db import get_client, get_database, lazy_import, pymongo
+from project.instrument import Instrument, get_sinks, instrumented
+from project.jobs import get_queue, pid_alive
+from project.journal import Journal, find_incomplete, folder_state, journal_key, open_journal
+from project.notebooks import clean_notebook, clean_notebooks, count_source, find_notebooks
+from project.progress import Progress
+from project.sample import sample_ids
+from project.versions import VersionIndex, archive_field, json_default, record_document, version_document
+from project.workspace import WorkspaceManager, enforce_due, touch
 
-# Set up the MongoDB client, configure the databases, and assign variables to the "collections"
-client = MongoClient(config.MONGO_CLIENT)
-db = client.we1s
-projects_db = db.Projects
-corpus_db = db.Corpus
+# pymongo and nbformat are only loaded when first used, and nothing connects to
+# the database until a Project needs it
+nbformat = lazy_import('nbformat')
 
-JSON_UTIL = json_util.default
+# Versions are written without their stored archives
+JSON_UTIL = json_default
+# Return only these fields when listing projects
+SUMMARY_PROJECTION = {
+    'name': True,
+    'title': True,
+    'contributors': True,
+    'db_query': True,
+    'content.version_number': True,
+    'content.version_date': True,
+    'content.version_name': True,
+    'content.version_workflow': True
+}
+# Exclude the zip archives stored by older versions when reading project records; see `Project.load()`
+VERSION_PAYLOAD_PROJECTION = {'content.zipfile': False, 'content.version_zipfile': False}
+# Background restore threads are named with this prefix and the path of the folder they write
+RESTORE_THREAD = 'restore '
 
 class Project():
     """Model a project.
@@ -38,18 +64,86 @@ class Project():
 
     """
 
-    def __init__(self, manifest, templates_dir, workspace_dir, temp_dir):
+    def __init__(self, manifest, templates_dir, workspace_dir, temp_dir, client=None):
         """Initialize the object."""
         self.manifest = manifest
+        self.client = client
         self.templates_dir = templates_dir
         self.workspace_dir = workspace_dir
         self.temp_dir = temp_dir
+        self.stats = {}
+        # Replaced by callers that want progress events or to cancel an operation
+        self.progress = Progress()
+        self.instrument = Instrument(get_sinks(), config.INSTRUMENT_PROFILE, config.INSTRUMENT_TRACE_MEMORY)
+        self._blobs = None
+        self._pending = {}
+        self._restores = {}
         self.reduced_manifest = self.clean(manifest)
+        # Index the versions, sharing the manifest's content list
+        self.versions = VersionIndex(self.reduced_manifest.get('content'))
+        if 'content' in self.reduced_manifest:
+            self.reduced_manifest['content'] = self.versions.versions
         if '_id' in self.reduced_manifest:
             self._id = self.reduced_manifest['_id']
         else:
             self._id = None
 
+    @property
+    def db(self):
+        """Get the database from the project's client or the process-wide client."""
+        return get_database(self.client)
+
+    @property
+    def projects_db(self):
+        """Get the Projects collection."""
+        return self.db.Projects
+
+    @property
+    def corpus_db(self):
+        """Get the Corpus collection."""
+        return self.db.Corpus
+
+    @property
+    def blobs(self):
+        """Get the blob store for version files, creating it on first use."""
+        if self._blobs is None:
+            self._blobs = get_blob_store(self.db, config.BLOB_STORE, config.BLOB_DIR)
+        return self._blobs
+
+    def add_version(self, version_dict, replace=False):
+        """Add a version to the project record with a single server-side update.
+
+        A new version is pushed onto the record's `content` only if no stored version
+        has the same number. If another save has taken the number in the meantime,
+        the version is renumbered after the latest stored version. If replace is
+        True, the stored version with the same number is updated in place.
+        """
+        _id = ObjectId(self._id)
+        try:
+            if replace:
+                result = self.projects_db.update_one({'_id': _id, 'content.version_number': version_dict['version_number']},
+                                                {'$set': {'content.$': version_document(version_dict)}})
+                if result.matched_count > 0:
+                    self.set_version(version_dict)
+                    return {'result': 'success', 'version_number': version_dict['version_number'], 'errors': []}
+            for _ in range(config.VERSION_RETRIES):
+                result = self.projects_db.update_one({'_id': _id, 'content.version_number': {'$ne': version_dict['version_number']}},
+                                                {'$push': {'content': version_document(version_dict)}})
+                if result.matched_count > 0:
+                    self.set_version(version_dict)
+                    return {'result': 'success', 'version_number': version_dict['version_number'], 'errors': []}
+                # The number has been taken, so renumber the version after the latest stored version
+                record = self.projects_db.find_one({'_id': _id}, projection={'content.version_number': True})
+                if record is None:
+                    break
+                number = max([int(item['version_number']) for item in record.get('content', [])] or [0]) + 1
+                version_dict['version_number'] = number
+                version_dict['version_name'] = version_dict['version_date'] + '_v' + str(number) + '_' + self.reduced_manifest['name']
+        except pymongo.errors.OperationFailure as e:
+            print(e.code)
+            print(e.details)
+        return {'result': 'fail', 'errors': ['<p>Unknown error: Could not add the version to the database.</p>']}
+
     def clean(self, manifest):
         """Get a reduced version of the manifest, removing empty values."""
         data = {}
@@ -62,7 +156,8 @@ class Project():
         """Clean metadata fields and outputs from notebook.
 
         Cleans outputs only by default.
-        Takes a path to the notebook file. Returns a json object with the cleaned notebook.
+        Takes a path to the notebook file. Returns a json object with the cleaned notebook,
+        or, if save is True, rewrites the file and returns a dict counting the cleanings.
         Based on nbtoolbelt: https://gitlab.tue.nl/jupyter-projects/nbtoolbelt/blob/master/src/nbtoolbelt/cleaning.py
         """
         # Read the file
@@ -70,51 +165,31 @@ class Project():
             nb = nbformat.read(nbfile, as_version=4)
         except Exception as e:
             print('{}: {}'.format(type(e).__name__, e), sys.stderr)
-        freq = defaultdict(int)  # number of cleanings
-        # delete notebook (global) metadata fields
-        if isinstance(clean_notebook_metadata_fields, list) and len(clean_notebook_metadata_fields) > 0:
-            for field in clean_notebook_metadata_fields:
-                if field in nb.metadata:
-                    del nb.metadata[field]
-                    freq['global ' + field] += 1
-        # delete empty cells, if desired
-        n = len(nb.cells)
-        if clean_empty_cells:
-            nb.cells = [cell for cell in nb.cells if self.count_source(cell.source)[0]]
-        if n > len(nb.cells):
-            freq['empty cells'] = n - len(nb.cells)
-        # traverse all cells, and delete fields
-        for _, cell in enumerate(nb.cells):  # Assign an index if needed for debugging
-            ct = cell.cell_type
-            # delete cell metadata fields
-            if isinstance(clean_cell_metadata_fields, list) and len(clean_cell_metadata_fields) > 0:
-                for field in clean_cell_metadata_fields:
-                    if field in cell.metadata:
-                        del cell.metadata[field]
-                        freq['cell ' + field] += 1
-            # delete cell tags
-            if 'tags' in cell.metadata and isinstance(clean_tags, list) and len(clean_tags) > 0:
-                removed_tags = {tag for tag in cell.metadata.tags if tag in clean_tags}
-                for tag in removed_tags:
-                    freq['tag ' + tag] += 1
-                clean_tags = [tag for tag in cell.metadata.tags if tag not in clean_tags]
-                if clean_tags:
-                    cell.metadata.tags = clean_tags
-                else:
-                    del cell.metadata['tags']
-            # clean outputs of code cells, if requested
-            if ct == 'code' and clean_outputs == True:
-                if cell.outputs:
-                    cell.outputs = []
-                    freq['outputs'] += 1
-                cell.execution_count = None
+        freq = clean_notebook(nb, clean_outputs, clean_notebook_metadata_fields, clean_cell_metadata_fields,
+                              clean_tags, clean_empty_cells)
         # re-write the json file or return it to a variable
         if save == True:
             with open(nbfile, 'w') as f:
                 f.write(json.dumps(nb, indent=2))
+            return freq
         else:
             return json.dumps(nb, indent=2)
 
+    def clean_notebooks(self, path, processes=None, **options):
+        """Clean every notebook in a project folder, across a process pool.
+
+        Notebooks which are already clean are detected with a fast scan and are
+        not rewritten. The pool is only started if there are at least
+        `config.CLEAN_POOL_MIN_NOTEBOOKS` notebooks totalling at least
+        `config.CLEAN_POOL_MIN_BYTES`. Takes the keyword arguments of clean_nb()
+        other than save. Returns the numbers of notebooks cleaned and skipped and
+        the cleanings counted over all of them in `freq`.
+        """
+        if processes is None:
+            processes = config.CLEAN_PROCESSES
+        return clean_notebooks(find_notebooks(path), processes, config.CLEAN_POOL_MIN_NOTEBOOKS,
+                               config.CLEAN_POOL_MIN_BYTES, **options)
+
     def compare_files(self, existing_file, new_file):
         """Hash and compare two files.
 
@@ -140,25 +215,32 @@ class Project():
         if version == None:
             version = self.get_latest_version_number()
         # Get the version dict and reset the version number and date
-        version_dict = self.get_version(version)
+        version_dict = self.get_version(version).copy()
         version_dict['version_number'] = 1
         now = datetime.today().strftime('%Y%m%d%H%M%S')
         version_dict['version_date'] = now
         version_dict['version_name'] = now + '_v1_' + self.reduced_manifest['name']
-        self.reduced_manifest['content'] = [version_dict]
+        self.versions = VersionIndex([version_dict])
+        self.reduced_manifest['content'] = self.versions.versions
         # Save the manifest
+        self.progress.report('save')
         try:
-            projects_db.insert_one(self.reduced_manifest)
+            result = self.projects_db.insert_one(record_document(self.reduced_manifest))
+            self.reduced_manifest['_id'] = result.inserted_id
             return json.dumps({'result': 'success', 'project_dir': version_dict['version_name'], 'errors': []})
         except pymongo.errors.OperationFailure as e:
             print(e.code)
             print(e.details)
             return json.dumps({'result': 'fail', 'errors': ['<p>Unknown error: Could not insert the new project from the database.</p>']})
 
-    def copy_templates(self, templates, project_dir):
-        """Copy the workflow templates from the templates folder to the a project folder."""
+    def copy_templates(self, templates, project_dir, dirs_exist_ok=False):
+        """Copy the workflow templates from the templates folder to the a project folder.
+
+        Files are cloned with reflinks where the filesystem supports them.
+        """
         try:
-            copytree(templates, project_dir, ignore=ignore_patterns('.ipynb_checkpoints', '__pycache__'))
+            clone_tree(templates, project_dir, ignore=['.ipynb_checkpoints', '__pycache__'], hardlinks=False,
+                       dirs_exist_ok=dirs_exist_ok)
             return []
         except IOError:
             return '<p>Error: The templates could not be copied to the project directory.</p>'
@@ -171,18 +253,18 @@ class Project():
         :param source: string to count
         :return: number of non-blank lines, words, and non-whitespace characters
         """
-        lines = [line for line in source.split('\n') if line and not line.isspace()]
-        words = source.split()
-        chars = ''.join(words)
-        return len(lines), len(words), len(chars)
+        return count_source(source)
 
+    @instrumented('create_version_dict')
     def create_version_dict(self, path=None, version=None):
         """Create and return a version dict.
 
-        If a project path is given, the project folder is zipped
-        and compared to the latest existing zip archive. If it
-        differs, a new dict is created with a higher version number.
+        If a project path is given, the files in the project folder are stored
+        and compared to the existing version with `detect_changes()`. If they
+        differ, a new dict is created with a higher version number.
         """
+        if path is not None:
+            return self.detect_changes(path, version)[0]
         # Get the latest version number or 1 if it doesn't exist
         if version == None:
             version = self.get_latest_version_number()
@@ -190,46 +272,17 @@ class Project():
         # Create an empty dict of the manifest doesn't have one
         if version_dict == 0 or version_dict == None:
             version_dict = {}
-        # If a path is given, zip it and compare to the existing hash
-        if path is not None:
-            now = datetime.today().strftime('%Y%m%d%H%M%S')
-            version_dict['version_name'] = now + '_v' + str(version) + self.reduced_manifest['name']
-            version_dict['version_number'] = version
-
-            # Make sure there is a zipfile to compare
-            # Zip the project path
-            if not os.path.exists(self.temp_dir):
-                os.makedirs(self.temp_dir)
-            new_zipfile_path = self.temp_dir + '/' + version_dict['version_name'] + '.zip'
-            new_zipfile = zipfile.ZipFile(new_zipfile_path, 'w', zipfile.ZIP_DEFLATED)
-            rootlen = len(path) + 1
-            for base, _, files in os.walk(path):
-                # Create local paths and write them to the new zipfile
-                for file in files:
-                    fn = os.path.join(base, file)
-                    new_zipfile.write(fn, fn[rootlen:])
-                # Compare the hashes
-            if 'zipfile' in version_dict and version_dict['zipfile'] is not None:
-                result = self.compare_files(version_dict['zipfile'], new_zipfile)
-                # If the zipfiles are not the same iterate the version
-                if result == False:
-                    version = version + 1
-                    version_dict['version_number'] = version
-            with open(new_zipfile_path, 'rb') as f:
-                    version_dict['zipfile'] = Binary(f.read())
-            # Now remove the temporary zipfile
-            new_zipfile.close()
-            os.remove(new_zipfile_path)
-            # else:
-            #     version_dict['zipfile'] = Binary(new_zipfile)
         return version_dict
 
     def delete(self, version=None):
         """Delete a project or a project version, if the number is supplied."""
         if version == None:
+            self.progress.report('delete')
             try:
-                result = projects_db.delete_one({'_id': ObjectId(self._id)})
+                candidates = self.version_blobs(self.versions.versions)
+                result = self.projects_db.delete_one({'_id': ObjectId(self._id)})
                 if result.deleted_count > 0:
+                    self.collect_blobs(candidates)
                     return {'result': 'success', 'errors': []}
                 else:
                     return {'result': 'fail', 'errors': ['<p>Unknown error: Could not delete the project from the database.</p>']}
@@ -238,26 +291,120 @@ class Project():
                 print(e.details)
                 return {'result': 'fail', 'errors': ['<p>Unknown error: Could not delete the project from the database.</p>']}
         else:
-            try:
-                for index, item in enumerate(self.reduced_manifest['content']):
-                    if item['version_number'] == version:
-                        del self.reduced_manifest['content'][index]
-                        projects_db.update_one({'_id': ObjectId(self._id)},
-                                   {'$set': {'content': self.reduced_manifest['content']}}, upsert=False)
-            except pymongo.errors.OperationFailure as e:
-                print(e.code)
-                print(e.details)
-                return {'result': 'fail', 'errors': ['<p>Unknown error: Could not delete the project from the database.</p>']}
+            return self.remove_version(version)
+
+    @instrumented('detect_changes')
+    def detect_changes(self, path, version=None):
+        """Compare a project folder to a stored version and store any changed files.
+
+        The manifest saved in the folder by the last save records the size,
+        modification time and hash of every file, so only files whose stats
+        have changed are rehashed and uploaded to the blob store. The version
+        stores only the digest of the resulting manifest of file hashes.
+
+        Returns the version dict and a dict of changes whose `status` is
+        'unchanged', 'changed' (the version was updated in place) or 'new version'.
+        """
+        # Get the latest version number or 1 if it doesn't exist
+        if version == None:
+            version = self.get_latest_version_number()
+        version_dict = self.get_version(version)
+        # Create an empty dict of the manifest doesn't have one
+        if version_dict == 0 or version_dict == None:
+            version_dict = {}
+        else:
+            version_dict = version_dict.copy()
+        # A folder must be fully restored before it can be compared
+        self.wait_for_restore(path)
+        if os.path.exists(os.path.join(path, PENDING_FILE)) or folder_state(path) == 'incomplete':
+            return version_dict, {'status': 'incomplete',
+                                  'errors': ['<p>The project folder has not been completely written, so it cannot be saved yet.</p>']}
+        self.progress.report('scan')
+        local_manifest = load_local_manifest(path)
+        with self.instrument.measure('scan'):
+            scan = scan_manifest(path, local_manifest)
+        self.instrument.count('files_changed', len(scan['changed']))
+        changes = {'status': 'unchanged', 'changed_files': scan['changed'], 'removed_files': scan['removed']}
+        if scan['changed'] == [] and scan['removed'] == [] \
+                and local_manifest.get('manifest') is not None \
+                and local_manifest.get('manifest') == version_dict.get('manifest'):
+            return version_dict, changes
+        # Files that have not changed since the last save are already in the blob store,
+        # unless the version that recorded them has since been deleted and its blobs collected
+        with self.instrument.measure('upload'):
+            for attempt in range(3):
+                try:
+                    if self.manifest_referenced(local_manifest.get('manifest')):
+                        digest, uploaded = store_manifest(self.blobs, path, scan['manifest'], scan['changed'],
+                                                          progress=self.progress.reporter('upload'))
+                    else:
+                        digest, uploaded = store_manifest(self.blobs, path, scan['manifest'], progress=self.progress.reporter('upload'))
+                    break
+                except DigestMismatch:
+                    # A file was edited after it was scanned, so scan the folder again
+                    if attempt == 2:
+                        raise
+                    with self.instrument.measure('scan'):
+                        scan = scan_manifest(path, local_manifest)
+                    changes['changed_files'] = scan['changed']
+                    changes['removed_files'] = scan['removed']
+        self.instrument.count('files_uploaded', uploaded)
+        save_local_manifest(path, digest, scan)
+        if version_dict.get('manifest') == digest:
+            return version_dict, changes
+        # If the manifests are not the same iterate the version, unless it has not been stored yet
+        changes['status'] = 'changed'
+        if 'manifest' in version_dict or archive_field(version_dict) is not None:
+            version = version + 1
+            changes['status'] = 'new version'
+        now = datetime.today().strftime('%Y%m%d%H%M%S')
+        version_dict['version_date'] = now
+        version_dict['version_number'] = version
+        version_dict['version_name'] = now + '_v' + str(version) + '_' + self.reduced_manifest['name']
+        version_dict['manifest'] = digest
+        version_dict['files'] = len(scan['manifest'])
+        version_dict['size'] = sum(record['size'] for record in scan['manifest'])
+        version_dict['uploaded'] = uploaded
+        # Versions with a manifest no longer carry a zip archive
+        version_dict.pop('zipfile', None)
+        version_dict.pop('version_zipfile', None)
+        return version_dict, changes
+
+    def enforce_workspace_budget(self, keep=None):
+        """Evict old Workspace folders and exports if `config.WORKSPACE_MAX_BYTES` is exceeded.
+
+        Only folders which can be restored from a stored version are evicted.
+        The Workspace is scanned at most once every `config.WORKSPACE_CHECK_INTERVAL`
+        seconds. Returns the eviction report, or None if there is no budget or
+        the budget was enforced too recently.
+        """
+        if config.WORKSPACE_MAX_BYTES is None or not enforce_due(self.workspace_dir):
+            return None
+        manager = WorkspaceManager(self.workspace_dir, self.temp_dir, config.WORKSPACE_MAX_BYTES, client=self.client)
+        report = manager.enforce(keep=keep)
+        self.stats['workspace'] = {key: report[key] for key in ['bytes', 'evicted', 'evicted_bytes']}
+        return report
 
     def exists(self):
         """Test whether the project already exists in the database."""
-        test = projects_db.find_one({'_id': ObjectId(self._id)})
+        test = self.projects_db.find_one({'_id': ObjectId(self._id)}, projection={'_id': True})
         if test is not None:
             return True
         return False
 
-    def export(self, version=None):
-        """Export a project in the Workspace."""
+    @instrumented('export')
+    def export(self, version=None, background=False):
+        """Export a project in the Workspace.
+
+        If background is True, the export is added to the job queue and a `Job`
+        is returned whose `result()` is the JSON result of the export. An export
+        which stopped partway is resumed by `write_export()`.
+        """
+        if background:
+            if version == None:
+                version = self.get_latest_version_number()
+            return self.submit_job('export', version=version)
+        self.enforce_workspace_budget()
         errors = []
         # Get the version dict. Use the latest version if no version number is supplied.
         if version == None:
@@ -267,76 +414,206 @@ class Project():
         # Set the filename and path to write to
         zipname = version_dict['version_name'] + '.zip'
         exports_dir = self.workspace_dir + '/' + 'exports'
-        # 1. First try to get the zip file from the manifest and copy it to the exports folder
-        if 'version_zipfile' in version_dict:
+        # 1. First try to build the zip file from the version's blobs or copy its zip file to the exports folder
+        if 'manifest' in version_dict:
             try:
-                zipfile = version_dict['version_zipfile']
+                self.write_export(os.path.join(exports_dir, zipname), version_dict)
+            except IOError:
+                errors.append('Error: Could not write the zip archive to the exports directory.')
+        elif archive_field(version_dict) is not None:
+            try:
+                os.makedirs(exports_dir, exist_ok=True)
                 with open(os.path.join(exports_dir, zipname), 'wb') as f:
-                    f.write(zipfile)
+                    f.write(version_dict[archive_field(version_dict)])
             except IOError:
                 errors.append('Error: Could not write the zip archive to the exports directory.')
-        # 2. Next try to find an active project folder in the Workspace and zip it to the exports folder
-        elif os.path.exists(os.path.join(self.workspace_dir, version_dict['version_name'])):
+        # 2. Next try to find a complete project folder in the Workspace and zip it to the exports folder
+        elif folder_state(os.path.join(self.workspace_dir, version_dict['version_name'])) == 'complete':
             try:
-                project_dir = os.path.join(self.workspace_dir, version_dict['version_name'])
-                zipfile = self.zip(zipname, project_dir, exports_dir)
+                self.write_export(os.path.join(exports_dir, zipname), version_dict)
             except IOError:
                 errors.append('Error: Could not zip project folder from the Workspace to the exports directory.')
-        # 3. Finally, create a new project folder in the exports directory and populate from the database
+        # 3. Finally, build the archive from the workflow templates and the database without an intermediate folder
         else:
-            # Make a version folder in the exports directory
-            project_dir = exports_dir + '/' + version_dict['version_name']
-            os.makedirs(project_dir, exist_ok=True)
-            # Get the data and put a manifest in it and write data to the caches/json folder
-            self.reduced_manifest['db_query'] = json.loads('{"$and":[{"metapath":"Corpus,guardian,RawData"}]}')
-            result = corpus_db.find(self.reduced_manifest['db_query'])
             try:
-                with open(os.path.join(project_dir, 'datapackage.json'), 'w') as f:
-                    f.write(json.dumps(self.reduced_manifest, indent=2, sort_keys=False, default=JSON_UTIL))
-                json_caches = os.path.join(project_dir, 'caches/json')
-                os.makedirs(json_caches, exist_ok=True)
-                for item in result:
-                    filename = os.path.join(json_caches, item['name'] + '.json')
-                    with open(filename, 'w') as f:
-                        f.write(json.dumps(item, indent=2, sort_keys=False, default=JSON_UTIL))
+                self.write_export(os.path.join(exports_dir, zipname), version_dict)
+            except pymongo.errors.OperationFailure as e:
+                print(e.code)
+                print(e.details)
+                errors.append('<p>Unknown Error: The database query could not be executed.</p>')
             except IOError:
-                errors.append('<p>Error: Could not write data files to the caches directory.</p>')
-            # Zip up the project folder, then delete the folder
-            zipfile = self.zip(zipname, project_dir, exports_dir)
-            rmtree(project_dir)
+                errors.append('Error: Could not write the zip archive to the exports directory.')
         # Return the path to the zip archive
         if len(errors) > 0:
             return json.dumps({'result': 'fail', 'errors': errors})
         else:
-            return json.dumps({'result': 'success', 'filepath': exports_dir + '/' + zipname, 'errors': errors})
+            return json.dumps({'result': 'success', 'filepath': exports_dir + '/' + zipname, 'stats': self.stats, 'errors': errors})
+
+    def export_entries(self, version_dict):
+        """Get the archive entries of a version from the best available source.
+
+        These are the version's files in the blob store, its folder in the Workspace
+        or, failing both, the workflow templates, the datapackage and the documents
+        matching the project's query, which are encoded as the archive is written.
+        Generated members are dated with the version date and documents are read
+        in `_id` order, so the same data always gives the same archive.
+        """
+        date_time = datetime.strptime(version_dict['version_date'], '%Y%m%d%H%M%S').timetuple()[:6]
+        if 'manifest' in version_dict:
+            return entries_from_manifest(self.blobs, load_manifest(self.blobs, version_dict['manifest']), date_time)
+        project_dir = os.path.join(self.workspace_dir, version_dict['version_name'])
+        if folder_state(project_dir) == 'complete':
+            return entries_from_dir(project_dir, exclude=[MANIFEST_FILE, PENDING_FILE, JOURNAL_FILE])
+        self.reduced_manifest['db_query'] = json.loads('{"$and":[{"metapath":"Corpus,guardian,RawData"}]}')
+        return self._rebuild_entries(version_dict, self.reduced_manifest['db_query'], date_time)
+
+    def _rebuild_entries(self, version_dict, db_query, date_time):
+        """Yield the archive entries of a project rebuilt from its templates and the database."""
+        templates = os.path.join(self.templates_dir, version_dict.get('version_workflow', ''))
+        if 'version_workflow' in version_dict and os.path.exists(templates):
+            for entry in entries_from_dir(templates):
+                if not any(part in ['.ipynb_checkpoints', '__pycache__'] for part in entry.arcname.split(os.sep)):
+                    yield entry
+        datapackage = json.dumps(self.reduced_manifest, indent=2, sort_keys=False, default=JSON_UTIL)
+        yield entry_from_bytes('datapackage.json', datapackage.encode('utf-8'), date_time)
+        projection = self.reduced_manifest.get('db_projection', config.CORPUS_PROJECTION)
+        if projection and any(v for k, v in projection.items() if k != '_id'):
+            projection = dict(projection, name=True)
+        cursor = self.corpus_db.find(db_query, projection or None, batch_size=config.CORPUS_BATCH_SIZE).sort('_id', 1)
+        if config.CORPUS_LAYOUT != 'jsonl':
+            for item in cursor:
+                name, data = encode([item], config.CORPUS_INDENT)[0]
+                yield entry_from_bytes('caches/json/' + name + '.json', data, date_time)
+            return
+        # Each shard is built in memory and added to the archive once it is full
+        completed = []
+        shards = JsonlShards(lambda name: BytesIO(), config.CORPUS_SHARD_SIZE, config.CORPUS_COMPRESSION,
+                             config.CORPUS_BLOCK_SIZE, on_close=lambda name, f: completed.append((name, f.getvalue())))
+        for item in cursor:
+            shards.add(*encode([item], None)[0])
+            while completed:
+                name, data = completed.pop(0)
+                yield entry_from_bytes('caches/jsonl/' + name, data, date_time)
+        index = shards.close()
+        for name, data in completed:
+            yield entry_from_bytes('caches/jsonl/' + name, data, date_time)
+        yield entry_from_bytes('caches/jsonl/index.json', index, date_time)
+
+    def export_etag(self, version_dict, compresslevel=None):
+        """Get a tag which changes whenever a version's exported archive would change.
+
+        Used to validate HTTP range requests that resume a download. Returns None
+        if the archive would be rebuilt from the corpus and `config.CORPUS_MODIFIED_FIELD`
+        is not set, since documents edited in place could not be detected.
+        """
+        if compresslevel is None:
+            compresslevel = config.ZIP_COMPRESSLEVEL
+        if 'manifest' in version_dict:
+            source = version_dict['manifest']
+        elif archive_field(version_dict) is not None:
+            source = hashlib.sha256(version_dict[archive_field(version_dict)]).hexdigest()
+        elif folder_state(os.path.join(self.workspace_dir, version_dict['version_name'])) == 'complete':
+            project_dir = os.path.join(self.workspace_dir, version_dict['version_name'])
+            source = [[entry.arcname, entry.size, entry.date_time]
+                      for entry in entries_from_dir(project_dir, exclude=[MANIFEST_FILE, PENDING_FILE, JOURNAL_FILE])]
+        elif config.CORPUS_MODIFIED_FIELD is None:
+            return None
+        else:
+            db_query = json.loads('{"$and":[{"metapath":"Corpus,guardian,RawData"}]}')
+            templates = os.path.join(self.templates_dir, version_dict.get('version_workflow', ''))
+            source = [corpus_marker(self.corpus_db, db_query, config.CORPUS_MODIFIED_FIELD),
+                      json.dumps(self.reduced_manifest, sort_keys=True, default=JSON_UTIL),
+                      [config.CORPUS_LAYOUT, config.CORPUS_INDENT, config.CORPUS_SHARD_SIZE,
+                       config.CORPUS_COMPRESSION, config.CORPUS_BLOCK_SIZE]]
+            if 'version_workflow' in version_dict and os.path.exists(templates):
+                source.append([[entry.arcname, entry.size, entry.date_time] for entry in entries_from_dir(templates)])
+        data = json.dumps([version_dict['version_name'], compresslevel, source], default=JSON_UTIL)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()[:32]
+
+    def export_stream(self, version=None, start=0, end=None, compresslevel=None, workers=None):
+        """Stream a version's zip archive without writing it or the project folder to disk.
+
+        Returns a dict with the archive's filename, its `etag` and a `stream`
+        iterator which yields the bytes from offset `start` to `end`, inclusive.
+        The archive is deterministic, so an interrupted download can be resumed
+        with a range starting where it stopped, provided the etag has not changed.
+        Ranges are refused if there is no etag to validate them with.
+        """
+        if version == None:
+            version_dict = self.get_latest_version()
+        else:
+            version_dict = self.get_version(version)
+        if not version_dict:
+            return {'result': 'fail', 'errors': ['<p>The project version could not be found.</p>']}
+        if compresslevel is None:
+            compresslevel = config.ZIP_COMPRESSLEVEL
+        if workers is None:
+            workers = config.ZIP_WORKERS
+        etag = self.export_etag(version_dict, compresslevel)
+        if etag is None and (start > 0 or end is not None):
+            return {'result': 'fail', 'errors': ['<p>This version cannot be downloaded in parts, since it is rebuilt from a corpus whose changes cannot be detected.</p>']}
+        if 'manifest' not in version_dict and archive_field(version_dict) is not None:
+            data = version_dict[archive_field(version_dict)]
+            stream = iter([data[start:None if end is None else end + 1]])
+        else:
+            stream = iter_archive(self.export_entries(version_dict), compresslevel, workers, start=start, end=end)
+        return {'result': 'success', 'filename': version_dict['version_name'] + '.zip', 'etag': etag,
+                'start': start, 'end': end, 'stream': stream, 'errors': []}
+
+    def write_export(self, zip_path, version_dict):
+        """Write a version's zip archive to a file, resuming an earlier write that stopped partway.
+
+        The archive is written to a `.part` file, with a journal recording its
+        etag, and renamed into place once it is complete. The archive is
+        deterministic, so if the etag is unchanged an interrupted write is
+        resumed by appending the bytes after the end of the part file. A version
+        without an etag is always written from the start.
+        """
+        os.makedirs(os.path.dirname(zip_path), exist_ok=True)
+        part_path = zip_path + '.part'
+        journal = Journal(part_path + '.json')
+        etag = self.export_etag(version_dict)
+        resumed = journal.start('export', etag) and etag is not None and os.path.exists(part_path)
+        if resumed:
+            offset = os.path.getsize(part_path)
+            with open(part_path, 'ab') as f:
+                for data in iter_archive(self.export_entries(version_dict), config.ZIP_COMPRESSLEVEL, config.ZIP_WORKERS,
+                                         start=offset):
+                    f.write(data)
+            self.stats['zip'] = {'resumed_from': offset, 'bytes_out': os.path.getsize(part_path)}
+        else:
+            with open(part_path, 'wb') as f:
+                self.stream_zip(f, entries=self.export_entries(version_dict))
+        os.replace(part_path, zip_path)
+        journal.remove()
+        return self.stats['zip']
+
+    def export_size(self, version=None, compresslevel=None, workers=None):
+        """Get the size of a version's streamed archive, e.g. for a Content-Length header.
+
+        The archive is built and discarded to count its bytes, so callers should
+        keep the result for as long as the etag is unchanged.
+        """
+        result = self.export_stream(version, compresslevel=compresslevel, workers=workers)
+        if result['result'] == 'fail':
+            return result
+        size = sum(len(data) for data in result['stream'])
+        return {'result': 'success', 'size': size, 'etag': result['etag'], 'errors': []}
 
     def get_latest_version_number(self):
         """Get the latest version number from the versions dict.
 
         Returns an integer or 1, if no version information is available.
         """
-        version_numbers = []
-        if 'content' in self.reduced_manifest and len(self.reduced_manifest['content']) > 0:
-            for version in self.reduced_manifest['content']:
-                version_numbers.append(int(version['version_number']))
-            _latest_version_number = max(version_numbers)
-        else:
-            _latest_version_number = 1
-        return _latest_version_number
+        if self.versions.latest_number is None:
+            return 1
+        return self.versions.latest_number
 
     def get_latest_version(self):
         """Get the dict for the latest version."""
-        _latest_version = {}
-        version_numbers = []
-        if 'content' in self.reduced_manifest and len(self.reduced_manifest['content']) > 0:
-            for version in self.reduced_manifest['content']:
-                version_numbers.append(int(version['version_number']))
-            _latest_version_number = max(version_numbers)
-            for version in self.reduced_manifest['content']:
-                if version['version_number'] == _latest_version_number:
-                    _latest_version = version['version_number']
-        return self.get_version(_latest_version)
-
+        if 'content' not in self.reduced_manifest:
+            return 0
+        return self.versions.latest()
 
     def get_version(self, value, key='number'):
         """Get the dict for a specific version.
@@ -345,16 +622,94 @@ class Project():
         'name', or 'date', that value is used to find the dict.
         """
         if 'content' in self.reduced_manifest:
-            versions = self.reduced_manifest['content']
-            for version in versions:
-                if version['version_' + str(key)] == str(value):
-                    return version
+            return self.versions.get(value, key)
         else:
             # Return 0 to tell create_version_dict() to start with {}
             # raise ValueError('No versions were included in the manifest.')
             return 0
 
-    def launch(self, workflow, version=None, new=True):
+    @classmethod
+    def ensure_indexes(cls, client=None):
+        """Create the indexes used by the project listing API and by corpus queries."""
+        db = get_database(client)
+        try:
+            db.Projects.create_index('name')
+            db.Projects.create_index('content.version_date')
+            db.Projects.create_index('content.version_workflow')
+            db.Projects.create_index('content.manifest')
+            db.Corpus.create_index('metapath')
+            if config.BLOB_STORE == 'gridfs':
+                GridFSBlobStore.ensure_indexes(db)
+            return {'result': 'success', 'errors': []}
+        except pymongo.errors.OperationFailure as e:
+            print(e.code)
+            print(e.details)
+            return {'result': 'fail', 'errors': ['<p>Unknown error: Could not create the database indexes.</p>']}
+
+    @classmethod
+    def load(cls, _id, templates_dir, workspace_dir, temp_dir, client=None):
+        """Load a project from the database without its version payloads.
+
+        The zip archives stored by older versions are only fetched when
+        `launch()`, `restore()` or `export()` reads them, so the memory used by
+        a Project does not depend on the size of its archives. Returns None if
+        the project is not in the database.
+        """
+        projects_db = get_database(client).Projects
+        manifest = projects_db.find_one({'_id': ObjectId(_id)}, projection=VERSION_PAYLOAD_PROJECTION)
+        if manifest is None:
+            return None
+        project = cls(manifest, templates_dir, workspace_dir, temp_dir, client)
+        project.versions.attach_payloads(projects_db, manifest['_id'])
+        return project
+
+    @classmethod
+    def list_projects(cls, query=None, page=1, per_page=50, sort='name', client=None):
+        """List project summaries matching a database query, one page at a time.
+
+        Only the summary fields in `SUMMARY_PROJECTION` are returned, so version
+        files and archives are never read. Returns the page of summaries with
+        the total number of matching projects.
+        """
+        if query is None:
+            query = {}
+        page = max(int(page), 1)
+        projects_db = get_database(client).Projects
+        try:
+            total = projects_db.count_documents(query)
+            cursor = projects_db.find(query, projection=SUMMARY_PROJECTION).sort(sort, pymongo.ASCENDING)
+            projects = list(cursor.skip((page - 1) * per_page).limit(per_page))
+            return {'result': 'success', 'projects': projects, 'total': total, 'page': page,
+                    'per_page': per_page, 'errors': []}
+        except pymongo.errors.OperationFailure as e:
+            print(e.code)
+            print(e.details)
+            return {'result': 'fail', 'errors': ['<p>Unknown error: Could not list the projects in the database.</p>']}
+
+    @classmethod
+    def search_projects(cls, name=None, date_from=None, date_to=None, workflow=None, page=1, per_page=50, client=None):
+        """Search project summaries by name prefix, version date range and workflow.
+
+        Dates use the version date format, e.g. '20190131' or '20190131120000'.
+        """
+        query = {}
+        if name is not None:
+            # An anchored, case-sensitive prefix can use the index on name
+            query['name'] = {'$regex': '^' + re.escape(name)}
+        if date_from is not None or date_to is not None:
+            dates = {}
+            if date_from is not None:
+                dates['$gte'] = str(date_from)
+            if date_to is not None:
+                # Include every time on the final day
+                dates['$lte'] = str(date_to).ljust(14, '9')
+            query['content.version_date'] = dates
+        if workflow is not None:
+            query['content.version_workflow'] = workflow
+        return cls.list_projects(query, page, per_page, client=client)
+
+    @instrumented('launch')
+    def launch(self, workflow, version=None, new=True, sample=None, stratify=None):
         """Prepare the project in the Workspace.
 
         If the user does not have any datapackages stored in the database, a new v1
@@ -363,11 +718,21 @@ class Project():
         on a specific version's rocket icon, a project_dir based on that version's
         datapackage is created. Where possible, a datapackage is unzipped to the
         Workspace. Otherwise, the data is written to the project_dir from the database.
+        A launch which stopped partway is resumed in the same project_dir, and an
+        existing project_dir is only reused if its journal shows it is complete.
+
+        If `sample` is a number of documents, a new v1 is launched with a
+        deterministic sample of the query's documents, stratified by the values
+        of the `stratify` field if one is given. `upgrade_sample()` later fills
+        in the rest of the corpus in the same project_dir.
         """
-        # If the manifest has a zipfile, skip Option 1
-        if 'content' in self.reduced_manifest:
-            for item in self.reduced_manifest['content']:
-                if 'zipfile' in item:
+        # Make room in the Workspace first, keeping any of this project's folders that the launch may reuse
+        self.enforce_workspace_budget(keep=[os.path.join(self.workspace_dir, version['version_name'])
+                                            for version in self.versions.versions if 'version_name' in version])
+        # If the manifest has a stored version, skip Option 1
+        if 'content' in self.reduced_manifest and version is None:
+            for item in self.versions.versions:
+                if 'manifest' in item or 'zipfile' in item or 'version_zipfile' in item:
                     version = 'latest'
 
         # Get a timestamp
@@ -375,18 +740,23 @@ class Project():
 
         # Option 1. Generate a project_dir for a new v1
         if new == True and version == None:
+            templates = os.path.join(self.templates_dir, workflow)
+            # Resume a launch of the same project and workflow which stopped partway
+            unfinished = find_incomplete(self.workspace_dir, '_v1_' + self.reduced_manifest['name'], 'launch',
+                                         self._launch_key(templates, sample, stratify))
+            if unfinished is not None:
+                now = self.parse_version(os.path.basename(unfinished), 'date')
             version_name = now + '_v1_' + self.reduced_manifest['name']
-            self.reduced_manifest['content'] = {
+            self.set_version({
                 'version_date': now,
                 'version_number': 1,
                 'version_name': version_name,
                 'version_workflow': workflow
-            }
+            })
             project_dir = os.path.join(self.workspace_dir, version_name)
-            templates = os.path.join(self.templates_dir, workflow)
-            errors = self.make_new_project_dir(project_dir, templates)
+            errors = self.make_new_project_dir(project_dir, templates, sample, stratify)
             if errors == []:
-                return json.dumps({'result': 'success', 'project_dir': project_dir, 'errors': []})
+                return json.dumps({'result': 'success', 'project_dir': project_dir, 'stats': self.stats, 'errors': []})
             else:
                 return json.dumps({'result': 'fail', 'errors': errors})
 
@@ -394,22 +764,27 @@ class Project():
         if new == True and version is not None:
             version_dict = self.get_latest_version()
             next_version_number = version_dict['version_number'] + 1
-            next_version_name = now + '_v' + str(next_version_number) +'_' + self.reduced_manifest['name']
+            suffix = '_v' + str(next_version_number) + '_' + self.reduced_manifest['name']
+            # Resume a restore of the same version which stopped partway
+            unfinished = find_incomplete(self.workspace_dir, suffix, 'restore', self._restore_key(version_dict))
+            if unfinished is not None:
+                now = self.parse_version(os.path.basename(unfinished), 'date')
+            next_version_name = now + suffix
             next_version = {
                 'version_date': now,
                 'version_number': next_version_number,
                 'version_workflow': workflow,
-                'version_name': next_version_name,
-                'version_zipfile': version_dict['version_zipfile']
+                'version_name': next_version_name
             }
-            self.reduced_manifest['content'] = next_version
+            # The new version has not been stored yet, so it takes neither the latest version's manifest
+            # nor its archive. Its first save then records it under this number rather than treating it as saved.
+            self.set_version(next_version)
             project_dir = os.path.join(self.workspace_dir, next_version_name)
-            try:
-                self.unzip(version_dict['version_zipfile'], project_dir)
-                return json.dumps({'result': 'success', 'project_dir': project_dir, 'errors': []})
-            except:
-                errors = ['<p>Unknown error: Could not unzip the project datapackage to the project directory.</p>']
-                return json.dumps({'result': 'fail', 'errors': errors})
+            result = self.restore(version_dict, project_dir, lazy=config.LAZY_LAUNCH)
+            if result['result'] == 'success':
+                return json.dumps({'result': 'success', 'project_dir': project_dir, 'state': result['state'], 'errors': []})
+            else:
+                return json.dumps({'result': 'fail', 'errors': result['errors']})
 
         # Option 3. Launch a specific version
         if new == False:
@@ -420,54 +795,78 @@ class Project():
             print('Launching ' + version_dict['version_name'])
             project_dir = os.path.join(self.workspace_dir, version_dict['version_name'])
             # If the project is live in the workspace, return a link to the folder
-            if os.path.exists(project_dir):
-                return json.dumps({'result': 'success', 'project_dir': project_dir, 'errors': []})
-            # Otherwise, unzip the datapackage from the manifest to the workspace
+            if folder_state(project_dir) == 'complete':
+                touch(project_dir)
+                return json.dumps({'result': 'success', 'project_dir': project_dir, 'state': self.restore_state(project_dir), 'errors': []})
+            # Otherwise, restore the version from the database to the workspace, resuming an interrupted restore
             else:
-                try:
-                    self.unzip(version_dict['version_zipfile'], project_dir, binary=True)
-                    print('Unzipped to ' + project_dir)
-                except:
-                    errors.append('<p>Unknown error: Could not unzip the project datapackage to the project directory.</p>')
-                    return json.dumps({'result': 'fail', 'errors': errors})
-
-    def make_new_project_dir(self, project_dir, templates):
-        """Provide a helper function for Project.launch()."""
+                result = self.restore(version_dict, project_dir, lazy=config.LAZY_LAUNCH)
+                if result['result'] == 'success':
+                    print('Restored to ' + project_dir)
+                    return json.dumps({'result': 'success', 'project_dir': project_dir, 'state': result['state'], 'errors': []})
+                else:
+                    return json.dumps({'result': 'fail', 'errors': result['errors']})
+
+    @instrumented('make_new_project_dir')
+    def make_new_project_dir(self, project_dir, templates, sample=None, stratify=None):
+        """Provide a helper function for Project.launch().
+
+        Each completed stage and the last document written are recorded in the
+        folder's journal, so a launch which stopped partway resumes where it stopped.
+        If `sample` is given, only a sample of that many documents is written and
+        the sample is recorded in the datapackage as `corpus_sample`.
+        """
         errors = []
-        # The project_dir must not already exist
-        error = self.copy_templates(templates, project_dir)
-        if error != []:
-            errors.append(error)
+        journal, _ = open_journal(project_dir, 'launch', self._launch_key(templates, sample, stratify))
+        if not journal.is_done('templates'):
+            error = self.copy_templates(templates, project_dir, dirs_exist_ok=True)
+            if error != []:
+                errors.append(error)
+            else:
+                journal.done('templates')
         # If the there is a db_query, get the data
         self.reduced_manifest['db_query'] = json.loads('{"$and": [{"metapath":"Corpus,guardian,RawData"}]}')
         if 'db_query' in self.reduced_manifest:
-            try:
-                result = list(corpus_db.find(self.reduced_manifest['db_query']))
-                if len(result) == 0:
-                    errors.append('<p>The database query returned no results.</p>')
-            except pymongo.errors.OperationFailure as e:
-                print(e.code)
-                print(e.details)
-                msg = '<p>Unknown Error: The database query could not be executed.</p>'
-                errors.append(msg)
+            db_query = self.reduced_manifest['db_query']
+            datapackage = self.reduced_manifest
+            if sample is not None:
+                try:
+                    ids = sample_ids(self.corpus_db, db_query, sample, config.SAMPLE_SEED, stratify, config.CORPUS_BATCH_SIZE)
+                except pymongo.errors.OperationFailure as e:
+                    print(e.code)
+                    print(e.details)
+                    return errors + ['<p>Unknown Error: The database query could not be executed.</p>']
+                # The datapackage keeps the full query, so that the sample can be upgraded to the full corpus
+                self.stats['sample'] = {'size': sample, 'stratify': stratify, 'seed': config.SAMPLE_SEED, 'count': len(ids)}
+                datapackage = dict(datapackage, corpus_sample=self.stats['sample'])
+                db_query = {'$and': [db_query, {'_id': {'$in': ids}}]}
             # Write the data manifests to the caches/json folder
             try:
-                json_caches = os.path.join(project_dir, 'caches/json')
-                os.makedirs(json_caches, exist_ok=True)
                 with open(os.path.join(project_dir, 'datapackage.json'), 'w') as f:
-                    f.write(json.dumps(self.reduced_manifest, indent=2, sort_keys=False, default=JSON_UTIL))
-
-                for item in result:
-                    filename = os.path.join(json_caches, item['name'] + '.json')
-                    with open(filename, 'w') as f:
-                        f.write(json.dumps(item, indent=2, sort_keys=False, default=JSON_UTIL))
+                    f.write(json.dumps(datapackage, indent=2, sort_keys=False, default=JSON_UTIL))
             except IOError:
-                errors.append('<p>Error: Could not write data files to the caches directory.</p>')
+                errors.append('<p>Error: Could not write the datapackage to the project directory.</p>')
+            if not journal.is_done('corpus'):
+                # Samples are not worth keeping in the query cache
+                result = self.write_corpus(project_dir, db_query, use_cache=False if sample is not None else None,
+                                           journal=journal)
+                errors = errors + result['errors']
+                if result['result'] == 'success' and result['count'] == 0:
+                    errors.append('<p>The database query returned no results.</p>')
+                elif result['result'] == 'success':
+                    journal.done('corpus')
         else:
             errors.append('<p>Please enter a database query in the Data Resources tab.</p>')
-
+        if errors == []:
+            journal.complete()
         return errors
 
+    def _launch_key(self, templates, sample=None, stratify=None):
+        """Get the journal key of a new project folder built from a workflow's templates."""
+        if sample is None:
+            return journal_key(self._id, self.reduced_manifest['name'], templates)
+        return journal_key(self._id, self.reduced_manifest['name'], templates, sample, stratify, config.SAMPLE_SEED)
+
     def parse_version(self, s, output=None):
         """Separate a project folder name into its component parts.
 
@@ -483,40 +882,488 @@ class Project():
         else:
             return version.group(1), version.group(2), version.group(3)
 
+    def preview(self, db_query=None, projection=None, stratify=None, sample_size=None):
+        """Estimate the size of the corpus a query would write, without writing it.
+
+        Returns the number of matching documents and the estimated bytes of their
+        cached files, from encoding a random sample of `sample_size` matching
+        documents as `write_corpus()` would. The collection's statistics and the
+        query plan chosen by the server are included where they are available,
+        to show how large the documents are on the server and whether the query
+        uses an index. If `stratify` is a field name, the number of matching
+        documents with each of its values is also returned.
+        """
+        if db_query is None:
+            db_query = self.reduced_manifest.get('db_query')
+        if db_query is None:
+            return {'result': 'fail', 'errors': ['<p>Please enter a database query in the Data Resources tab.</p>']}
+        if projection is None:
+            projection = self.reduced_manifest.get('db_projection', config.CORPUS_PROJECTION)
+        if projection and any(v for k, v in projection.items() if k != '_id'):
+            projection = dict(projection, name=True)
+        if sample_size is None:
+            sample_size = config.PREVIEW_SAMPLE_SIZE
+        indent = None if config.CORPUS_LAYOUT == 'jsonl' else config.CORPUS_INDENT
+        try:
+            count = self.corpus_db.count_documents(db_query)
+            pipeline = [{'$match': db_query}, {'$sample': {'size': sample_size}}]
+            if projection:
+                pipeline.append({'$project': projection})
+            sizes = [len(data) for _, data in encode(self.corpus_db.aggregate(pipeline), indent)]
+            strata = None
+            if stratify:
+                groups = self.corpus_db.aggregate([{'$match': db_query}, {'$group': {'_id': '$' + stratify, 'count': {'$sum': 1}}}])
+                strata = {json.dumps(group['_id'], default=JSON_UTIL): group['count'] for group in groups}
+        except pymongo.errors.OperationFailure as e:
+            print(e.code)
+            print(e.details)
+            return {'result': 'fail', 'errors': ['<p>Unknown Error: The database query could not be executed.</p>']}
+        average = sum(sizes) / len(sizes) if sizes else 0
+        preview = {'result': 'success', 'count': count, 'estimated_bytes': int(average * count),
+                   'average_document_bytes': int(average), 'sampled': len(sizes), 'collection': None, 'plan': None,
+                   'errors': []}
+        if strata is not None:
+            preview['strata'] = strata
+        # Collection statistics and query plans are optional: they may be refused to users without the
+        # privileges to read them, or not be implemented by the database, so any failure just leaves them out
+        try:
+            stats = next(self.corpus_db.aggregate([{'$collStats': {'storageStats': {}}}]))['storageStats']
+            preview['collection'] = {'count': stats.get('count'), 'bytes': stats.get('size'),
+                                     'average_document_bytes': stats.get('avgObjSize')}
+        except Exception:
+            pass
+        try:
+            plan = self.corpus_db.find(db_query).explain()['queryPlanner']['winningPlan']
+            stages = []
+            while plan:
+                stages.append(plan['stage'] + (' ' + plan['indexName'] if 'indexName' in plan else ''))
+                plan = plan.get('inputStage')
+            preview['plan'] = stages
+        except Exception:
+            pass
+        return preview
+
     def print_manifest(self):
         """Print the manifest."""
         print(json.dumps(self.reduced_manifest, indent=2, sort_keys=False, default=JSON_UTIL))
 
-    def save(self, path=None):
+    @instrumented('refresh_data')
+    def refresh_data(self, project_dir, db_query=None, projection=None, batch_size=None):
+        """Bring the cached corpus of a project in the Workspace up to date with its query.
+
+        Cached documents are matched to the query results by `_id` and compared by
+        `config.CORPUS_MODIFIED_FIELD`, or by a hash of their contents if the corpus
+        has no modification field. Only added and changed documents are written,
+        and removed documents are deleted. Files are replaced rather than rewritten,
+        since they may be hard linked from the query cache.
+
+        An index of the cached documents is kept in `caches/sync.json` and the sync
+        point is recorded in the project's `datapackage.json`. Projects using the
+        'jsonl' layout are rewritten in full, since their shards cannot be updated
+        in place. A project launched with a sample holds the full corpus afterwards.
+        """
+        datapackage_file = os.path.join(project_dir, 'datapackage.json')
+        try:
+            with open(datapackage_file, 'r') as f:
+                datapackage = json_util.loads(f.read())
+        except (IOError, ValueError):
+            return {'result': 'fail', 'errors': ['<p>Error: Could not read the datapackage in the project directory.</p>']}
+        if db_query is None:
+            db_query = datapackage.get('db_query', self.reduced_manifest.get('db_query'))
+        if db_query is None:
+            return {'result': 'fail', 'errors': ['<p>Please enter a database query in the Data Resources tab.</p>']}
+        if batch_size is None:
+            batch_size = config.CORPUS_BATCH_SIZE
+        if projection is None:
+            projection = datapackage.get('db_projection', config.CORPUS_PROJECTION)
+        if projection and any(v for k, v in projection.items() if k != '_id'):
+            projection = dict(projection, name=True)
+        modified_field = config.CORPUS_MODIFIED_FIELD
+        stats = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+        start = datetime.now()
+        if os.path.exists(os.path.join(project_dir, 'caches/jsonl')):
+            # Remove the shards rather than truncating them, since they may be hard linked
+            rmtree(os.path.join(project_dir, 'caches/jsonl'))
+            result = self.write_corpus(project_dir, db_query, batch_size, projection, use_cache=False, layout='jsonl')
+            if result['result'] == 'fail':
+                return result
+            stats['added'] = result['count']
+            count = result['count']
+        else:
+            documents = load_sync_index(project_dir, modified_field)
+            current = {}
+            writer = CorpusWriter(project_dir, indent=config.CORPUS_INDENT, workers=config.CORPUS_WORKERS,
+                                  executor=config.CORPUS_EXECUTOR, replace=True)
+
+            def compare(key, entry):
+                """Record a document as current and return True if it needs to be written."""
+                current[key] = entry
+                if key not in documents:
+                    stats['added'] += 1
+                elif documents[key] != entry:
+                    stats['changed'] += 1
+                else:
+                    stats['unchanged'] += 1
+                    return False
+                return True
+
+            def stale_by_field():
+                """Compare the modification fields, then fetch only the documents which changed."""
+                fields = {'name': True, modified_field: True}
+                stale = [item['_id'] for item in self.corpus_db.find(db_query, fields, batch_size=batch_size)
+                         if compare(str(item['_id']), [item['name'], signature(item, None, modified_field)])]
+                for i in range(0, len(stale), batch_size):
+                    yield from self.corpus_db.find({'_id': {'$in': stale[i:i + batch_size]}}, projection or None)
+
+            def stale_by_hash():
+                """Hash every document in the query and yield those which changed."""
+                for item in self.corpus_db.find(db_query, projection or None, batch_size=batch_size):
+                    data = encode([item], config.CORPUS_INDENT)[0][1]
+                    if compare(str(item['_id']), [item['name'], signature(item, data)]):
+                        yield item
+
+            try:
+                writer.write(stale_by_field() if modified_field else stale_by_hash())
+                # Delete the files of removed documents and of documents which have been renamed
+                names = {entry[0] for entry in current.values()}
+                for key, entry in documents.items():
+                    if key not in current:
+                        stats['removed'] += 1
+                    if entry[0] not in names:
+                        path = os.path.join(project_dir, 'caches/json', entry[0] + '.json')
+                        if os.path.exists(path):
+                            os.remove(path)
+                save_sync_index(project_dir, current, modified_field)
+            except pymongo.errors.OperationFailure as e:
+                print(e.code)
+                print(e.details)
+                return {'result': 'fail', 'stats': stats,
+                        'errors': ['<p>Unknown Error: The database query could not be executed.</p>']}
+            except IOError:
+                return {'result': 'fail', 'stats': stats,
+                        'errors': ['<p>Error: Could not write data files to the caches directory.</p>']}
+            count = len(current)
+        stats['seconds'] = round((datetime.now() - start).total_seconds(), 3)
+        # Record the sync point so that the project shows when its data was last refreshed
+        datapackage['corpus_sync'] = {
+            'synced': start.strftime('%Y%m%d%H%M%S'),
+            'count': count,
+            'modified_field': modified_field
+        }
+        datapackage.pop('corpus_sample', None)
+        try:
+            data = json.dumps(datapackage, indent=2, sort_keys=False, default=JSON_UTIL)
+            write_replace(datapackage_file, data.encode('utf-8'))
+        except IOError:
+            return {'result': 'fail', 'stats': stats,
+                    'errors': ['<p>Error: Could not write the datapackage to the project directory.</p>']}
+        self.stats['refresh_data'] = stats
+        return {'result': 'success', 'count': count, 'stats': stats, 'errors': []}
+
+    def reload(self, payloads=False):
+        """Reload the manifest from the database.
+
+        Version payloads (zip archives stored by older versions) are not
+        fetched unless payloads is True. Otherwise, the versions hold handles
+        which fetch them when they are read.
+        """
+        projection = None if payloads else VERSION_PAYLOAD_PROJECTION
+        record = self.projects_db.find_one({'_id': ObjectId(self._id)}, projection=projection)
+        if record is None:
+            return {'result': 'fail', 'errors': ['<p>The project could not be found in the database.</p>']}
+        self.manifest = record
+        self.reduced_manifest = self.clean(record)
+        self.versions = VersionIndex(self.reduced_manifest.get('content'))
+        if 'content' in self.reduced_manifest:
+            self.reduced_manifest['content'] = self.versions.versions
+        if not payloads:
+            self.versions.attach_payloads(self.projects_db, record['_id'])
+        return {'result': 'success', 'errors': []}
+
+    def remove_version(self, number):
+        """Remove a version from the project record with a server-side $pull.
+
+        Older records may store the version number as a string, so both forms are matched.
+        """
+        try:
+            candidates = self.version_blobs([self.versions.get(number) or {}])
+            result = self.projects_db.update_one({'_id': ObjectId(self._id)},
+                                            {'$pull': {'content': {'version_number': {'$in': [int(number), str(int(number))]}}}},
+                                            upsert=False)
+            if result.modified_count == 0:
+                return {'result': 'fail', 'errors': ['<p>The version could not be found in the database.</p>']}
+            self.versions.remove(number)
+            self.collect_blobs(candidates)
+            return {'result': 'success', 'errors': []}
+        except pymongo.errors.OperationFailure as e:
+            print(e.code)
+            print(e.details)
+            return {'result': 'fail', 'errors': ['<p>Unknown error: Could not delete the project from the database.</p>']}
+
+    def version_blobs(self, version_dicts):
+        """Get the digests of the manifests of some versions and of the files they list."""
+        digests = set()
+        for version_dict in version_dicts:
+            digest = version_dict.get('manifest')
+            if digest is None:
+                continue
+            digests.add(digest)
+            try:
+                digests.update(record['sha256'] for record in load_manifest(self.blobs, digest))
+            except Exception:
+                continue
+        return digests
+
+    def collect_blobs(self, candidates):
+        """Remove the blobs in candidates that no stored version refers to any longer.
+
+        Does nothing unless `config.BLOB_GC_ON_DELETE` is set. Returns the number
+        of blobs and bytes removed.
+        """
+        if not config.BLOB_GC_ON_DELETE or not candidates:
+            return {'removed': 0, 'bytes': 0}
+        return collect_garbage(self.blobs, self.projects_db, candidates, config.BLOB_GC_GRACE)
+
+    def manifest_referenced(self, digest):
+        """Check whether a stored version still refers to a manifest."""
+        if digest is None:
+            return False
+        return self.projects_db.count_documents({'content.manifest': digest}, limit=1) > 0
+
+    def rename_version(self, number, version_name):
+        """Rename a version in the project record with a positional update."""
+        try:
+            result = self.projects_db.update_one({'_id': ObjectId(self._id), 'content.version_number': int(number)},
+                                            {'$set': {'content.$.version_name': version_name}})
+            if result.matched_count == 0:
+                return {'result': 'fail', 'errors': ['<p>The version could not be found in the database.</p>']}
+            version_dict = (self.versions.get(number) or {'version_number': int(number)}).copy()
+            version_dict['version_name'] = version_name
+            self.set_version(version_dict)
+            return {'result': 'success', 'errors': []}
+        except pymongo.errors.OperationFailure as e:
+            print(e.code)
+            print(e.details)
+            return {'result': 'fail', 'errors': ['<p>Unknown error: Could not rename the version in the database.</p>']}
+
+    @instrumented('restore')
+    def restore(self, version_dict, project_dir, lazy=False):
+        """Write a stored version to a project folder.
+
+        Versions with a manifest are rebuilt from the blob store. Older versions
+        which carry a zip archive are unzipped. If lazy is True, only the files
+        outside `caches/` are written before returning with the state 'ready',
+        so that the notebooks can be opened at once. The cached data files are
+        then written by a background thread, and `fetch_file()` writes any that
+        are needed sooner. Otherwise, the state returned is 'complete'.
+
+        The number of files written is checkpointed in the folder's journal, so
+        a restore into a folder left unfinished by an earlier restore of the
+        same version continues from the last checkpoint. The journal is only
+        completed once the background thread has written the deferred files.
+        A folder whose background restore is still running is left to it.
+        """
+        errors = ['<p>Unknown error: Could not unzip the project datapackage to the project directory.</p>']
+        if self.restore_running(project_dir):
+            return {'result': 'success', 'output_path': project_dir, 'state': 'ready', 'errors': []}
+        if 'manifest' in version_dict:
+            try:
+                journal, _ = open_journal(project_dir, 'restore', self._restore_key(version_dict))
+                manifest = load_manifest(self.blobs, version_dict['manifest'])
+                deferred = [record for record in manifest if record['path'].startswith(DEFERRED_DIR)] if lazy else []
+                records = [record for record in manifest if not record['path'].startswith(DEFERRED_DIR)] if deferred else manifest
+                if journal.is_done('files'):
+                    # An earlier run stopped whilst writing the deferred files. These are written
+                    # atomically, so only the missing ones are left to write.
+                    missing = [record for record in manifest if record['path'].startswith(DEFERRED_DIR)
+                               and not os.path.exists(os.path.join(project_dir, record['path']))]
+                    records, deferred = ([], missing) if lazy else (missing, [])
+                # The files before the checkpoint were written by the earlier run
+                done = journal.get('files', 0)
+                report = self.progress.reporter('restore')
+
+                def progress(counts):
+                    journal.checkpoint('files', done + counts['restored'])
+                    report({'restored': done + counts['restored'], 'files': len(records)})
+
+                restore_manifest(self.blobs, records[done:], project_dir, progress=progress)
+                journal.done('files')
+                if deferred:
+                    # From here on the pending marker records the progress of the background thread
+                    self._restore_in_background(project_dir, version_dict['manifest'], manifest, deferred, journal)
+                    return {'result': 'success', 'output_path': project_dir, 'state': 'ready', 'pending': len(deferred), 'errors': []}
+                save_local_manifest(project_dir, version_dict['manifest'], stat_manifest(project_dir, manifest))
+                journal.complete()
+                return {'result': 'success', 'output_path': project_dir, 'state': 'complete', 'errors': []}
+            except Exception:
+                return {'result': 'fail', 'errors': ['<p>Unknown error: Could not restore the project files to the project directory.</p>']}
+        if archive_field(version_dict) is not None:
+            try:
+                journal, _ = open_journal(project_dir, 'restore', self._restore_key(version_dict))
+                result = self.unzip(version_dict[archive_field(version_dict)], project_dir, binary=True, lazy=lazy,
+                                    journal=journal)
+                if result['result'] == 'success' and result['state'] == 'complete':
+                    journal.complete()
+                return result
+            except Exception:
+                return {'result': 'fail', 'errors': errors}
+        return {'result': 'fail', 'errors': errors}
+
+    def _restore_key(self, version_dict):
+        """Get the journal key of a project folder restored from a stored version."""
+        if 'manifest' in version_dict:
+            return version_dict['manifest']
+        if archive_field(version_dict) is not None:
+            return hashlib.sha256(version_dict[archive_field(version_dict)]).hexdigest()
+        return None
+
+    def _restore_in_background(self, project_dir, digest, manifest, deferred, journal):
+        """Start a thread which writes the deferred files of a lazy restore.
+
+        A pending marker in the project folder records the manifest digest until
+        every file has been written, so `fetch_file()` and `restore_state()` work
+        from any process. The restore's journal is completed by the thread.
+        """
+        with open(os.path.join(project_dir, PENDING_FILE), 'w') as f:
+            f.write(json.dumps({'manifest': digest}))
+        self._pending[project_dir] = manifest
+
+        def run():
+            try:
+                restore_manifest(self.blobs, deferred, project_dir, atomic=True)
+                save_local_manifest(project_dir, digest, stat_manifest(project_dir, manifest))
+                journal.complete()
+                os.remove(os.path.join(project_dir, PENDING_FILE))
+            except Exception as e:
+                with open(os.path.join(project_dir, PENDING_FILE), 'w') as f:
+                    f.write(json.dumps({'manifest': digest, 'error': '{}: {}'.format(type(e).__name__, e)}))
+            finally:
+                self._pending.pop(project_dir, None)
+
+        self._start_restore_thread(project_dir, run, journal)
+
+    def _start_restore_thread(self, project_dir, target, journal):
+        """Run the background stage of a lazy restore, recording the process running it in the journal."""
+        journal.data['pid'] = os.getpid()
+        journal.save()
+        thread = threading.Thread(target=target, name=RESTORE_THREAD + os.path.abspath(project_dir), daemon=True)
+        self._restores[project_dir] = thread
+        thread.start()
+
+    def restore_running(self, project_dir):
+        """Check whether a background restore in this or another process is still writing a project folder."""
+        journal = Journal(os.path.join(project_dir, JOURNAL_FILE))
+        if journal.data is None or journal.is_complete or 'pid' not in journal.data:
+            return False
+        if journal.data['pid'] != os.getpid():
+            return pid_alive(journal.data['pid'])
+        name = RESTORE_THREAD + os.path.abspath(project_dir)
+        return any(thread.name == name and thread.is_alive() for thread in threading.enumerate())
+
+    def restore_state(self, project_dir):
+        """Get the state of a project folder.
+
+        Returns 'complete', 'ready' (the notebooks can be used whilst the data
+        files are still being written), 'failed' or 'missing'.
+        """
+        pending_file = os.path.join(project_dir, PENDING_FILE)
+        if os.path.exists(pending_file):
+            try:
+                with open(pending_file, 'r') as f:
+                    if 'error' in json.loads(f.read()):
+                        return 'failed'
+            except (IOError, ValueError):
+                pass
+            return 'ready'
+        if os.path.exists(project_dir):
+            return 'complete'
+        return 'missing'
+
+    def fetch_file(self, project_dir, path):
+        """Get the full path to a file in a project folder, restoring it first if it is still pending.
+
+        Returns None if the file is not part of the project.
+        """
+        fn = os.path.join(project_dir, path)
+        if os.path.exists(fn):
+            return fn
+        manifest = self._pending.get(project_dir)
+        if manifest is None:
+            try:
+                with open(os.path.join(project_dir, PENDING_FILE), 'r') as f:
+                    manifest = load_manifest(self.blobs, json.loads(f.read())['manifest'])
+                self._pending[project_dir] = manifest
+            except (IOError, ValueError):
+                return None
+        for record in manifest:
+            if record['path'] == path:
+                return restore_file(self.blobs, record, project_dir, atomic=True)
+        return None
+
+    def wait_for_restore(self, project_dir, timeout=None):
+        """Wait for a background restore started by this object to finish and return the state."""
+        thread = self._restores.get(project_dir)
+        if thread is not None:
+            thread.join(timeout)
+            if not thread.is_alive():
+                del self._restores[project_dir]
+        return self.restore_state(project_dir)
+
+    @instrumented('save')
+    def save(self, path=None, background=False):
         """Handle save requests from the WMS or workspace.
 
-        Default behaviour: Insert a new record.
+        Default behaviour: Insert a new record. If background is True, storing the
+        project folder at `path` as a version is added to the job queue and a `Job`
+        is returned whose `result()` is the JSON result of the save. The project
+        must already be in the database.
         """
+        if background:
+            return self.submit_job('snapshot', path=path)
         # Determine if the project exists in the database
         if self.exists() and self._id is not None:
             action = 'update'
         else:
             action = 'insert'
-        # If a path is supplied, zip it and create a manifest version
+        # If a path is supplied, store its changed files
+        changes = {'status': 'unchanged'}
         if path is not None:
-            self.reduced_manifest['content'] = self.create_version_dict(path)
+            version_dict, changes = self.detect_changes(path)
+            if changes['status'] == 'incomplete':
+                return {'result': 'fail', 'errors': changes['errors']}
+            if changes['status'] != 'unchanged' and action == 'insert':
+                self.set_version(version_dict)
         # Execute the database query and return the result
-        return self.save_record(action)
+        self.progress.report('save')
+        result = self.save_record(action)
+        # Record the version with a single server-side update
+        if result['result'] == 'success' and action == 'update' and changes['status'] != 'unchanged':
+            result = self.add_version(version_dict, replace=changes['status'] == 'changed')
+            result['_id'] = self._id
+        result.update(changes)
+        return result
 
+    @instrumented('save_record')
     def save_record(self, action='insert'):
         """Insert or update a record in the database.
-        
-        This is a helper function to reduce code repetition.
+
+        This is a helper function to reduce code repetition. Updates only set
+        the project's own fields; versions are changed with `add_version()`,
+        `remove_version()` and `rename_version()`, so the version list is never
+        sent back to the database.
         """
         try:
             if action == 'update':
-                result = projects_db.find_one_and_update({'_id': ObjectId(self._id)},
-                                                {'$set': self.reduced_manifest}, upsert=False,
-                                                projection={'_id': True}, return_document=ReturnDocument.AFTER)
+                fields = {k: v for k, v in self.reduced_manifest.items() if k not in ['_id', 'content']}
+                result = self.projects_db.find_one_and_update({'_id': ObjectId(self._id)},
+                                                {'$set': fields}, upsert=False,
+                                                projection={'_id': True}, return_document=pymongo.ReturnDocument.AFTER)
                 _id = result['_id']
             else:
-                result = projects_db.insert_one(self.reduced_manifest)
+                result = self.projects_db.insert_one(record_document(self.reduced_manifest))
                 _id = result.inserted_id
+                self.reduced_manifest['_id'] = _id
+                self._id = _id
             return {'result': 'success', '_id': _id, 'errors': []}
         except pymongo.errors.OperationFailure as e:
             print(e.code)
@@ -533,21 +1380,23 @@ class Project():
             return {'result': 'fail', 'errors': ['No name has been supplied for the new project.']}
         else:
             # new_name = datetime.today().strftime('%Y%m%d%H%M%S_') + new_name 
-            # If a path is supplied, zip the folder and create a version 1
+            # If a path is supplied, clone the folder and create a version 1
             if path is not None:
-            # Create a new project folder
+                # Create a new project folder. Only the files that will be modified
+                # are copied; the cached data is reflinked or hard linked.
                 try:
                     path_parts = path.split('/')
                     path_parts[-1] = datetime.today().strftime('%Y%m%d%H%M%S_') + new_name
                     new_path = '/'.join(path_parts)
-                    copytree(path, new_path)
+                    self.wait_for_restore(path)
+                    self.stats['clone'] = clone_tree(path, new_path, hardlinks=config.CLONE_HARDLINKS)
                 except OSError:
                     return {'result': 'fail', 'errors': ['A project folder with that name already exists. Please try another name.']}
-                # Clear Outputs on a glob of all ipynb files
+                # Clear Outputs on a glob of all ipynb files in the new folder
                 try:
-                    for filename in glob.iglob(path + '/**', recursive=True):
-                        if filename.endswith('.ipynb'):
-                            self.clean_nb(filename, clean_empty_cells=True, save=True)
+                    result = self.clean_notebooks(new_path, clean_empty_cells=True)
+                    if result['result'] == 'fail':
+                        raise OSError(result['errors'])
                 except OSError:
                     # Delete the new directory and fail since we have no way to provide this as a warning.
                     rmtree(new_path)
@@ -560,7 +1409,9 @@ class Project():
                 # they should be reset here.
                 # Change the manifest version dict
                 # Not sure if this call works; it might have to call 0
-                self.reduced_manifest['content'] = self.create_version_dict(path, 1)
+                self.versions = VersionIndex()
+                self.reduced_manifest['content'] = self.versions.versions
+                self.set_version(self.create_version_dict(new_path, 1))
                 # Now insert the record in the database
                 return self.save_record('insert')
             # We just need to insert a new database record with the new name
@@ -574,27 +1425,222 @@ class Project():
                     del self.reduced_manifest['_id']
                 return self.save_record('insert')
 
-    def unzip(self, source=None, output_path=None, binary=False):
+    def submit_job(self, kind, **options):
+        """Add an 'export' or 'snapshot' job for this project to the job queue and return its `Job`.
+
+        The job reloads the project from the database, so it must have been saved.
+        """
+        if self._id is None:
+            raise ValueError('A project must be saved before it can be queued.')
+        options.update({
+            'templates_dir': self.templates_dir,
+            'workspace_dir': self.workspace_dir,
+            'temp_dir': self.temp_dir
+        })
+        return get_queue().submit(kind, str(self._id), options)
+
+    def set_version(self, version_dict):
+        """Add a version dict to the manifest, replacing any version with the same number."""
+        self.versions.add(version_dict)
+        self.reduced_manifest['content'] = self.versions.versions
+
+    @instrumented('unzip')
+    def unzip(self, source=None, output_path=None, binary=False, lazy=False, journal=None):
         """Unzip the specified file to a project folder in the Workspace.
 
-        Uses the current path if one is not specified.
+        Uses the current path if one is not specified. If lazy is True and a
+        restore's journal is given, the members in `caches/` are extracted by a
+        background thread after the rest of the archive, and the state 'ready'
+        is returned straight away. The thread completes the journal.
         """
-        if binary == True:
-            # Copy the zip archive to memory; then unzip it to the output path
-            temp_zipfile = zipfile.ZipFile(BytesIO(source))
-            temp_zipfile.extractall(output_path)
-            return {'result': 'success', 'output_path': output_path, 'errors': []}
-        # Otherwise, the source is a filepath
-        else:
-            try:
-                with zipfile.ZipFile(source, 'r') as zip_ref:
-                    zip_ref.extractall(output_path)                
-                return {'result': 'success', 'output_path': output_path, 'errors': []}
-            except:
-                return {'result': 'fail', 'errors': ['<p>Could not unzip the file at ' + source + '.</p>']}
+        try:
+            # A binary archive is read in place through a seekable view rather than copied
+            zip_ref = zipfile.ZipFile(BytesIO(source) if binary == True else source, 'r')
+            members = zip_ref.namelist()
+            deferred = [name for name in members if name.startswith(DEFERRED_DIR)] if lazy and journal is not None else []
+            if deferred:
+                zip_ref.extractall(output_path, [name for name in members if not name.startswith(DEFERRED_DIR)])
+
+                def run():
+                    with zip_ref:
+                        zip_ref.extractall(output_path, deferred)
+                    journal.complete()
+
+                self._start_restore_thread(output_path, run, journal)
+                return {'result': 'success', 'output_path': output_path, 'state': 'ready', 'pending': len(deferred), 'errors': []}
+            with zip_ref:
+                zip_ref.extractall(output_path)
+            return {'result': 'success', 'output_path': output_path, 'state': 'complete', 'errors': []}
+        except:
+            if binary == True:
+                return {'result': 'fail', 'errors': ['<p>Could not unzip the project datapackage.</p>']}
+            return {'result': 'fail', 'errors': ['<p>Could not unzip the file at ' + source + '.</p>']}
+
+    def upgrade_sample(self, project_dir):
+        """Replace the sample in a project launched with `launch(sample=...)` by the full corpus.
+
+        The documents outside the sample are written into the same project folder
+        by `refresh_data()`, so the notebooks and their outputs are kept.
+        """
+        try:
+            with open(os.path.join(project_dir, 'datapackage.json'), 'r') as f:
+                datapackage = json_util.loads(f.read())
+        except (IOError, ValueError):
+            return {'result': 'fail', 'errors': ['<p>Error: Could not read the datapackage in the project directory.</p>']}
+        if 'corpus_sample' not in datapackage:
+            return {'result': 'fail', 'errors': ['<p>The project already has the full corpus.</p>']}
+        result = self.refresh_data(project_dir)
+        if result['result'] == 'success':
+            result['sample'] = datapackage['corpus_sample']
+        return result
 
+    @instrumented('write_corpus')
+    def write_corpus(self, project_dir, db_query, batch_size=None, projection=None, use_cache=None, journal=None, **kwargs):
+        """Stream the documents matching a query to the project's caches folder.
 
-    def zip(self, filename, source_dir, destination_dir):
+        The cursor is read in batches of `batch_size` documents and each document
+        is handed to a `CorpusWriter` as soon as it arrives, so memory use does not
+        grow with the size of the corpus. If no projection is supplied, the manifest's
+        `db_projection` or `config.CORPUS_PROJECTION` is used to skip fields the
+        workflow does not need. Keyword arguments override the `CorpusWriter` options
+        in `config`.
+
+        If the query cache is enabled, results are written once to the shared
+        `QueryCache` and cloned into the project. Later launches with the same query
+        are served from the cache until the corpus changes, without querying the
+        documents again. The cache is only used by default if
+        `config.CORPUS_MODIFIED_FIELD` is set, since otherwise documents edited in
+        place go unnoticed. Returns a dict with the number of documents written and
+        the writer's throughput stats.
+
+        If the project folder's `Journal` is given, documents are written in `_id`
+        order and the last `_id` written is checkpointed, so that a launch which
+        stopped partway only writes the documents after it. JSON Lines shards
+        cannot be appended to, so they are always written from the start. A
+        launch which stopped before its first checkpoint starts again from an
+        empty caches folder.
+        """
+        if batch_size is None:
+            batch_size = config.CORPUS_BATCH_SIZE
+        if projection is None:
+            projection = self.reduced_manifest.get('db_projection', config.CORPUS_PROJECTION)
+        if use_cache is None:
+            use_cache = config.QUERY_CACHE_DIR is not None and config.CORPUS_MODIFIED_FIELD is not None
+        # Filenames are taken from the document name, so it must always be returned
+        if projection and any(v for k, v in projection.items() if k != '_id'):
+            projection = dict(projection, name=True)
+        options = {
+            'indent': config.CORPUS_INDENT,
+            'layout': config.CORPUS_LAYOUT,
+            'shard_size': config.CORPUS_SHARD_SIZE,
+            'compression': config.CORPUS_COMPRESSION,
+            'block_size': config.CORPUS_BLOCK_SIZE,
+            'workers': config.CORPUS_WORKERS,
+            'executor': config.CORPUS_EXECUTOR
+        }
+        options.update(kwargs)
+        # Documents written by an earlier run are skipped, and are not in the cache
+        resumed = 0
+        if journal is not None and options['layout'] == 'files' and journal.get('corpus') is not None:
+            resume_from = journal.get('corpus')
+            resumed = resume_from['count']
+            db_query = {'$and': [db_query, {'_id': {'$gt': resume_from['last_id']}}]}
+            use_cache = False
+        elif journal is not None and journal.data.get('resumed'):
+            # The earlier run stopped before its first checkpoint, e.g. whilst cloning from the query cache,
+            # so the files it left are removed rather than written over
+            for folder in ['caches/json', 'caches/jsonl']:
+                rmtree(os.path.join(project_dir, folder), ignore_errors=True)
+        cache = None
+        writer = None
+        target_dir = project_dir
+        try:
+            if use_cache:
+                cache = QueryCache(config.QUERY_CACHE_DIR, config.QUERY_CACHE_MAX_BYTES)
+                # The cached files depend on how the documents were serialised as well as on the query
+                layout = {k: options[k] for k in ['indent', 'layout', 'shard_size', 'compression', 'block_size']}
+                key = query_key(db_query, projection, layout)
+                marker = corpus_marker(self.corpus_db, db_query, config.CORPUS_MODIFIED_FIELD)
+                entry = cache.get(key, marker)
+                if entry is not None:
+                    self.progress.report('clone', entry)
+                    stats = {'count': entry['count'], 'bytes': entry['bytes'], 'cache': 'hit'}
+                    self.instrument.count('cache_hits')
+                    self.instrument.count('documents', entry['count'])
+                    stats.update(cache.serve(key, project_dir, config.CLONE_HARDLINKS))
+                    self.stats['write_corpus'] = stats
+                    return {'result': 'success', 'count': stats['count'], 'stats': stats, 'errors': []}
+                target_dir = cache.staging()
+            save_checkpoint = None
+            if journal is not None and options['layout'] == 'files' and target_dir == project_dir:
+                save_checkpoint = lambda last_id, stats: journal.checkpoint(
+                    'corpus', {'last_id': last_id, 'count': resumed + stats['count']})
+            writer = CorpusWriter(target_dir, progress=self.progress.reporter('serialize'), checkpoint=save_checkpoint,
+                                  **options)
+            self.progress.report('query')
+            # Checkpoints are only valid if the documents are written in _id order
+            sort = [('_id', 1)] if journal is not None else None
+            cursor = self.corpus_db.find(db_query, projection or None, batch_size=batch_size, sort=sort)
+            stats = writer.write(cursor)
+            # The stages overlap, so their times show which one held up the others
+            self.instrument.add_stage('query', stats['read_seconds'])
+            self.instrument.add_stage('encode_wait', stats['encode_wait_seconds'])
+            self.instrument.add_stage('write_files', stats['write_seconds'])
+            self.instrument.count('documents', stats['count'])
+            self.instrument.count('corpus_bytes', stats['bytes'])
+            if cache is not None:
+                cache.put(key, target_dir, marker, stats['count'])
+                stats['cache'] = 'miss'
+                stats.update(cache.serve(key, project_dir, config.CLONE_HARDLINKS))
+                cache.evict()
+        except pymongo.errors.OperationFailure as e:
+            print(e.code)
+            print(e.details)
+            stats = writer.stats if writer is not None else {'count': 0}
+            return {'result': 'fail', 'count': stats['count'], 'stats': stats,
+                    'errors': ['<p>Unknown Error: The database query could not be executed.</p>']}
+        except IOError:
+            stats = writer.stats if writer is not None else {'count': 0}
+            return {'result': 'fail', 'count': stats['count'], 'stats': stats,
+                    'errors': ['<p>Error: Could not write data files to the caches directory.</p>']}
+        finally:
+            # A staging folder is moved into the cache once it is complete, so anything left is partial,
+            # including after a cancellation
+            if target_dir != project_dir:
+                rmtree(target_dir, ignore_errors=True)
+        if resumed:
+            stats['resumed'] = resumed
+        self.stats['write_corpus'] = stats
+        return {'result': 'success', 'count': resumed + stats['count'], 'stats': stats, 'errors': []}
+
+    @instrumented('zip')
+    def stream_zip(self, fileobj, source_dir=None, version_dict=None, compresslevel=None, workers=None, entries=None):
+        """Write a zip archive of a project folder or a stored version to a binary stream.
+
+        The destination can be a file, a database upload stream or a socket; it does
+        not need to be seekable and nothing is written to a temporary file. Members
+        in already-compressed formats are stored as they are, and the others are
+        compressed across `workers` threads at the given `compresslevel`. An
+        iterable of `ArchiveEntry` objects can be given instead of a folder or
+        version. Returns the archive stats.
+        """
+        if compresslevel is None:
+            compresslevel = config.ZIP_COMPRESSLEVEL
+        if workers is None:
+            workers = config.ZIP_WORKERS
+        if entries is None and version_dict is not None:
+            manifest = load_manifest(self.blobs, version_dict['manifest'])
+            date_time = datetime.strptime(version_dict['version_date'], '%Y%m%d%H%M%S').timetuple()[:6]
+            entries = entries_from_manifest(self.blobs, manifest, date_time)
+        elif entries is None:
+            entries = entries_from_dir(source_dir, exclude=[MANIFEST_FILE, PENDING_FILE, JOURNAL_FILE])
+        stats = write_archive(fileobj, entries, compresslevel, workers, progress=self.progress.reporter('zip'))
+        self.instrument.count('zip_members', stats['members'])
+        self.instrument.count('zip_bytes_out', stats['bytes_out'])
+        self.stats['zip'] = stats
+        return stats
+
+    def zip(self, filename, source_dir, destination_dir, compresslevel=None, workers=None):
         """Create a zip archive of the project folder and writes it to the destination folder."""
         errors = []
         try:
@@ -605,16 +1651,20 @@ class Project():
             return {'result': 'fail', 'errors': errors}
         try:
             zip_path = os.path.join(destination_dir, filename)
-            zipobj = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED)
-            rootlen = len(source_dir) + 1
-            for base, _, files in os.walk(source_dir):
-                for file in files:
-                    fn = os.path.join(base, file)
-                    zipobj.write(fn, fn[rootlen:])
-            return {'result': 'success', 'zip_path': zip_path, 'errors': []}
-        except:
+            with open(zip_path, 'wb') as f:
+                stats = self.stream_zip(f, source_dir, compresslevel=compresslevel, workers=workers)
+            return {'result': 'success', 'zip_path': zip_path, 'stats': stats, 'errors': []}
+        except Exception:
             errors.append('<p>Unknown error: a zip archive could not be created with the supplied source directory and filename.</p>')
             return {'result': 'fail', 'errors': errors}
 
-# Send feedback to the notebook cell
-print('Project module loaded.')
+
+def __getattr__(name):
+    """Provide the module-level client and collections of earlier versions on first use."""
+    if name == 'client':
+        return get_client()
+    if name == 'db':
+        return get_database()
+    if name in ['projects_db', 'corpus_db']:
+        return get_database()[name[:-3].capitalize()]
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
@@ -0,0 +1,390 @@
+"""archive.py."""
+
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+CHUNK_SIZE = 1024 * 1024
+# Members larger than this are compressed in a single pass on the calling thread
+PARALLEL_LIMIT = 16 * 1024 * 1024
+ZIP64_LIMIT = 0xFFFFFFFF
+# Streamed archives are yielded in chunks of about this size
+STREAM_CHUNK_SIZE = 64 * 1024
+# Formats which are already compressed and are stored without recompressing them
+STORED_SUFFIXES = ('.zip', '.gz', '.bz2', '.xz', '.zst', '.7z', '.png', '.jpg', '.jpeg',
+                   '.gif', '.parquet', '.arrow', '.mp3', '.mp4', '.pdf', '.docx', '.xlsx')
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+
+class ArchiveEntry():
+    """A member to be added to an archive.
+
+    Parameters:
+    - arcname: the path of the member inside the archive
+    - opener: a callable returning a readable binary file object
+    - size: the uncompressed size in bytes
+    - date_time: a (year, month, day, hour, minute, second) tuple; defaults to now
+    """
+
+    __slots__ = ['arcname', 'opener', 'size', 'date_time']
+
+    def __init__(self, arcname, opener, size, date_time=None):
+        """Initialize the object."""
+        self.arcname = arcname
+        self.opener = opener
+        self.size = size
+        self.date_time = date_time or time.localtime()[:6]
+
+
+def entries_from_dir(source_dir, exclude=None):
+    """Yield an ArchiveEntry for every file in a folder, in a stable order."""
+    rootlen = len(source_dir) + 1
+    for base, dirs, files in os.walk(source_dir):
+        dirs.sort()
+        for file in sorted(files):
+            fn = os.path.join(base, file)
+            arcname = fn[rootlen:]
+            if exclude is not None and arcname in exclude:
+                continue
+            stat = os.stat(fn)
+            yield ArchiveEntry(arcname, lambda fn=fn: open(fn, 'rb'), stat.st_size, time.localtime(stat.st_mtime)[:6])
+
+
+def entries_from_manifest(store, manifest, date_time=None):
+    """Yield an ArchiveEntry for every file record in a blob store manifest."""
+    for record in manifest:
+        yield ArchiveEntry(record['path'], lambda digest=record['sha256']: store.open(digest), record['size'], date_time)
+
+
+def entry_from_bytes(arcname, data, date_time=None):
+    """Get an ArchiveEntry for a member held in memory."""
+    return ArchiveEntry(arcname, lambda: BytesIO(data), len(data), date_time)
+
+
+def _dos_date_time(date_time):
+    """Pack a date_time tuple into DOS date and time fields."""
+    year = max(date_time[0], 1980)
+    dos_date = (year - 1980) << 9 | date_time[1] << 5 | date_time[2]
+    dos_time = date_time[3] << 11 | date_time[4] << 5 | (date_time[5] // 2)
+    return dos_date, dos_time
+
+
+def _compress_member(entry, method, compresslevel):
+    """Read and compress a whole member, returning its (crc, size, data) tuple."""
+    crc = 0
+    size = 0
+    chunks = []
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15) if method == ZIP_DEFLATED else None
+    with entry.opener() as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            chunks.append(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+        chunks.append(compressor.flush())
+    return crc, size, b''.join(chunks)
+
+
+class ArchiveWriter():
+    """Write a zip archive to any writable binary stream.
+
+    Parameters:
+    - fileobj: the destination, e.g. an open file, a GridFS upload stream or a socket file
+    - compresslevel: the zlib compression level, from 0 to 9
+    - workers: the number of threads used to compress members in parallel
+    - stored_suffixes: file extensions which are stored without compression
+    - progress: an optional callable which receives the running stats dict after each member
+
+    The destination does not need to be seekable: every member's CRC and sizes
+    are known before its header is written, or are given in a data descriptor
+    for members too large to hold in memory. Zip64 records are added when needed.
+    """
+
+    def __init__(self, fileobj, compresslevel=6, workers=1, stored_suffixes=STORED_SUFFIXES, progress=None):
+        """Initialize the object."""
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.workers = workers or os.cpu_count() or 1
+        self.stored_suffixes = tuple(stored_suffixes)
+        self.offset = 0
+        self.central_directory = []
+        self.progress = progress
+        self.stats = {'members': 0, 'stored': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+    def method(self, entry):
+        """Get the compression method for a member."""
+        if self.compresslevel == 0 or entry.arcname.lower().endswith(self.stored_suffixes):
+            return ZIP_STORED
+        return ZIP_DEFLATED
+
+    def write_entries(self, entries):
+        """Compress and write an iterable of ArchiveEntry objects in order."""
+        if self.workers == 1:
+            for entry in entries:
+                self._write_entry(entry)
+            return
+        futures = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for entry in entries:
+                if entry.size > PARALLEL_LIMIT:
+                    # Write everything in flight first to preserve the member order
+                    while futures:
+                        self._write_compressed(*futures.popleft().result())
+                    self._write_entry(entry)
+                    continue
+                method = self.method(entry)
+                future = pool.submit(_compress_member, entry, method, self.compresslevel)
+                futures.append(_Pending(entry, method, future))
+                while len(futures) > self.workers * 2:
+                    self._write_compressed(*futures.popleft().result())
+            while futures:
+                self._write_compressed(*futures.popleft().result())
+
+    def _write_entry(self, entry):
+        """Write a single member, streaming it if it is too large to hold in memory."""
+        method = self.method(entry)
+        if entry.size <= PARALLEL_LIMIT:
+            crc, size, data = _compress_member(entry, method, self.compresslevel)
+            self._write_compressed(entry, method, crc, size, data)
+        else:
+            self._write_streamed(entry, method)
+
+    def _write_compressed(self, entry, method, crc, size, data):
+        """Write a member whose compressed data is already in memory."""
+        header_offset = self.offset
+        zip64 = size > ZIP64_LIMIT or len(data) > ZIP64_LIMIT
+        self._write_local_header(entry.arcname, entry.date_time, method, 0, crc, len(data), size, zip64)
+        self._write(data)
+        self._add_record(entry, method, 0, crc, len(data), size, header_offset)
+
+    def _write_streamed(self, entry, method):
+        """Write a member in chunks, followed by a data descriptor with its CRC and sizes."""
+        header_offset = self.offset
+        zip64 = entry.size > ZIP64_LIMIT * 0.95
+        self._write_local_header(entry.arcname, entry.date_time, method, 0x08, 0, 0, 0, zip64)
+        crc = 0
+        size = 0
+        compressed_size = 0
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15) if method == ZIP_DEFLATED else None
+        with entry.opener() as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                compressed_size += len(chunk)
+                self._write(chunk)
+        if compressor:
+            chunk = compressor.flush()
+            compressed_size += len(chunk)
+            self._write(chunk)
+        if zip64:
+            self._write(struct.pack('<LLQQ', 0x08074b50, crc, compressed_size, size))
+        else:
+            self._write(struct.pack('<LLLL', 0x08074b50, crc, compressed_size, size))
+        self._add_record(entry, method, 0x08, crc, compressed_size, size, header_offset)
+
+    def _write_local_header(self, arcname, date_time, method, flags, crc, compressed_size, size, zip64):
+        """Write the local file header of a member."""
+        name = arcname.encode('utf-8')
+        dos_date, dos_time = _dos_date_time(date_time)
+        extra = b''
+        sizes = (compressed_size, size)
+        if zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, sizes[1], sizes[0])
+            sizes = (ZIP64_LIMIT, ZIP64_LIMIT)
+        self._write(struct.pack('<LHHHHHLLLHH', 0x04034b50, 45 if zip64 else 20, flags | 0x800, method,
+                                dos_time, dos_date, crc, sizes[0], sizes[1], len(name), len(extra)))
+        self._write(name + extra)
+
+    def _add_record(self, entry, method, flags, crc, compressed_size, size, header_offset):
+        """Keep the central directory record for a member and update the stats."""
+        self.central_directory.append((entry.arcname, entry.date_time, method, flags, crc,
+                                       compressed_size, size, header_offset))
+        self.stats['members'] += 1
+        self.stats['bytes_in'] += size
+        if method == ZIP_STORED:
+            self.stats['stored'] += 1
+        if self.progress is not None:
+            self.progress(self.stats)
+
+    def _write(self, data):
+        """Write bytes to the destination and advance the offset."""
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def close(self):
+        """Write the central directory and return the stats.
+
+        The destination itself is not closed.
+        """
+        cd_offset = self.offset
+        for arcname, date_time, method, flags, crc, compressed_size, size, header_offset in self.central_directory:
+            name = arcname.encode('utf-8')
+            dos_date, dos_time = _dos_date_time(date_time)
+            zip64_fields = []
+            if size > ZIP64_LIMIT:
+                zip64_fields.append(size)
+                size = ZIP64_LIMIT
+            if compressed_size > ZIP64_LIMIT:
+                zip64_fields.append(compressed_size)
+                compressed_size = ZIP64_LIMIT
+            if header_offset > ZIP64_LIMIT:
+                zip64_fields.append(header_offset)
+                header_offset = ZIP64_LIMIT
+            extra = b''
+            if zip64_fields:
+                extra = struct.pack('<HH' + 'Q' * len(zip64_fields), 0x0001, 8 * len(zip64_fields), *zip64_fields)
+            version = 45 if zip64_fields else 20
+            self._write(struct.pack('<LHHHHHHLLLHHHHHLL', 0x02014b50, 3 << 8 | version, version, flags | 0x800,
+                                    method, dos_time, dos_date, crc, compressed_size, size, len(name),
+                                    len(extra), 0, 0, 0, 0o100644 << 16, header_offset))
+            self._write(name + extra)
+        cd_size = self.offset - cd_offset
+        count = len(self.central_directory)
+        if count > 0xFFFF or cd_size > ZIP64_LIMIT or cd_offset > ZIP64_LIMIT:
+            zip64_offset = self.offset
+            self._write(struct.pack('<LQHHLLQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset))
+            self._write(struct.pack('<LLQL', 0x07064b50, 0, zip64_offset, 1))
+        self._write(struct.pack('<LHHHHLLH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                min(cd_size, ZIP64_LIMIT), min(cd_offset, ZIP64_LIMIT), 0))
+        self.stats['bytes_out'] = self.offset
+        return self.stats
+
+
+class _Pending():
+    """A member being compressed by a worker thread."""
+
+    __slots__ = ['entry', 'method', 'future']
+
+    def __init__(self, entry, method, future):
+        """Initialize the object."""
+        self.entry = entry
+        self.method = method
+        self.future = future
+
+    def result(self):
+        """Wait for the compressed data and return the arguments for _write_compressed()."""
+        crc, size, data = self.future.result()
+        return self.entry, self.method, crc, size, data
+
+
+def write_archive(fileobj, entries, compresslevel=6, workers=1, stored_suffixes=STORED_SUFFIXES, progress=None):
+    """Write a zip archive of the entries to a binary stream and return the stats."""
+    writer = ArchiveWriter(fileobj, compresslevel, workers, stored_suffixes, progress)
+    writer.write_entries(entries)
+    return writer.close()
+
+
+class _RangeComplete(Exception):
+    """Raised inside the archive writer once the requested byte range has been sent."""
+
+
+class _StreamBuffer():
+    """A write-only file object which passes a byte range of what it is given to a queue.
+
+    Parameters:
+    - pending: the queue receiving chunks of bytes
+    - start: the offset of the first byte to pass on
+    - end: the offset of the last byte to pass on, or None for the end of the archive
+    - stopped: a threading.Event which is set when the reader goes away
+    """
+
+    def __init__(self, pending, start=0, end=None, stopped=None):
+        """Initialize the object."""
+        self.pending = pending
+        self.start = start
+        self.end = end
+        self.stopped = stopped or threading.Event()
+        self.position = 0
+        self.chunks = []
+        self.buffered = 0
+
+    def write(self, data):
+        """Buffer the part of the data inside the range, stopping the writer after the range."""
+        if self.stopped.is_set():
+            raise _RangeComplete()
+        begin = self.position
+        self.position += len(data)
+        if self.position <= self.start:
+            return
+        if begin < self.start:
+            data = data[self.start - begin:]
+            begin = self.start
+        if self.end is not None and self.position > self.end + 1:
+            data = data[:self.end + 1 - begin]
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= STREAM_CHUNK_SIZE:
+            self.flush()
+        if self.end is not None and self.position > self.end:
+            self.flush()
+            raise _RangeComplete()
+
+    def flush(self):
+        """Send the buffered bytes to the queue, waiting while it is full."""
+        if not self.chunks:
+            return
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.buffered = 0
+        while True:
+            if self.stopped.is_set():
+                raise _RangeComplete()
+            try:
+                self.pending.put(data, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+def iter_archive(entries, compresslevel=6, workers=1, stored_suffixes=STORED_SUFFIXES, start=0, end=None, queue_size=16):
+    """Yield the bytes of a zip archive of the entries as it is written.
+
+    Only the bytes from offset `start` to `end`, inclusive, are yielded, and
+    writing stops once `end` is reached. Since the same entries always produce
+    the same archive, a download can be resumed by requesting the rest of the
+    range. The archive is written by a background thread and nothing is held in
+    memory beyond `queue_size` chunks. If the caller stops reading, the thread
+    stops at its next write.
+    """
+    pending = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+    buffer = _StreamBuffer(pending, start, end, stopped)
+    errors = []
+
+    def run():
+        """Write the archive to the buffer, then send the sentinel."""
+        try:
+            write_archive(buffer, entries, compresslevel, workers, stored_suffixes)
+            buffer.flush()
+        except _RangeComplete:
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            while not stopped.is_set():
+                try:
+                    pending.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    writer = threading.Thread(target=run, daemon=True)
+    writer.start()
+    try:
+        for data in iter(pending.get, None):
+            yield data
+    finally:
+        stopped.set()
+        writer.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,81 @@
+"""asyncproject.py."""
+
+import asyncio
+import functools
+import threading
+
+from project.progress import Cancelled, Progress
+
+
+class AsyncProject():
+    """Run the lifecycle operations of a Project without blocking the event loop.
+
+    Parameters:
+    - project: the Project to operate on
+    - executor: an optional concurrent.futures executor; the loop's default executor is used if None
+    - progress: an optional callable which receives the stage name and a stats dict
+
+    Each operation runs the blocking Project method in the executor, so database
+    round trips, archive writes and file copies happen off the loop thread.
+    Progress events are delivered on the loop thread as the operation reaches
+    each stage: 'scan', 'upload', 'save', 'query', 'serialize', 'clone', 'zip',
+    'restore' and 'delete'.
+
+    Cancelling the awaiting task stops the operation at its next progress event
+    and raises asyncio.CancelledError once it has stopped. Files already written,
+    such as a partially populated project folder, are left in place.
+    Operations on the same AsyncProject run one at a time.
+    """
+
+    def __init__(self, project, executor=None, progress=None):
+        """Initialize the object."""
+        self.project = project
+        self.executor = executor
+        self.progress = progress
+        self._lock = None
+
+    async def _run(self, method, *args, **kwargs):
+        """Run a Project method in the executor, relaying progress and cancellation."""
+        loop = asyncio.get_running_loop()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            callback = None
+            if self.progress is not None:
+                callback = functools.partial(loop.call_soon_threadsafe, self.progress)
+            self.project.progress = Progress(callback, threading.Event())
+            future = loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                self.project.progress.cancel()
+                # Wait for the worker to stop so that the Project is not used by two threads
+                try:
+                    await future
+                except (Cancelled, Exception):
+                    pass
+                raise
+            except Cancelled:
+                raise asyncio.CancelledError()
+            finally:
+                self.project.progress = Progress()
+
+    async def save(self, path=None):
+        """Save the project and, if a path is given, store the project folder as a version."""
+        return await self._run(self.project.save, path)
+
+    async def launch(self, workflow, version=None, new=True, sample=None, stratify=None):
+        """Launch a project in the Workspace."""
+        return await self._run(self.project.launch, workflow, version, new, sample, stratify)
+
+    async def export(self, version=None):
+        """Export a project in the Workspace."""
+        return await self._run(self.project.export, version)
+
+    async def copy(self, name, version=None):
+        """Insert a copy of the project into the database using a new name and _id."""
+        return await self._run(self.project.copy, name, version)
+
+    async def delete(self, version=None):
+        """Delete the project or a project version, if the number is supplied."""
+        return await self._run(self.project.delete, version)
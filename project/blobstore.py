@@ -0,0 +1,396 @@
+"""blobstore.py."""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import timezone
+
+CHUNK_SIZE = 1024 * 1024
+# The file in each project folder which records the stats and hashes from the last save
+MANIFEST_FILE = '.project_manifest.json'
+# Files in this folder are written after the notebooks in a lazy restore
+DEFERRED_DIR = 'caches/'
+# The file in a project folder whose files are still being restored in the background
+PENDING_FILE = '.project_pending.json'
+# The file in a project folder recording the progress of the launch or restore that is writing it
+JOURNAL_FILE = '.project_journal.json'
+# Files modified this close to a scan (in nanoseconds) are rehashed at the next scan
+RACY_NS = 2 * 10 ** 9
+
+
+class DigestMismatch(ValueError):
+    """Raised when a file no longer matches the digest it is being stored under."""
+
+
+class _HashingReader():
+    """Wrap a binary file object, hashing the bytes as they are read."""
+
+    def __init__(self, f):
+        """Initialize the object."""
+        self.f = f
+        self.sha = hashlib.sha256()
+
+    def read(self, size=-1):
+        """Read and hash up to size bytes."""
+        data = self.f.read(size)
+        self.sha.update(data)
+        return data
+
+
+def hash_file(path):
+    """Return the SHA-256 hex digest of a file, read in chunks."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_bytes(data):
+    """Return the SHA-256 hex digest of a bytes object."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class LocalBlobStore():
+    """Store content-addressed blobs in a local directory.
+
+    Each blob is saved as `<root>/<aa>/<bb>/<sha256>`, so identical files are
+    only stored once, however many versions or projects contain them.
+    """
+
+    def __init__(self, root):
+        """Initialize the object."""
+        self.root = root
+
+    def path(self, digest):
+        """Get the path of a blob."""
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        """Test whether a blob is already in the store."""
+        return os.path.exists(self.path(digest))
+
+    def put(self, source, digest=None):
+        """Add a file to the store and return its digest.
+
+        Nothing is written if a blob with the same digest already exists. The
+        file is hashed again as it is copied, and DigestMismatch is raised if
+        it no longer matches the digest, e.g. because it was edited after it
+        was scanned.
+        """
+        if digest is None:
+            digest = hash_file(source)
+        if not self.exists(digest):
+            blob_path = self.path(digest)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # Copy to a temporary name first so that a partial blob is never visible
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path))
+            try:
+                with os.fdopen(fd, 'wb') as dst, open(source, 'rb') as src:
+                    reader = _HashingReader(src)
+                    shutil.copyfileobj(reader, dst, CHUNK_SIZE)
+                if reader.sha.hexdigest() != digest:
+                    raise DigestMismatch('{} changed whilst it was being stored.'.format(source))
+                os.replace(temp_path, blob_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        return digest
+
+    def put_bytes(self, data):
+        """Add a bytes object to the store and return its digest."""
+        digest = hash_bytes(data)
+        if not self.exists(digest):
+            blob_path = self.path(digest)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, blob_path)
+        return digest
+
+    def open(self, digest):
+        """Open a blob for reading as a binary file object."""
+        return open(self.path(digest), 'rb')
+
+    def delete(self, digest):
+        """Remove a blob from the store."""
+        if self.exists(digest):
+            os.remove(self.path(digest))
+
+    def list(self, digests=None):
+        """Yield the digest, size and storage time of each blob, or of those in digests."""
+        if digests is None:
+            paths = []
+            if os.path.isdir(self.root):
+                for base, _, files in os.walk(self.root):
+                    paths += [os.path.join(base, file) for file in files if len(file) == 64]
+        else:
+            paths = [self.path(digest) for digest in digests]
+        for blob_path in paths:
+            try:
+                stat = os.stat(blob_path)
+            except OSError:
+                continue
+            yield os.path.basename(blob_path), stat.st_size, stat.st_mtime
+
+
+class GridFSBlobStore():
+    """Store content-addressed blobs in a GridFS bucket.
+
+    Each blob is saved in chunks with its SHA-256 digest as the filename, so
+    identical files are only uploaded once and there is no 16 MB document limit.
+    """
+
+    def __init__(self, db, bucket_name='blobs'):
+        """Initialize the object."""
+        import gridfs
+        self.bucket = gridfs.GridFSBucket(db, bucket_name=bucket_name)
+        self.files = db[bucket_name + '.files']
+
+    @staticmethod
+    def ensure_indexes(db, bucket_name='blobs'):
+        """Create the index used to look blobs up by digest."""
+        db[bucket_name + '.files'].create_index('filename')
+
+    def exists(self, digest):
+        """Test whether a blob is already in the store."""
+        return self.files.find_one({'filename': digest}, projection={'_id': True}) is not None
+
+    def put(self, source, digest=None):
+        """Add a file to the store and return its digest.
+
+        Nothing is uploaded if a blob with the same digest already exists. The
+        file is hashed again as it is uploaded, and DigestMismatch is raised if
+        it no longer matches the digest, e.g. because it was edited after it
+        was scanned.
+        """
+        if digest is None:
+            digest = hash_file(source)
+        if not self.exists(digest):
+            with open(source, 'rb') as f:
+                reader = _HashingReader(f)
+                file_id = self.bucket.upload_from_stream(digest, reader)
+            if reader.sha.hexdigest() != digest:
+                self.bucket.delete(file_id)
+                raise DigestMismatch('{} changed whilst it was being stored.'.format(source))
+        return digest
+
+    def put_bytes(self, data):
+        """Add a bytes object to the store and return its digest."""
+        digest = hash_bytes(data)
+        if not self.exists(digest):
+            self.bucket.upload_from_stream(digest, data)
+        return digest
+
+    def open(self, digest):
+        """Open a blob for reading as a seekable binary file object."""
+        return self.bucket.open_download_stream_by_name(digest)
+
+    def delete(self, digest):
+        """Remove a blob from the store."""
+        for grid_file in self.bucket.find({'filename': digest}):
+            self.bucket.delete(grid_file._id)
+
+    def list(self, digests=None):
+        """Yield the digest, size and storage time of each blob, or of those in digests."""
+        query = {} if digests is None else {'filename': {'$in': list(digests)}}
+        for item in self.files.find(query, projection={'filename': True, 'length': True, 'uploadDate': True}):
+            yield item['filename'], item['length'], item['uploadDate'].replace(tzinfo=timezone.utc).timestamp()
+
+
+def get_blob_store(db, store='gridfs', root=None):
+    """Create the blob store named in the configuration."""
+    if store == 'local':
+        return LocalBlobStore(root)
+    return GridFSBlobStore(db)
+
+
+def referenced_blobs(store, projects_db):
+    """Get the digests of the manifests of every stored version and of the files they list."""
+    live = set()
+    for digest in projects_db.distinct('content.manifest'):
+        live.add(digest)
+        try:
+            live.update(record['sha256'] for record in load_manifest(store, digest))
+        except Exception:
+            # A manifest missing from the store has no files to keep
+            continue
+    return live
+
+
+def collect_garbage(store, projects_db, candidates=None, grace=0):
+    """Remove the blobs which no stored version refers to.
+
+    Every blob listed in the manifest of a version in the Projects collection
+    is kept. If `candidates` is given, only those digests are checked, e.g. the
+    blobs of versions which have just been removed; otherwise the whole store
+    is swept. Blobs stored less than `grace` seconds ago are kept, since a save
+    in progress may be about to record a version which uses them. Returns the
+    number of blobs and bytes removed.
+    """
+    live = referenced_blobs(store, projects_db)
+    now = time.time()
+    removed = 0
+    freed = 0
+    for digest, size, stored in list(store.list(candidates)):
+        if digest in live or now - stored < grace:
+            continue
+        store.delete(digest)
+        removed += 1
+        freed += size
+    return {'removed': removed, 'bytes': freed}
+
+
+def build_manifest(path):
+    """Walk a project folder and return a list of file records.
+
+    Each record is a dict with the relative `path`, `size` and `sha256` of a file.
+    """
+    return scan_manifest(path)['manifest']
+
+
+def scan_manifest(path, previous=None):
+    """Walk a project folder, hashing only the files that changed since the previous scan.
+
+    `previous` is the dict saved by `save_local_manifest()`, whose `files` map
+    relative paths to `[size, mtime_ns, sha256]`. Files whose size and modification time are
+    unchanged keep their recorded hash, so the cost of a scan is one `stat()` per
+    file plus the hashing of changed files. Files modified within RACY_NS of the
+    previous scan are always rehashed, since a later write in the same clock tick
+    would not change their modification time.
+
+    Returns a dict with the `manifest` records, the `files` dict and scan time
+    for the next scan, and lists of `changed` and `removed` paths.
+    """
+    if previous is None:
+        previous = {}
+    previous_files = previous.get('files', {})
+    # Only trust the recorded hashes of files which were not modified just before the previous scan
+    trusted_ns = previous.get('scanned_ns', 0) - RACY_NS
+    scanned_ns = time.time_ns()
+    files = {}
+    changed = []
+    rootlen = len(path) + 1
+    for base, _, filenames in os.walk(path):
+        for file in filenames:
+            fn = os.path.join(base, file)
+            rel_path = fn[rootlen:]
+            if rel_path in [MANIFEST_FILE, PENDING_FILE, JOURNAL_FILE]:
+                continue
+            stat = os.stat(fn)
+            record = previous_files.get(rel_path)
+            if record is not None and record[0] == stat.st_size and record[1] == stat.st_mtime_ns \
+                    and stat.st_mtime_ns < trusted_ns:
+                digest = record[2]
+            else:
+                digest = hash_file(fn)
+                if record is None or record[2] != digest:
+                    changed.append(rel_path)
+            files[rel_path] = [stat.st_size, stat.st_mtime_ns, digest]
+    removed = sorted(set(previous_files) - set(files))
+    manifest = [{'path': rel_path, 'size': files[rel_path][0], 'sha256': files[rel_path][2]} for rel_path in sorted(files)]
+    return {'manifest': manifest, 'files': files, 'scanned_ns': scanned_ns,
+            'changed': sorted(changed), 'removed': removed}
+
+
+def stat_manifest(path, manifest):
+    """Build the scan for a folder just restored from a manifest, without rehashing its files."""
+    scanned_ns = time.time_ns()
+    files = {}
+    for record in manifest:
+        stat = os.stat(os.path.join(path, record['path']))
+        files[record['path']] = [stat.st_size, stat.st_mtime_ns, record['sha256']]
+    return {'manifest': manifest, 'files': files, 'scanned_ns': scanned_ns, 'changed': [], 'removed': []}
+
+
+def load_local_manifest(path):
+    """Load the manifest saved in a project folder by the last save.
+
+    Returns an empty dict if there is no readable manifest.
+    """
+    try:
+        with open(os.path.join(path, MANIFEST_FILE), 'r') as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return {}
+
+
+def save_local_manifest(path, digest, scan):
+    """Save the manifest digest and the file stats from a scan to a project folder."""
+    local_manifest = {'manifest': digest, 'scanned_ns': scan['scanned_ns'], 'files': scan['files']}
+    fd, temp_path = tempfile.mkstemp(dir=path)
+    with os.fdopen(fd, 'w') as f:
+        f.write(json.dumps(local_manifest))
+    os.replace(temp_path, os.path.join(path, MANIFEST_FILE))
+
+
+def upload_files(store, path, manifest, paths=None, progress=None):
+    """Upload the files in a manifest that are not yet in the store.
+
+    If a list of `paths` is given, only those files are checked. `progress` is an
+    optional callable which receives the running counts. Returns the number of
+    files that had to be uploaded.
+    """
+    uploaded = 0
+    checked = 0
+    if paths is not None:
+        paths = set(paths)
+    for record in manifest:
+        if paths is not None and record['path'] not in paths:
+            continue
+        if not store.exists(record['sha256']):
+            store.put(os.path.join(path, record['path']), record['sha256'])
+            uploaded += 1
+        checked += 1
+        if progress is not None:
+            progress({'checked': checked, 'uploaded': uploaded})
+    return uploaded
+
+
+def store_manifest(store, path, manifest, paths=None, progress=None):
+    """Upload the files in a manifest that are not yet in the store.
+
+    The manifest itself is stored as a JSON blob. Returns its digest and the
+    number of files that had to be uploaded.
+    """
+    uploaded = upload_files(store, path, manifest, paths, progress)
+    data = json.dumps(manifest, sort_keys=True).encode('utf-8')
+    return store.put_bytes(data), uploaded
+
+
+def load_manifest(store, digest):
+    """Fetch a manifest from the store."""
+    with store.open(digest) as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def restore_manifest(store, manifest, output_path, atomic=False, progress=None):
+    """Write the files in a manifest to a folder.
+
+    If atomic is True, each file is written to a temporary name and then renamed,
+    so that a reader never sees a partially written file. `progress` is an
+    optional callable which receives the running counts.
+    """
+    for i, record in enumerate(manifest):
+        restore_file(store, record, output_path, atomic)
+        if progress is not None:
+            progress({'restored': i + 1, 'files': len(manifest)})
+
+
+def restore_file(store, record, output_path, atomic=False):
+    """Write a single file record from a manifest to a folder and return its path."""
+    fn = os.path.join(output_path, record['path'])
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    if atomic:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(fn))
+        with store.open(record['sha256']) as src, os.fdopen(fd, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.replace(temp_path, fn)
+    else:
+        with store.open(record['sha256']) as src, open(fn, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    return fn
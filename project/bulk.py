@@ -0,0 +1,218 @@
+"""bulk.py.
+
+Rename, delete, prune and export many projects at once with batched database
+writes. Projects are selected by a list of project _ids or by a query on the
+Projects collection. Run from the repository root with
+`python -m project.bulk prune --keep 5`, `python -m project.bulk delete-versions 1 2`,
+`python -m project.bulk export` or `python -m project.bulk gc`, optionally with
+`--ids` or `--query`.
+"""
+
+import argparse
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from bson import ObjectId, json_util
+
+from config import config
+from project.blobstore import collect_garbage, get_blob_store
+from project.db import get_database, pymongo
+from project.Project import Project
+
+
+def project_filter(projects=None):
+    """Get a query on the Projects collection from a list of project _ids or a query.
+
+    None selects every project.
+    """
+    if projects is None:
+        return {}
+    if isinstance(projects, dict):
+        return projects
+    return {'_id': {'$in': [ObjectId(_id) for _id in projects]}}
+
+
+def collect_blobs(client=None, grace=None):
+    """Remove the blobs in the version store that no stored version refers to.
+
+    Blobs stored less than `grace` seconds ago, by default
+    `config.BLOB_GC_GRACE`, are kept. Returns the number of blobs and bytes removed.
+    """
+    if grace is None:
+        grace = config.BLOB_GC_GRACE
+    db = get_database(client)
+    return collect_garbage(get_blob_store(db, config.BLOB_STORE, config.BLOB_DIR), db.Projects, grace=grace)
+
+
+def sweep_after_delete(result, client=None):
+    """Add the blobs removed after a bulk deletion to its result, if `config.BLOB_GC_ON_DELETE` is set."""
+    if result['result'] == 'success' and config.BLOB_GC_ON_DELETE:
+        result['blobs'] = collect_blobs(client)
+    return result
+
+
+def rename_projects(renames, client=None, batch_size=None):
+    """Set the names of many projects from a dict mapping project _ids to new names.
+
+    The updates are sent in unordered `bulk_write` batches of `batch_size`. The
+    result is 'fail' if any of the projects could not be found, with their
+    number in `missing`; the projects that were found are still renamed.
+    """
+    if batch_size is None:
+        batch_size = config.BULK_BATCH_SIZE
+    projects_db = get_database(client).Projects
+    requests = [pymongo.UpdateOne({'_id': ObjectId(_id)}, {'$set': {'name': name}}) for _id, name in renames.items()]
+    matched = 0
+    modified = 0
+    try:
+        for i in range(0, len(requests), batch_size):
+            result = projects_db.bulk_write(requests[i:i + batch_size], ordered=False)
+            matched += result.matched_count
+            modified += result.modified_count
+    except pymongo.errors.OperationFailure as e:
+        print(e.code)
+        print(e.details)
+        return {'result': 'fail', 'matched': matched, 'modified': modified,
+                'errors': ['<p>Unknown error: Could not rename the projects in the database.</p>']}
+    missing = len(requests) - matched
+    if missing > 0:
+        return {'result': 'fail', 'matched': matched, 'modified': modified, 'missing': missing,
+                'errors': ['<p>{} projects could not be found in the database.</p>'.format(missing)]}
+    return {'result': 'success', 'matched': matched, 'modified': modified, 'missing': 0, 'errors': []}
+
+
+def delete_projects(projects, client=None):
+    """Delete many projects with a single `delete_many`.
+
+    The blobs of their versions are then removed unless another version uses them.
+    """
+    query = project_filter(projects)
+    if not query:
+        return {'result': 'fail', 'errors': ['<p>Please select the projects to delete.</p>']}
+    try:
+        result = get_database(client).Projects.delete_many(query)
+        return sweep_after_delete({'result': 'success', 'deleted': result.deleted_count, 'errors': []}, client)
+    except pymongo.errors.OperationFailure as e:
+        print(e.code)
+        print(e.details)
+        return {'result': 'fail', 'errors': ['<p>Unknown error: Could not delete the projects from the database.</p>']}
+
+
+def delete_versions(projects, numbers, client=None):
+    """Delete the versions with the given numbers from many projects with a single `update_many`.
+
+    The blobs of the deleted versions are then removed unless another version uses them.
+    """
+    numbers = [int(number) for number in numbers]
+    try:
+        result = get_database(client).Projects.update_many(
+            {'$and': [project_filter(projects), {'content.version_number': {'$in': numbers}}]},
+            {'$pull': {'content': {'version_number': {'$in': numbers}}}})
+        return sweep_after_delete({'result': 'success', 'matched': result.matched_count,
+                                   'modified': result.modified_count, 'errors': []}, client)
+    except pymongo.errors.OperationFailure as e:
+        print(e.code)
+        print(e.details)
+        return {'result': 'fail', 'errors': ['<p>Unknown error: Could not delete the versions from the database.</p>']}
+
+
+def prune_versions(projects=None, keep=5, client=None):
+    """Keep only the latest `keep` versions of many projects.
+
+    A single `update_many` selects the projects with more than `keep` versions
+    and, on the server, sorts each project's versions by number and drops all
+    but the last `keep`, so no versions are read by the client. The blobs of
+    the dropped versions are then removed unless another version uses them.
+    """
+    keep = int(keep)
+    if keep < 1:
+        return {'result': 'fail', 'errors': ['<p>At least one version of each project must be kept.</p>']}
+    # A project has more than keep versions if it has a version at index keep
+    query = {'$and': [project_filter(projects), {'content.' + str(keep): {'$exists': True}}]}
+    try:
+        result = get_database(client).Projects.update_many(
+            query, {'$push': {'content': {'$each': [], '$sort': {'version_number': 1}, '$slice': -keep}}})
+        return sweep_after_delete({'result': 'success', 'matched': result.matched_count,
+                                   'modified': result.modified_count, 'errors': []}, client)
+    except pymongo.errors.OperationFailure as e:
+        print(e.code)
+        print(e.details)
+        return {'result': 'fail', 'errors': ['<p>Unknown error: Could not prune the versions in the database.</p>']}
+
+
+def export_projects(projects, templates_dir, workspace_dir, temp_dir, version=None, workers=None, client=None):
+    """Export a version of many projects, `workers` at a time.
+
+    The latest version of each project is exported unless a version number is
+    given. Each project is loaded without its version payloads. Returns the
+    file paths of the archives written and the errors of the exports that failed.
+    """
+    if workers is None:
+        workers = config.BULK_WORKERS
+    try:
+        ids = [record['_id'] for record in get_database(client).Projects.find(project_filter(projects), projection={'_id': True})]
+    except pymongo.errors.OperationFailure as e:
+        print(e.code)
+        print(e.details)
+        return {'result': 'fail', 'errors': ['<p>Unknown error: Could not find the projects in the database.</p>']}
+
+    def export(_id):
+        """Export one project and return its result."""
+        project = Project.load(_id, templates_dir, workspace_dir, temp_dir, client)
+        if project is None:
+            return {'result': 'fail', 'errors': ['<p>The project could not be found in the database.</p>']}
+        if version is not None and not project.get_version(version):
+            return {'result': 'fail', 'errors': ['<p>The project version could not be found.</p>']}
+        try:
+            return json.loads(project.export(version))
+        except Exception as e:
+            return {'result': 'fail', 'errors': ['<p>Unknown error: {}</p>'.format(e)]}
+
+    exported = {}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _id, result in zip(ids, pool.map(export, ids)):
+            if result['result'] == 'success':
+                exported[str(_id)] = result['filepath']
+            else:
+                failed[str(_id)] = result['errors']
+    return {'result': 'fail' if failed else 'success', 'exported': exported, 'failed': failed,
+            'errors': ['<p>{} of {} exports failed.</p>'.format(len(failed), len(ids))] if failed else []}
+
+
+def main():
+    """Run a bulk operation from the command line and print its result."""
+    parser = argparse.ArgumentParser(description='Prune, delete or export the versions of many projects.')
+    parser.add_argument('--ids', nargs='+', help='the project _ids; defaults to every project')
+    parser.add_argument('--query', help='a JSON query on the Projects collection selecting the projects')
+    commands = parser.add_subparsers(dest='command', required=True)
+    prune = commands.add_parser('prune', help='keep only the latest versions of each project')
+    prune.add_argument('--keep', type=int, default=5, help='the number of versions to keep')
+    delete = commands.add_parser('delete-versions', help='delete the given version numbers')
+    delete.add_argument('numbers', type=int, nargs='+')
+    export = commands.add_parser('export', help='export a version of each project to the Workspace')
+    export.add_argument('--version', type=int, help='the version number; defaults to the latest')
+    export.add_argument('--workers', type=int, help='the number of exports run at once')
+    export.add_argument('--templates-dir', default=config.TEMPLATES_DIR)
+    export.add_argument('--workspace-dir', default=config.WORKSPACE_DIR)
+    gc = commands.add_parser('gc', help='remove the stored files that no version refers to')
+    gc.add_argument('--grace', type=int, help='keep files stored less than this many seconds ago')
+    args = parser.parse_args()
+    projects = json_util.loads(args.query) if args.query else args.ids
+    if args.command == 'prune':
+        result = prune_versions(projects, args.keep)
+    elif args.command == 'delete-versions':
+        result = delete_versions(projects, args.numbers)
+    elif args.command == 'gc':
+        result = {'result': 'success', 'blobs': collect_blobs(grace=args.grace), 'errors': []}
+    else:
+        result = export_projects(projects, args.templates_dir, args.workspace_dir, config.TEMP_DIR, args.version,
+                                 args.workers)
+    print(json.dumps(result, indent=2))
+    for error in result['errors']:
+        print(error, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
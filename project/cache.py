@@ -0,0 +1,147 @@
+"""cache.py."""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from bson import json_util
+
+from project.clone import clone_tree
+
+ENTRY_FILE = 'entry.json'
+
+
+def query_key(db_query, projection=None, options=None):
+    """Get a canonical hash of a corpus query and the options used to serialise its results.
+
+    Queries which differ only in the order of their keys get the same key.
+    """
+    spec = {'query': db_query, 'projection': projection, 'options': options}
+    data = json.dumps(spec, sort_keys=True, default=json_util.default)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def corpus_marker(corpus_db, db_query, modified_field=None):
+    """Get a marker which changes whenever the documents matching a query change.
+
+    The marker combines the number of matching documents with the largest `_id`
+    and, if the corpus has a modification field, its latest value. Each part is
+    answered from an index where one exists. Without a modification field,
+    documents edited in place do not change the marker.
+    """
+    count = corpus_db.count_documents(db_query)
+    marker = [count]
+    fields = ['_id'] + ([modified_field] if modified_field else [])
+    for field in fields:
+        latest = list(corpus_db.find(db_query, projection={field: True}).sort(field, -1).limit(1))
+        marker.append(str(latest[0].get(field)) if latest else None)
+    return json.dumps(marker)
+
+
+class QueryCache():
+    """A size-bounded cache of serialised corpus query results shared by all projects.
+
+    Parameters:
+    - root: the folder holding the cache entries
+    - max_bytes: the total size above which least recently used entries are evicted
+
+    Each entry is a folder named by `query_key()` holding a `caches/` tree, as
+    written by `CorpusWriter`, and an `entry.json` recording the corpus marker,
+    document count and size. An entry is served to a project by cloning its
+    files, so it must never be modified in place.
+    """
+
+    def __init__(self, root, max_bytes):
+        """Initialize the object."""
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        """Get the folder of a cache entry."""
+        return os.path.join(self.root, key)
+
+    def get(self, key, marker):
+        """Get the entry for a key if it matches the corpus marker, or None.
+
+        Stale entries are removed. A hit marks the entry as recently used.
+        """
+        entry_file = os.path.join(self.path(key), ENTRY_FILE)
+        try:
+            with open(entry_file, 'r') as f:
+                entry = json.loads(f.read())
+        except (IOError, ValueError):
+            return None
+        if entry.get('marker') != marker:
+            self.remove(key)
+            return None
+        os.utime(entry_file)
+        return entry
+
+    def staging(self):
+        """Create a temporary folder in which to write a new entry."""
+        os.makedirs(self.root, exist_ok=True)
+        return tempfile.mkdtemp(dir=self.root, prefix='.staging-')
+
+    def put(self, key, staging_dir, marker, count):
+        """Move a written staging folder into the cache.
+
+        Call `evict()` once the entry has been served. If another process has
+        cached the same key in the meantime, the staging folder is discarded.
+        Returns the entry.
+        """
+        size = 0
+        for base, _, files in os.walk(staging_dir):
+            for file in files:
+                size += os.path.getsize(os.path.join(base, file))
+        entry = {'key': key, 'marker': marker, 'count': count, 'bytes': size, 'created': time.time()}
+        with open(os.path.join(staging_dir, ENTRY_FILE), 'w') as f:
+            f.write(json.dumps(entry))
+        self.remove(key)
+        try:
+            os.rename(staging_dir, self.path(key))
+        except OSError:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        return entry
+
+    def serve(self, key, project_dir, hardlinks=True):
+        """Clone an entry's files into a project folder and return the clone stats."""
+        return clone_tree(self.path(key), project_dir, ignore=[ENTRY_FILE], hardlinks=hardlinks, dirs_exist_ok=True)
+
+    def remove(self, key):
+        """Remove an entry."""
+        shutil.rmtree(self.path(key), ignore_errors=True)
+
+    def entries(self):
+        """List the entries, least recently used first."""
+        entries = []
+        if not os.path.exists(self.root):
+            return entries
+        for key in os.listdir(self.root):
+            entry_file = os.path.join(self.path(key), ENTRY_FILE)
+            try:
+                with open(entry_file, 'r') as f:
+                    entry = json.loads(f.read())
+                entry['last_used'] = os.path.getmtime(entry_file)
+                entries.append(entry)
+            except (IOError, ValueError):
+                continue
+        entries.sort(key=lambda entry: entry['last_used'])
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until the cache is within its size budget.
+
+        Returns the keys removed.
+        """
+        entries = self.entries()
+        total = sum(entry['bytes'] for entry in entries)
+        removed = []
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(entry['key'])
+            total -= entry['bytes']
+            removed.append(entry['key'])
+        return removed
@@ -0,0 +1,94 @@
+"""clone.py."""
+
+import fnmatch
+import os
+import shutil
+import tempfile
+
+# The Linux ioctl which shares a file's extents with another file (copy-on-write)
+FICLONE = 0x40049409
+# Files in these folders are never modified in place, so they can be hard linked
+IMMUTABLE_DIRS = ('caches/',)
+
+
+def reflink(src, dst):
+    """Create dst as a copy-on-write clone of src, if the filesystem supports it.
+
+    The clone is written to a temporary file which then replaces dst, so an
+    existing dst, which may be a hard link to src, is never opened for writing.
+    Returns True on success. On failure, dst is unchanged.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.clone', dir=os.path.dirname(dst) or '.')
+    try:
+        with open(src, 'rb') as src_file, os.fdopen(fd, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        shutil.copystat(src, temp_path)
+        os.replace(temp_path, dst)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    return True
+
+
+def clone_tree(src, dst, ignore=None, hardlinks=True, immutable_dirs=IMMUTABLE_DIRS, dirs_exist_ok=False):
+    """Clone a folder, sharing file data with the original wherever it is safe.
+
+    Every file is first cloned with a reflink. If the filesystem does not support
+    reflinks, files in `immutable_dirs` are hard linked and all other files, such
+    as notebooks and `datapackage.json`, are copied. Hard linked files share
+    their contents with the original, so they must be replaced rather than
+    rewritten in place. Modification times are preserved so that the folder's
+    saved manifest stays valid. The destination must not already exist, unless
+    dirs_exist_ok is True. Files already in the destination are replaced, and
+    any that are already the same file as the original are left alone.
+
+    `ignore` is a list of glob patterns for names to skip. Returns the number
+    of files reflinked, linked, copied and already in place.
+    """
+    stats = {'reflinked': 0, 'linked': 0, 'copied': 0, 'existing': 0}
+    os.makedirs(dst, exist_ok=dirs_exist_ok)
+    rootlen = len(src) + 1
+    use_reflinks = True
+    for base, dirs, files in os.walk(src):
+        if ignore:
+            dirs[:] = [d for d in dirs if not any(fnmatch.fnmatch(d, pattern) for pattern in ignore)]
+            files = [f for f in files if not any(fnmatch.fnmatch(f, pattern) for pattern in ignore)]
+        rel_base = base[rootlen:]
+        target_base = os.path.join(dst, rel_base)
+        for d in dirs:
+            os.makedirs(os.path.join(target_base, d), exist_ok=True)
+        for file in files:
+            source = os.path.join(base, file)
+            target = os.path.join(target_base, file)
+            rel_path = os.path.join(rel_base, file).replace(os.sep, '/')
+            if os.path.lexists(target):
+                # A target hard linked to the source, e.g. by an earlier clone, is already done
+                try:
+                    if os.path.samefile(source, target):
+                        stats['existing'] += 1
+                        continue
+                except OSError:
+                    pass
+                # Remove the target rather than writing into it, since it may share its data with other files
+                os.remove(target)
+            # Stop trying reflinks after the first failure, since the filesystem does not support them
+            if use_reflinks:
+                if reflink(source, target):
+                    stats['reflinked'] += 1
+                    continue
+                use_reflinks = False
+            if hardlinks and rel_path.startswith(immutable_dirs):
+                try:
+                    os.link(source, target)
+                    stats['linked'] += 1
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(source, target)
+            stats['copied'] += 1
+    return stats
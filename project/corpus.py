@@ -0,0 +1,367 @@
+"""corpus.py."""
+
+import gzip
+import hashlib
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from bson import json_util
+
+JSON_UTIL = json_util.default
+# Maps each cached document's _id to its file name and signature, for incremental refreshes
+SYNC_FILE = 'caches/sync.json'
+
+
+def encode(items, indent=2):
+    """Serialise a chunk of corpus documents.
+
+    Returns a list of `(name, data)` tuples, where data is the encoded document
+    as UTF-8 bytes. Defined at module level so that it can be sent to a process pool.
+    """
+    encoded = []
+    for item in items:
+        data = json.dumps(item, indent=indent, sort_keys=False, default=JSON_UTIL)
+        encoded.append((item['name'], data.encode('utf-8')))
+    return encoded
+
+
+def write_replace(path, data):
+    """Write bytes to a temporary file and rename it over path.
+
+    A file hard linked to path keeps its old contents.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def signature(item, data, modified_field=None):
+    """Get the value which changes when a corpus document changes.
+
+    This is the document's modification field if the corpus has one, otherwise
+    the SHA-256 hash of its encoded bytes.
+    """
+    if modified_field:
+        return json.dumps(item.get(modified_field), default=JSON_UTIL)
+    return hashlib.sha256(data).hexdigest()
+
+
+def index_corpus_files(project_dir, modified_field=None):
+    """Build a sync index from the files in a project's `caches/json` folder.
+
+    Used when a project has no saved index, as after its first launch.
+    """
+    documents = {}
+    json_caches = os.path.join(project_dir, 'caches/json')
+    if not os.path.exists(json_caches):
+        return documents
+    for entry in os.scandir(json_caches):
+        if not entry.name.endswith('.json') or not entry.is_file():
+            continue
+        with open(entry.path, 'rb') as f:
+            data = f.read()
+        try:
+            item = json_util.loads(data.decode('utf-8'))
+        except ValueError:
+            continue
+        if '_id' in item:
+            documents[str(item['_id'])] = [entry.name[:-5], signature(item, data, modified_field)]
+    return documents
+
+
+def load_sync_index(project_dir, modified_field=None):
+    """Get the sync index of a project's cached documents.
+
+    Returns a dict mapping each document's _id to its name and signature. The
+    index is rebuilt from the files if it is missing or was built with a
+    different modification field.
+    """
+    try:
+        with open(os.path.join(project_dir, SYNC_FILE), 'r') as f:
+            index = json.loads(f.read())
+        if index.get('modified_field') == modified_field:
+            return index['documents']
+    except (IOError, ValueError, KeyError):
+        pass
+    return index_corpus_files(project_dir, modified_field)
+
+
+def save_sync_index(project_dir, documents, modified_field=None):
+    """Save the sync index of a project's cached documents."""
+    index = {'modified_field': modified_field, 'documents': documents}
+    write_replace(os.path.join(project_dir, SYNC_FILE), json.dumps(index).encode('utf-8'))
+
+
+class JsonlShards():
+    """Lay out encoded documents in JSON Lines shards with an offset index.
+
+    Parameters:
+    - open_shard: a callable which takes a shard name and returns a writable binary file
+    - shard_size: the number of documents per shard
+    - compression: None, or 'gzip' to compress the shards in independent blocks
+    - block_size: the uncompressed size in bytes of each compressed block
+    - on_close: an optional callable which receives each shard's name and file before it is closed
+
+    Uncompressed shards are indexed by the shard, offset and length of each
+    document. Compressed shards are a series of gzip members, so they can still
+    be read with any gzip tool. The index lists the shard, offset and length of
+    each block, and the block, offset and length of each document, so a reader
+    only decompresses the block it needs.
+    """
+
+    def __init__(self, open_shard, shard_size=10000, compression=None, block_size=256 * 1024, on_close=None):
+        """Initialize the object."""
+        if compression not in [None, 'gzip']:
+            raise ValueError('Unknown corpus compression: ' + str(compression))
+        self.open_shard = open_shard
+        self.shard_size = shard_size
+        self.compression = compression
+        self.block_size = block_size
+        self.on_close = on_close
+        self.index = {'shard_size': shard_size, 'compression': compression, 'shards': [], 'documents': []}
+        if compression:
+            self.index['blocks'] = []
+        self.shard = None
+        self.shard_count = 0
+        self.offset = 0
+        self.block = []
+        self.block_offset = 0
+
+    def add(self, name, data):
+        """Add an encoded document, starting a new shard when the current one is full."""
+        if self.shard is None or self.shard_count >= self.shard_size:
+            self._close_shard()
+            shard_name = 'corpus-{:05d}.jsonl'.format(len(self.index['shards']))
+            if self.compression:
+                shard_name += '.gz'
+            self.index['shards'].append(shard_name)
+            self.shard = self.open_shard(shard_name)
+            self.shard_count = 0
+            self.offset = 0
+        if self.compression:
+            self.block.append(data + b'\n')
+            self.index['documents'].append([name, len(self.index['blocks']), self.block_offset, len(data)])
+            self.block_offset += len(data) + 1
+            if self.block_offset >= self.block_size:
+                self._flush_block()
+        else:
+            self.shard.write(data + b'\n')
+            self.index['documents'].append([name, len(self.index['shards']) - 1, self.offset, len(data)])
+            self.offset += len(data) + 1
+        self.shard_count += 1
+
+    def _flush_block(self):
+        """Compress the pending block and write it to the current shard."""
+        if not self.block:
+            return
+        # Level 1 keeps pace with the encoders; a fixed mtime keeps the output identical for identical documents
+        data = gzip.compress(b''.join(self.block), 1, mtime=0)
+        self.shard.write(data)
+        self.index['blocks'].append([len(self.index['shards']) - 1, self.offset, len(data)])
+        self.offset += len(data)
+        self.block = []
+        self.block_offset = 0
+
+    def _close_shard(self):
+        """Finish the current shard, if there is one."""
+        if self.shard is None:
+            return
+        if self.compression:
+            self._flush_block()
+        if self.on_close is not None:
+            self.on_close(self.index['shards'][-1], self.shard)
+        self.shard.close()
+        self.shard = None
+
+    def close(self):
+        """Finish the last shard and return the encoded index."""
+        self._close_shard()
+        return json.dumps(self.index).encode('utf-8')
+
+
+class CorpusWriter():
+    """Write a stream of corpus documents to a project's caches folder.
+
+    Parameters:
+    - project_dir: the project folder to write to
+    - indent: the JSON indent; None writes compact documents (ignored for 'jsonl')
+    - layout: 'files' writes one `caches/json/<name>.json` file per document;
+      'jsonl' writes `caches/jsonl/corpus-<n>.jsonl` shards with an `index.json`
+      giving the shard, offset and length of each document
+    - shard_size: the number of documents per JSON Lines shard
+    - compression: None, or 'gzip' to compress JSON Lines shards in independent blocks
+    - block_size: the uncompressed size in bytes of each compressed block
+    - workers: the number of encoding workers
+    - executor: 'thread' or 'process'
+    - chunk_size: the number of documents sent to a worker at a time
+    - queue_size: the maximum number of encoded chunks waiting to be written
+    - progress: an optional callable which receives the running stats dict
+    - replace: write each file under a temporary name and rename it into place,
+      so that files hard linked from elsewhere are never modified
+    - checkpoint: an optional callable which receives the `_id` of the last document
+      in each chunk and the running stats once the chunk has been written
+
+    Documents are encoded by a pool of workers and handed to a single writer
+    thread through a bounded queue, so reading from the database, encoding and
+    writing to disk overlap without holding the whole corpus in memory. Chunks
+    are written in the order they are read, so after a checkpoint every earlier
+    document has been written.
+    """
+
+    def __init__(self, project_dir, indent=2, layout='files', shard_size=10000, workers=None,
+                 executor='thread', chunk_size=100, queue_size=64, progress=None, replace=False,
+                 compression=None, block_size=256 * 1024, checkpoint=None):
+        """Initialize the object."""
+        if layout not in ['files', 'jsonl']:
+            raise ValueError('Unknown corpus layout: ' + str(layout))
+        self.project_dir = project_dir
+        self.indent = indent
+        self.layout = layout
+        self.shard_size = shard_size
+        self.compression = compression
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.progress = progress
+        self.replace = replace
+        self.checkpoint = checkpoint
+        self.stats = {'count': 0, 'bytes': 0, 'seconds': 0.0, 'read_seconds': 0.0, 'encode_wait_seconds': 0.0,
+                      'write_seconds': 0.0}
+        self._error = None
+
+    def write(self, documents):
+        """Encode and write an iterable of documents.
+
+        Returns the stats dict with document and byte counts and throughput. The
+        time spent waiting for documents from the iterator, waiting for encoders
+        and writing files is counted separately, to show which stage limits the rest.
+        """
+        start = time.perf_counter()
+        pending = queue.Queue(maxsize=self.queue_size)
+        writer = threading.Thread(target=self._consume, args=(pending,), daemon=True)
+        writer.start()
+        pool_class = ProcessPoolExecutor if self.executor == 'process' else ThreadPoolExecutor
+        futures = deque()
+        # JSON Lines requires one document per line
+        indent = None if self.layout == 'jsonl' else self.indent
+        try:
+            with pool_class(max_workers=self.workers) as pool:
+                for chunk in self._chunks(documents):
+                    futures.append((pool.submit(encode, chunk, indent), chunk[-1].get('_id')))
+                    # Keep a bounded window of chunks in flight, preserving their order
+                    while len(futures) > self.workers * 2:
+                        self._put(pending, self._result(*futures.popleft()))
+                while futures:
+                    self._put(pending, self._result(*futures.popleft()))
+        finally:
+            pending.put(None)
+            writer.join()
+        if self._error is not None:
+            raise self._error
+        self.stats['seconds'] = round(time.perf_counter() - start, 3)
+        for key in ['read_seconds', 'encode_wait_seconds', 'write_seconds']:
+            self.stats[key] = round(self.stats[key], 3)
+        if self.stats['seconds'] > 0:
+            self.stats['docs_per_second'] = round(self.stats['count'] / self.stats['seconds'], 1)
+            self.stats['mb_per_second'] = round(self.stats['bytes'] / 1048576 / self.stats['seconds'], 2)
+        return self.stats
+
+    def _chunks(self, documents):
+        """Group the document stream into lists of chunk_size documents."""
+        chunk = []
+        iterator = iter(documents)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                self.stats['read_seconds'] += time.perf_counter() - started
+            chunk.append(item)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _result(self, future, last_id):
+        """Wait for an encoded chunk, counting the time spent waiting."""
+        started = time.perf_counter()
+        encoded = future.result()
+        self.stats['encode_wait_seconds'] += time.perf_counter() - started
+        return encoded, last_id
+
+    def _put(self, pending, chunk):
+        """Queue an encoded chunk, stopping early if the writer has failed."""
+        if self._error is not None:
+            raise self._error
+        pending.put(chunk)
+
+    def _consume(self, pending):
+        """Write encoded chunks from the queue until the sentinel is received."""
+        try:
+            if self.layout == 'jsonl':
+                self._write_jsonl(pending)
+            else:
+                self._write_files(pending)
+        except BaseException as e:
+            # Includes cancellation raised by the progress callback
+            self._error = e
+            # Drain the queue so that the producer is never blocked
+            while pending.get() is not None:
+                pass
+
+    def _write_files(self, pending):
+        """Write one JSON file per document."""
+        json_caches = os.path.join(self.project_dir, 'caches/json')
+        os.makedirs(json_caches, exist_ok=True)
+        for encoded, last_id in iter(pending.get, None):
+            started = time.perf_counter()
+            for name, data in encoded:
+                if self.replace:
+                    write_replace(os.path.join(json_caches, name + '.json'), data)
+                else:
+                    with open(os.path.join(json_caches, name + '.json'), 'wb') as f:
+                        f.write(data)
+            self._count(encoded, started, last_id)
+
+    def _write_jsonl(self, pending):
+        """Write the documents to JSON Lines shards with an offset index."""
+        jsonl_caches = os.path.join(self.project_dir, 'caches/jsonl')
+        os.makedirs(jsonl_caches, exist_ok=True)
+        shards = JsonlShards(lambda name: open(os.path.join(jsonl_caches, name), 'wb'), self.shard_size,
+                             self.compression, self.block_size)
+        try:
+            for encoded, last_id in iter(pending.get, None):
+                started = time.perf_counter()
+                for name, data in encoded:
+                    shards.add(name, data)
+                self._count(encoded, started, last_id)
+        finally:
+            index = shards.close()
+        with open(os.path.join(jsonl_caches, 'index.json'), 'wb') as f:
+            f.write(index)
+
+    def _count(self, encoded, started, last_id):
+        """Update the progress counters and the checkpoint after a chunk has been written."""
+        self.stats['write_seconds'] += time.perf_counter() - started
+        self.stats['count'] += len(encoded)
+        self.stats['bytes'] += sum(len(data) for _, data in encoded)
+        if self.progress is not None:
+            self.progress(self.stats)
+        if self.checkpoint is not None:
+            self.checkpoint(last_id, self.stats)
@@ -0,0 +1,73 @@
+"""db.py."""
+
+import importlib.util
+import os
+import sys
+import threading
+
+from config import config
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+def lazy_import(name):
+    """Import a module whose code only runs when one of its attributes is first used."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+pymongo = lazy_import('pymongo')
+
+
+def create_client(url=None, **kwargs):
+    """Create a MongoClient with the pool size and timeouts in `config`.
+
+    Keyword arguments override the configured MongoClient options.
+    """
+    options = {
+        'maxPoolSize': config.MONGO_MAX_POOL_SIZE,
+        'minPoolSize': config.MONGO_MIN_POOL_SIZE,
+        'connectTimeoutMS': config.MONGO_CONNECT_TIMEOUT_MS,
+        'serverSelectionTimeoutMS': config.MONGO_TIMEOUT_MS,
+        'connect': False
+    }
+    options.update(kwargs)
+    return pymongo.MongoClient(url or config.MONGO_CLIENT, **options)
+
+
+def get_client():
+    """Get the process-wide MongoClient, creating it on first use.
+
+    A new client is created after a fork, since clients cannot be shared
+    between processes.
+    """
+    global _client, _client_pid
+    with _lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = create_client()
+            _client_pid = os.getpid()
+        return _client
+
+
+def set_client(client):
+    """Use the given client for every Project in this process that is not given its own."""
+    global _client, _client_pid
+    with _lock:
+        _client = client
+        _client_pid = os.getpid()
+
+
+def get_database(client=None):
+    """Get the WE1S database from a client, or from the process-wide client."""
+    if client is None:
+        client = get_client()
+    return client[config.MONGO_DATABASE]
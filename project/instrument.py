@@ -0,0 +1,205 @@
+"""instrument.py."""
+
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+from config import config
+
+_sinks = None
+_lock = threading.Lock()
+
+
+class LogSink():
+    """Send each operation's record to a logger as a line of JSON.
+
+    Parameters:
+    - logger: the logger to use; defaults to the `project.instrument` logger
+    """
+
+    def __init__(self, logger=None):
+        """Initialize the object."""
+        self.logger = logger or logging.getLogger('project.instrument')
+
+    def emit(self, record):
+        """Log a record."""
+        self.logger.info(json.dumps({key: value for key, value in record.items() if key != 'profile'}))
+
+
+class PrometheusSink():
+    """Keep running totals of the operation records in a Prometheus text file.
+
+    Parameters:
+    - path: the file to write, e.g. in the folder read by node_exporter's textfile collector
+
+    The file is replaced after every operation, so a scraper never reads it half written.
+    """
+
+    def __init__(self, path):
+        """Initialize the object."""
+        self.path = path
+        self.operations = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        """Add a record to the totals and rewrite the file."""
+        operation = record['operation']
+        with self._lock:
+            self.operations[operation] += 1
+            self.seconds[operation] += record['seconds']
+            for stage, seconds in record['stages'].items():
+                self.stages[(operation, stage)] += seconds
+            for counter, value in record['counters'].items():
+                self.counters[(operation, counter)] += value
+            lines = ['# TYPE we1s_project_operations_total counter']
+            lines += ['we1s_project_operations_total{{operation="{}"}} {}'.format(op, n) for op, n in sorted(self.operations.items())]
+            lines.append('# TYPE we1s_project_operation_seconds_total counter')
+            lines += ['we1s_project_operation_seconds_total{{operation="{}"}} {:.6f}'.format(op, s)
+                      for op, s in sorted(self.seconds.items())]
+            lines.append('# TYPE we1s_project_stage_seconds_total counter')
+            lines += ['we1s_project_stage_seconds_total{{operation="{}",stage="{}"}} {:.6f}'.format(op, stage, s)
+                      for (op, stage), s in sorted(self.stages.items())]
+            lines.append('# TYPE we1s_project_count_total counter')
+            lines += ['we1s_project_count_total{{operation="{}",counter="{}"}} {}'.format(op, counter, value)
+                      for (op, counter), value in sorted(self.counters.items())]
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(temp_path, self.path)
+
+
+def get_sinks():
+    """Get the process-wide sinks configured in `config`."""
+    global _sinks
+    with _lock:
+        if _sinks is None:
+            _sinks = []
+            if config.INSTRUMENT_LOG:
+                _sinks.append(LogSink())
+            if config.INSTRUMENT_PROMETHEUS_FILE:
+                _sinks.append(PrometheusSink(config.INSTRUMENT_PROMETHEUS_FILE))
+        return _sinks
+
+
+class Instrument():
+    """Time the stages of Project operations and count what they process.
+
+    Parameters:
+    - sinks: objects with an `emit(record)` method which receive each finished operation
+    - profile: if True, run each operation under cProfile and keep the top functions
+    - trace_memory: if True, trace allocations with tracemalloc and keep the peak
+
+    The outermost measured call in a thread is an operation. Measured calls inside
+    it, and the stages and counters added while it runs, are added to its record:
+    `{'operation', 'seconds', 'stages': {name: seconds}, 'counters': {name: value}}`.
+    """
+
+    def __init__(self, sinks=None, profile=False, trace_memory=False):
+        """Initialize the object."""
+        self.sinks = sinks if sinks is not None else []
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.last = None
+        self._local = threading.local()
+
+    @property
+    def record(self):
+        """Get the record of the operation running in this thread, or None."""
+        return getattr(self._local, 'record', None)
+
+    @contextmanager
+    def measure(self, name):
+        """Time an operation or, inside one, a stage."""
+        record = self.record
+        if record is not None:
+            started = time.perf_counter()
+            try:
+                yield record
+            finally:
+                self.add_stage(name, time.perf_counter() - started)
+            return
+        record = {'operation': name, 'seconds': 0.0, 'stages': {}, 'counters': {}}
+        self._local.record = record
+        profiler = cProfile.Profile() if self.profile else None
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        if profiler is not None:
+            profiler.enable()
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.perf_counter() - started, 6)
+            if profiler is not None:
+                profiler.disable()
+                output = io.StringIO()
+                pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(20)
+                record['profile'] = output.getvalue()
+            if tracing:
+                record['memory_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self._local.record = None
+            self.last = record
+            for sink in self.sinks:
+                sink.emit(record)
+
+    def add_stage(self, name, seconds):
+        """Add time to a stage of the running operation, if there is one."""
+        record = self.record
+        if record is not None:
+            record['stages'][name] = round(record['stages'].get(name, 0.0) + seconds, 6)
+
+    def count(self, name, value=1):
+        """Add to a counter of the running operation, if there is one."""
+        record = self.record
+        if record is not None:
+            record['counters'][name] = record['counters'].get(name, 0) + value
+
+
+def instrumented(name):
+    """Measure a Project method with the project's Instrument.
+
+    When the method is the outermost operation, its record is added to the
+    result under 'timings', whether the result is a dict or a JSON string.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            outermost = self.instrument.record is None
+            with self.instrument.measure(name):
+                result = method(self, *args, **kwargs)
+            if outermost:
+                result = _attach(result, self.instrument.last)
+            return result
+        return wrapper
+    return decorator
+
+
+def _attach(result, record):
+    """Add a timing record to a result dict or a JSON result string.
+
+    Other return values, such as version dicts, are left alone.
+    """
+    timings = {key: value for key, value in record.items() if key != 'profile'}
+    if isinstance(result, dict) and 'result' in result:
+        result['timings'] = timings
+    elif isinstance(result, str) and result.startswith('{'):
+        data = json.loads(result)
+        if 'result' in data:
+            data['timings'] = timings
+            result = json.dumps(data)
+    return result
@@ -0,0 +1,288 @@
+"""jobs.py."""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from config import config
+from project.progress import Cancelled
+
+# Jobs in these states are merged with duplicate requests
+ACTIVE = ['queued', 'running']
+SCHEMA = '''CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    project_id TEXT NOT NULL,
+    options TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    pid INTEGER,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+)'''
+
+_queue = None
+_lock = threading.Lock()
+
+
+def pid_alive(pid):
+    """Check whether a process is still running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def run_job(kind, project_id, options):
+    """Load a project from the database and run an export or snapshot job.
+
+    Returns the JSON result of `Project.export()` or `Project.save()`.
+    """
+    # Imported here because Project imports this module
+    from bson import json_util
+    from project.Project import Project
+    project = Project.load(project_id, options['templates_dir'], options['workspace_dir'], options['temp_dir'])
+    if project is None:
+        return json.dumps({'result': 'fail', 'errors': ['<p>The project could not be found in the database.</p>']})
+    if kind == 'export':
+        return project.export(options['version'])
+    elif kind == 'snapshot':
+        return json.dumps(project.save(options['path']), default=json_util.default)
+    raise ValueError('Unknown job kind: ' + str(kind))
+
+
+class _Connection():
+    """Close a sqlite3 connection at the end of a with block."""
+
+    def __init__(self, conn):
+        """Initialize the object."""
+        self.conn = conn
+
+    def __enter__(self):
+        """Return the connection."""
+        return self.conn
+
+    def __exit__(self, *exc):
+        """Roll back any open transaction and close the connection."""
+        if self.conn.in_transaction:
+            self.conn.rollback()
+        self.conn.close()
+
+
+class Job():
+    """A handle on a queued job.
+
+    Parameters:
+    - queue: the JobQueue holding the job
+    - id: the job id
+    """
+
+    def __init__(self, queue, id):
+        """Initialize the object."""
+        self.queue = queue
+        self.id = id
+
+    def status(self):
+        """Get the job's record as a dict."""
+        return self.queue.status(self.id)
+
+    def done(self):
+        """Check whether the job has finished."""
+        return self.status()['status'] in ['done', 'failed']
+
+    def result(self, timeout=None):
+        """Wait for the job to finish and return its JSON result.
+
+        Raises TimeoutError if the job has not finished within `timeout` seconds.
+        """
+        return self.queue.wait(self.id, timeout)['result']
+
+
+class JobQueue():
+    """A persistent queue of export and snapshot jobs with a bounded pool of workers.
+
+    Parameters:
+    - path: the SQLite database file holding the queue
+    - workers: the number of jobs run at once by all processes sharing the queue
+    - poll_seconds: the interval at which idle workers check for jobs
+
+    A request for a job which is already queued for the same project version
+    returns the existing job, as does an export which is already running. The
+    queue survives restarts: jobs left running by a process which has exited
+    are queued again when a worker starts.
+    """
+
+    def __init__(self, path, workers=2, poll_seconds=0.5):
+        """Initialize the object."""
+        self.path = path
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self._threads = []
+        self._stop = threading.Event()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(SCHEMA)
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status)')
+
+    def _connect(self):
+        """Open a connection; each thread uses its own."""
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return _Connection(conn)
+
+    def submit(self, kind, project_id, options):
+        """Queue a job, or return the matching active job, and start the workers.
+
+        Exports are merged with queued or running exports of the same version.
+        Snapshots are merged only with queued snapshots of the same folder, since a
+        running snapshot may already have scanned the folder.
+        """
+        if kind == 'export':
+            key = 'export:{}:{}'.format(project_id, options['version'])
+            statuses = ACTIVE
+        else:
+            key = 'snapshot:{}:{}'.format(project_id, os.path.abspath(options['path']))
+            statuses = ['queued']
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT id FROM jobs WHERE key = ? AND status IN ({}) ORDER BY id LIMIT 1'.format(
+                ','.join('?' * len(statuses))), [key] + statuses).fetchone()
+            if row is not None:
+                conn.execute('COMMIT')
+                job_id = row['id']
+            else:
+                cursor = conn.execute('INSERT INTO jobs (kind, key, project_id, options, status, created) VALUES (?, ?, ?, ?, ?, ?)',
+                                      [kind, key, str(project_id), json.dumps(options), 'queued', time.time()])
+                conn.execute('COMMIT')
+                job_id = cursor.lastrowid
+        self.start()
+        return Job(self, job_id)
+
+    def status(self, job_id):
+        """Get a job's record as a dict, or None if there is no such job."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', [job_id]).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['options'] = json.loads(job['options'])
+        return job
+
+    def list(self, status=None):
+        """List the jobs, optionally only those with a given status."""
+        with self._connect() as conn:
+            if status is None:
+                rows = conn.execute('SELECT id FROM jobs ORDER BY id').fetchall()
+            else:
+                rows = conn.execute('SELECT id FROM jobs WHERE status = ? ORDER BY id', [status]).fetchall()
+        return [self.status(row['id']) for row in rows]
+
+    def wait(self, job_id, timeout=None):
+        """Wait for a job to finish and return its record.
+
+        Raises TimeoutError if the job has not finished within `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.status(job_id)
+            if job is None:
+                raise KeyError('No such job: ' + str(job_id))
+            if job['status'] in ['done', 'failed']:
+                return job
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError('Job {} has not finished.'.format(job_id))
+            time.sleep(self.poll_seconds)
+
+    def start(self):
+        """Start the worker threads of this process if they are not running."""
+        with _lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            if self._threads:
+                return
+            self._stop.clear()
+            self.recover()
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop the worker threads once their current jobs have finished."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def recover(self):
+        """Queue again the jobs left running by processes which have exited.
+
+        Returns the number of jobs requeued.
+        """
+        requeued = 0
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for row in conn.execute('SELECT id, pid FROM jobs WHERE status = ?', ['running']).fetchall():
+                if row['pid'] is None or not pid_alive(row['pid']):
+                    conn.execute('UPDATE jobs SET status = ?, pid = NULL, started = NULL WHERE id = ?', ['queued', row['id']])
+                    requeued += 1
+            conn.execute('COMMIT')
+        return requeued
+
+    def claim(self):
+        """Mark the oldest queued job as running and return it, or None.
+
+        No job is claimed if `workers` jobs are already running, so processes
+        sharing the queue never run more than that between them.
+        """
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            running = conn.execute('SELECT COUNT(*) FROM jobs WHERE status = ?', ['running']).fetchone()[0]
+            row = None
+            if running < self.workers:
+                row = conn.execute('SELECT * FROM jobs WHERE status = ? ORDER BY id LIMIT 1', ['queued']).fetchone()
+            if row is not None:
+                conn.execute('UPDATE jobs SET status = ?, pid = ?, started = ? WHERE id = ?',
+                             ['running', os.getpid(), time.time(), row['id']])
+            conn.execute('COMMIT')
+        return dict(row) if row is not None else None
+
+    def finish(self, job_id, status, result):
+        """Record the result of a job."""
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET status = ?, result = ?, finished = ? WHERE id = ?',
+                         [status, result, time.time(), job_id])
+
+    def _work(self):
+        """Claim and run jobs until the queue is stopped."""
+        while not self._stop.is_set():
+            job = self.claim()
+            if job is None:
+                self._stop.wait(self.poll_seconds)
+                continue
+            try:
+                result = run_job(job['kind'], job['project_id'], json.loads(job['options']))
+                status = 'failed' if json.loads(result).get('result') == 'fail' else 'done'
+            except Cancelled:
+                result = json.dumps({'result': 'fail', 'errors': ['<p>The job was cancelled.</p>']})
+                status = 'failed'
+            except BaseException as e:
+                # Anything a job raises, including KeyboardInterrupt, fails only that job, so the worker keeps running
+                result = json.dumps({'result': 'fail', 'errors': ['<p>Error: The job failed: {}.</p>'.format(type(e).__name__)]})
+                status = 'failed'
+            self.finish(job['id'], status, result)
+
+
+def get_queue():
+    """Get the process-wide job queue configured in `config`."""
+    global _queue
+    with _lock:
+        if _queue is None:
+            _queue = JobQueue(config.JOB_DB, config.JOB_WORKERS, config.JOB_POLL_SECONDS)
+        return _queue
@@ -0,0 +1,164 @@
+"""journal.py.
+
+Record the progress of an operation writing a project folder or an export
+archive, so that an interrupted launch, restore or export resumes where it
+stopped and a half-written folder is never served as if it were complete.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from bson import json_util
+
+from config import config
+from project.blobstore import JOURNAL_FILE
+
+JSON_UTIL = json_util.default
+
+
+def journal_key(*parts):
+    """Get a hash of the inputs of an operation, e.g. a project, workflow and query."""
+    data = json.dumps(parts, sort_keys=True, default=JSON_UTIL)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class Journal():
+    """Record the completed stages and latest checkpoints of an operation in a small file.
+
+    Parameters:
+    - path: the journal file
+    - interval: the least number of seconds between saves of a checkpoint;
+      defaults to `config.JOURNAL_INTERVAL`
+
+    The journal holds the `operation`, a `key` identifying its inputs, the
+    completed `stages`, the latest `checkpoints` of the stages in progress and
+    whether the operation is `complete`. It is replaced atomically, so it is
+    never read half written. A checkpoint only moves forward, so one lost
+    between saves just means that some work is repeated.
+    """
+
+    def __init__(self, path, interval=None):
+        """Initialize the object."""
+        self.path = path
+        self.interval = interval if interval is not None else config.JOURNAL_INTERVAL
+        self.data = self.load()
+        self._saved = 0.0
+
+    def load(self):
+        """Read the journal file, or return None if there is no readable journal."""
+        try:
+            with open(self.path, 'r') as f:
+                return json_util.loads(f.read())
+        except (IOError, ValueError):
+            return None
+
+    @property
+    def is_complete(self):
+        """Check whether the operation recorded in the journal finished."""
+        return self.data is not None and self.data.get('complete', False)
+
+    def matches(self, operation, key):
+        """Check whether the journal records an unfinished run of the same operation."""
+        return self.data is not None and not self.is_complete \
+            and self.data.get('operation') == operation and self.data.get('key') == key
+
+    def start(self, operation, key):
+        """Start an operation, or resume it if an earlier run with the same key stopped partway.
+
+        Returns True if the earlier run's stages and checkpoints are kept.
+        """
+        if self.matches(operation, key):
+            self.data['resumed'] = self.data.get('resumed', 0) + 1
+            self.save()
+            return True
+        self.data = {'operation': operation, 'key': key, 'stages': [], 'checkpoints': {}, 'complete': False,
+                     'started': time.time()}
+        self.save()
+        return False
+
+    def is_done(self, stage):
+        """Check whether a stage has been completed."""
+        return stage in self.data['stages']
+
+    def get(self, stage, default=None):
+        """Get the latest checkpoint of a stage in progress."""
+        return self.data['checkpoints'].get(stage, default)
+
+    def checkpoint(self, stage, value):
+        """Record how far a stage has got, saving the journal if the interval has passed."""
+        self.data['checkpoints'][stage] = value
+        if time.monotonic() - self._saved >= self.interval:
+            self.save()
+
+    def done(self, stage):
+        """Record a completed stage."""
+        if stage not in self.data['stages']:
+            self.data['stages'].append(stage)
+        self.data['checkpoints'].pop(stage, None)
+        self.save()
+
+    def complete(self):
+        """Record that the operation finished."""
+        self.data['complete'] = True
+        self.data['checkpoints'] = {}
+        self.save()
+
+    def save(self):
+        """Replace the journal file with the current record."""
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(self.data, default=JSON_UTIL))
+        os.replace(temp_path, self.path)
+        self._saved = time.monotonic()
+
+    def remove(self):
+        """Remove the journal file."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def open_journal(project_dir, operation, key):
+    """Start or resume the journal of an operation writing a project folder.
+
+    A folder left unfinished by a different operation is cleared first, since
+    none of its files can be trusted. Returns the journal and whether it resumed.
+    """
+    journal = Journal(os.path.join(project_dir, JOURNAL_FILE))
+    if journal.data is not None and not journal.is_complete and not journal.matches(operation, key):
+        shutil.rmtree(project_dir)
+        journal.data = None
+    os.makedirs(project_dir, exist_ok=True)
+    resumed = journal.start(operation, key)
+    return journal, resumed
+
+
+def folder_state(project_dir):
+    """Get whether a project folder has been completely written.
+
+    Returns 'missing', 'incomplete' if the launch or restore writing it stopped
+    before it finished, or 'complete'. Folders written before journals were
+    kept are complete.
+    """
+    if not os.path.exists(project_dir):
+        return 'missing'
+    journal = Journal(os.path.join(project_dir, JOURNAL_FILE))
+    if journal.data is not None and not journal.is_complete:
+        return 'incomplete'
+    return 'complete'
+
+
+def find_incomplete(workspace_dir, suffix, operation, key):
+    """Find a Workspace folder left unfinished by an earlier run of an operation, or None.
+
+    Only folders whose names end with suffix are read, newest first.
+    """
+    if not os.path.isdir(workspace_dir):
+        return None
+    for entry in sorted(os.scandir(workspace_dir), key=lambda entry: entry.name, reverse=True):
+        if entry.name.endswith(suffix) and entry.is_dir():
+            if Journal(os.path.join(entry.path, JOURNAL_FILE)).matches(operation, key):
+                return entry.path
+    return None
@@ -0,0 +1,165 @@
+"""notebooks.py."""
+
+import glob
+import json
+import os
+import re
+import sys
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+# A code cell with outputs or an execution count still has something to clear
+DIRTY_OUTPUTS = re.compile(r'"outputs":\s*\[\s*[^\]\s]|"execution_count":\s*[0-9]')
+
+
+def count_source(source):
+    """Count number of non-blank lines, words, and non-whitespace characters.
+
+    :param source: string or list of strings to count
+    :return: number of non-blank lines, words, and non-whitespace characters
+    """
+    if isinstance(source, list):
+        source = ''.join(source)
+    lines = [line for line in source.split('\n') if line and not line.isspace()]
+    words = source.split()
+    chars = ''.join(words)
+    return len(lines), len(words), len(chars)
+
+
+def clean_notebook(nb, clean_outputs=True, clean_notebook_metadata_fields=None, clean_cell_metadata_fields=None,
+                   clean_tags=None, clean_empty_cells=False):
+    """Clean metadata fields and outputs from a notebook in place.
+
+    Accepts a NotebookNode or the plain dict parsed from a notebook file.
+    Returns a dict counting the cleanings made; an empty dict means the
+    notebook was already clean.
+    Based on nbtoolbelt: https://gitlab.tue.nl/jupyter-projects/nbtoolbelt/blob/master/src/nbtoolbelt/cleaning.py
+    """
+    freq = defaultdict(int)  # number of cleanings
+    # delete notebook (global) metadata fields
+    if isinstance(clean_notebook_metadata_fields, list) and len(clean_notebook_metadata_fields) > 0:
+        for field in clean_notebook_metadata_fields:
+            if field in nb['metadata']:
+                del nb['metadata'][field]
+                freq['global ' + field] += 1
+    # delete empty cells, if desired
+    n = len(nb['cells'])
+    if clean_empty_cells:
+        nb['cells'] = [cell for cell in nb['cells'] if count_source(cell['source'])[0]]
+    if n > len(nb['cells']):
+        freq['empty cells'] = n - len(nb['cells'])
+    # traverse all cells, and delete fields
+    for cell in nb['cells']:
+        # delete cell metadata fields
+        if isinstance(clean_cell_metadata_fields, list) and len(clean_cell_metadata_fields) > 0:
+            for field in clean_cell_metadata_fields:
+                if field in cell['metadata']:
+                    del cell['metadata'][field]
+                    freq['cell ' + field] += 1
+        # delete cell tags
+        if 'tags' in cell['metadata'] and isinstance(clean_tags, list) and len(clean_tags) > 0:
+            removed_tags = {tag for tag in cell['metadata']['tags'] if tag in clean_tags}
+            for tag in removed_tags:
+                freq['tag ' + tag] += 1
+            kept_tags = [tag for tag in cell['metadata']['tags'] if tag not in clean_tags]
+            if kept_tags:
+                cell['metadata']['tags'] = kept_tags
+            else:
+                del cell['metadata']['tags']
+        # clean outputs of code cells, if requested
+        if cell['cell_type'] == 'code' and clean_outputs == True:
+            if cell.get('outputs'):
+                cell['outputs'] = []
+                freq['outputs'] += 1
+            if cell.get('execution_count') is not None:
+                cell['execution_count'] = None
+                freq['execution counts'] += 1
+    return dict(freq)
+
+
+def clean_file(nbfile, options):
+    """Clean a notebook file, writing it back only if something changed.
+
+    If only outputs are to be cleaned, a regular expression scan of the raw
+    file decides whether the notebook needs to be parsed at all. Returns the
+    path, the dict of cleanings and whether the file was rewritten.
+    """
+    with open(nbfile, 'r', encoding='utf-8') as f:
+        text = f.read()
+    outputs_only = not any(options.get(key) for key in ['clean_notebook_metadata_fields', 'clean_cell_metadata_fields',
+                                                        'clean_tags', 'clean_empty_cells'])
+    if outputs_only and not (options.get('clean_outputs', True) and DIRTY_OUTPUTS.search(text)):
+        return nbfile, {}, False
+    nb = json.loads(text)
+    freq = clean_notebook(nb, **options)
+    if not freq:
+        return nbfile, freq, False
+    # Replace the file in one step so that a reader never sees a partial notebook
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(nbfile) or '.')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(nb, indent=2))
+    os.replace(temp_path, nbfile)
+    return nbfile, freq, True
+
+
+def _clean_file(args):
+    """Unpack the arguments for clean_file() in a worker process."""
+    nbfile, options = args
+    try:
+        return clean_file(nbfile, options)
+    except Exception as e:
+        return nbfile, {'error': '{}: {}'.format(type(e).__name__, e)}, False
+
+
+def find_notebooks(path):
+    """Get the paths of all notebooks in a folder, skipping Jupyter checkpoints."""
+    return [filename for filename in glob.iglob(os.path.join(path, '**', '*.ipynb'), recursive=True)
+            if '.ipynb_checkpoints' not in filename.split(os.sep)]
+
+
+def total_size(paths):
+    """Get the total size of some files, counting any that cannot be read as empty."""
+    size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+
+def clean_notebooks(paths, processes=None, min_pool_notebooks=2, min_pool_bytes=0, **options):
+    """Clean many notebook files, across a process pool if there are enough of them.
+
+    Takes a list of notebook paths and the keyword arguments of clean_notebook().
+    Starting a pool costs more than cleaning a few small notebooks, so they are
+    cleaned in this process unless there are at least `min_pool_notebooks`
+    notebooks totalling at least `min_pool_bytes`. Returns the number of
+    notebooks rewritten and skipped and the cleanings counted over all notebooks.
+    """
+    freq = defaultdict(int)
+    errors = []
+    cleaned = 0
+    tasks = [(nbfile, options) for nbfile in paths]
+    if processes == 1 or len(tasks) < max(2, min_pool_notebooks) or total_size(paths) < min_pool_bytes:
+        results = map(_clean_file, tasks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=processes)
+        results = pool.map(_clean_file, tasks, chunksize=max(1, len(tasks) // ((processes or os.cpu_count() or 1) * 4)))
+    try:
+        for nbfile, file_freq, written in results:
+            if 'error' in file_freq:
+                print(nbfile + ': ' + file_freq['error'], file=sys.stderr)
+                errors.append('<p>Could not clean the notebook at ' + nbfile + '.</p>')
+                continue
+            for key, count in file_freq.items():
+                freq[key] += count
+            if written:
+                cleaned += 1
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return {'result': 'fail' if errors else 'success', 'cleaned': cleaned, 'skipped': len(tasks) - cleaned - len(errors),
+            'freq': dict(freq), 'errors': errors}
@@ -0,0 +1,43 @@
+"""progress.py."""
+
+import threading
+
+
+class Cancelled(BaseException):
+    """Raised inside a Project operation when its caller has cancelled it.
+
+    Derived from BaseException, like asyncio.CancelledError, so that it is not
+    swallowed by the handlers for database and file errors.
+    """
+
+
+class Progress():
+    """Report the stages of a Project operation and check for cancellation.
+
+    Parameters:
+    - callback: an optional callable which receives the stage name and a stats dict
+    - cancel_event: an optional threading.Event which is set to cancel the operation
+
+    Long stages report from inside their loops, so an operation stops soon after
+    it is cancelled rather than at the end of the stage.
+    """
+
+    def __init__(self, callback=None, cancel_event=None):
+        """Initialize the object."""
+        self.callback = callback
+        self.cancel_event = cancel_event or threading.Event()
+
+    def cancel(self):
+        """Ask the operation to stop at its next report."""
+        self.cancel_event.set()
+
+    def report(self, stage, stats=None):
+        """Send a progress event, raising Cancelled if the operation has been cancelled."""
+        if self.cancel_event.is_set():
+            raise Cancelled(stage)
+        if self.callback is not None:
+            self.callback(stage, dict(stats or {}))
+
+    def reporter(self, stage):
+        """Get a callable which reports a stats dict for a stage, for the writers' progress hooks."""
+        return lambda stats: self.report(stage, stats)
@@ -0,0 +1,127 @@
+"""reader.py.
+
+Read the corpus cached in a project folder. This module only uses the standard
+library, so it can be copied next to the notebooks in a project.
+"""
+
+import json
+import mmap
+import os
+import zlib
+
+
+class CorpusReader():
+    """Read the documents in a project's `caches/jsonl` or `caches/json` folder.
+
+    Parameters:
+    - project_dir: the project folder
+
+    JSON Lines shards are memory-mapped, so only the pages holding the documents
+    that are read are loaded, and a document is found from the offset index
+    without scanning. Compressed shards are decompressed one block at a time.
+    Projects with one file per document are read through the same interface.
+    """
+
+    def __init__(self, project_dir):
+        """Initialize the object."""
+        self.project_dir = project_dir
+        self.jsonl_dir = os.path.join(project_dir, 'caches/jsonl')
+        self.json_dir = os.path.join(project_dir, 'caches/json')
+        self._maps = {}
+        self._files = {}
+        self._block = (None, None)
+        index_file = os.path.join(self.jsonl_dir, 'index.json')
+        if os.path.exists(index_file):
+            with open(index_file, 'r') as f:
+                self.index = json.loads(f.read())
+            self.layout = 'jsonl'
+            self.positions = {row[0]: i for i, row in enumerate(self.index['documents'])}
+        else:
+            self.index = None
+            self.layout = 'files'
+            names = sorted(fn[:-5] for fn in os.listdir(self.json_dir) if fn.endswith('.json')) \
+                if os.path.exists(self.json_dir) else []
+            self.positions = {name: i for i, name in enumerate(names)}
+
+    def __enter__(self):
+        """Return the reader."""
+        return self
+
+    def __exit__(self, *exc):
+        """Close the memory maps."""
+        self.close()
+
+    def __len__(self):
+        """Get the number of documents."""
+        return len(self.positions)
+
+    def __iter__(self):
+        """Iterate over the documents as dicts, in the order they were written."""
+        for data in self.iter_raw():
+            yield json.loads(data)
+
+    def names(self):
+        """Get the document names, in the order they were written."""
+        return list(self.positions)
+
+    def close(self):
+        """Close the memory maps and their files."""
+        for data in self._maps.values():
+            data.close()
+        for f in self._files.values():
+            f.close()
+        self._maps = {}
+        self._files = {}
+        self._block = (None, None)
+
+    def _shard(self, number):
+        """Get the memory map of a shard, opening it on first use."""
+        if number not in self._maps:
+            f = open(os.path.join(self.jsonl_dir, self.index['shards'][number]), 'rb')
+            self._files[number] = f
+            self._maps[number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[number]
+
+    def _read_block(self, number):
+        """Get the decompressed bytes of a block, keeping the last block read."""
+        if self._block[0] != number:
+            shard, offset, length = self.index['blocks'][number]
+            # wbits=31 reads a single gzip member
+            self._block = (number, zlib.decompress(self._shard(shard)[offset:offset + length], 31))
+        return self._block[1]
+
+    def _read(self, row):
+        """Get the encoded bytes of a document from its index row."""
+        name, location, offset, length = row
+        if self.index.get('compression'):
+            return self._read_block(location)[offset:offset + length]
+        return self._shard(location)[offset:offset + length]
+
+    def iter_raw(self):
+        """Iterate over the encoded bytes of the documents without parsing them."""
+        if self.layout == 'files':
+            for name in self.positions:
+                with open(os.path.join(self.json_dir, name + '.json'), 'rb') as f:
+                    yield f.read()
+            return
+        for row in self.index['documents']:
+            yield self._read(row)
+
+    def get(self, name):
+        """Get a document by name, or None if it is not in the corpus."""
+        position = self.positions.get(name)
+        if position is None:
+            return None
+        if self.layout == 'files':
+            with open(os.path.join(self.json_dir, name + '.json'), 'rb') as f:
+                return json.loads(f.read())
+        return json.loads(self._read(self.index['documents'][position]))
+
+    def select(self, fields):
+        """Iterate over the documents, keeping only the given fields of each.
+
+        Documents are parsed one at a time, so memory use does not grow with
+        the size of the corpus.
+        """
+        for item in self:
+            yield {field: item[field] for field in fields if field in item}
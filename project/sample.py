@@ -0,0 +1,70 @@
+"""sample.py.
+
+Choose deterministic random and stratified samples of the documents matching a
+corpus query, for launching a project against a few hundred documents.
+"""
+
+import hashlib
+import heapq
+import json
+from collections import defaultdict
+
+
+def sample_rank(_id, seed=0):
+    """Get a document's position in the random order given by a seed."""
+    digest = hashlib.sha256('{}:{}'.format(seed, _id).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def allocate(counts, size):
+    """Split a sample size between strata in proportion to their sizes.
+
+    Each stratum gets the whole part of its share, and the documents left over
+    go to the strata with the largest remainders.
+    """
+    total = sum(counts.values())
+    if total <= size:
+        return dict(counts)
+    shares = {key: size * count / total for key, count in counts.items()}
+    quotas = {key: int(share) for key, share in shares.items()}
+    left = size - sum(quotas.values())
+    for key in sorted(shares, key=lambda key: (quotas[key] - shares[key], key))[:left]:
+        quotas[key] += 1
+    return quotas
+
+
+def sample_ids(corpus_db, db_query, size, seed=0, stratify=None, batch_size=1000):
+    """Get the `_id`s of a deterministic sample of the documents matching a query.
+
+    Documents are ranked by a hash of their `_id` and the seed, and the `size`
+    lowest ranked are chosen, so the same seed, query and corpus always give
+    the same sample. Only the `_id`s are read, and no more than `size` of them
+    per stratum are kept in memory.
+
+    If `stratify` is a field name or dotted path, the sample is split between
+    the values of the field in proportion to the number of documents with each
+    value, and each stratum is sampled in the same way. The field is projected
+    on the server, so dotted paths resolve as they do in `Project.preview()`.
+    Returns the `_id`s in order.
+    """
+    if stratify:
+        cursor = corpus_db.aggregate([{'$match': db_query}, {'$project': {'_id': True, 'stratum': '$' + stratify}}],
+                                     batchSize=batch_size)
+    else:
+        cursor = corpus_db.find(db_query, {'_id': True}, batch_size=batch_size)
+    counts = defaultdict(int)
+    heaps = defaultdict(list)
+    for item in cursor:
+        key = json.dumps(item.get('stratum'), sort_keys=True, default=str) if stratify else ''
+        counts[key] += 1
+        # A heap of negated ranks keeps the lowest ranked documents, with the highest at the top
+        entry = (-sample_rank(item['_id'], seed), item['_id'])
+        heap = heaps[key]
+        if len(heap) < size:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+    ids = []
+    for key, quota in allocate(counts, size).items():
+        ids += [_id for _, _id in heapq.nlargest(quota, heaps[key])]
+    return sorted(ids)
@@ -0,0 +1,291 @@
+"""versions.py."""
+
+from collections.abc import MutableMapping
+from io import BytesIO
+
+from bson import json_util
+
+# The version fields kept in slots; any others are kept in a dict
+VERSION_FIELDS = ('version_number', 'version_date', 'version_name', 'version_workflow', 'manifest', 'files', 'size',
+                  'uploaded', 'zipfile', 'version_zipfile')
+# The fields in which older versions stored the project folder as a zip archive
+PAYLOAD_FIELDS = ('zipfile', 'version_zipfile')
+
+
+class VersionPayload():
+    """A handle on a zip archive stored in a version of a project record.
+
+    Parameters:
+    - collection: the Projects collection
+    - project_id: the _id of the project record
+    - number: the version number, as stored
+    - field: 'zipfile' or 'version_zipfile'
+
+    Only the handle is kept in memory. The archive is fetched from the
+    database each time it is read.
+    """
+
+    __slots__ = ('collection', 'project_id', 'number', 'field')
+
+    def __init__(self, collection, project_id, number, field):
+        """Initialize the object."""
+        self.collection = collection
+        self.project_id = project_id
+        self.number = number
+        self.field = field
+
+    def __repr__(self):
+        """Show which archive the handle refers to."""
+        return '<VersionPayload {} v{} {}>'.format(self.project_id, self.number, self.field)
+
+    def read(self):
+        """Fetch the archive's bytes, or None if it is no longer stored."""
+        record = self.collection.find_one({'_id': self.project_id},
+                                          projection={'content': {'$elemMatch': {'version_number': self.number}}})
+        for version in (record or {}).get('content', []):
+            return version.get(self.field)
+        return None
+
+    def open(self):
+        """Fetch the archive as a seekable binary file."""
+        return BytesIO(self.read())
+
+
+class Version(MutableMapping):
+    """The metadata of a project version, stored compactly.
+
+    Behaves like the version dict stored in a project record's `content` list,
+    so it can be saved to the database as it is. The usual fields are kept in
+    slots, without a dict per version. A zip archive stored by an older
+    version may be held as a `VersionPayload`, which is fetched when the field
+    is read, so that a project only holds its archives in memory while they
+    are used. Checking for the field, copying the version and converting it to
+    JSON do not fetch the archive.
+    """
+
+    __slots__ = VERSION_FIELDS + ('extra',)
+
+    def __init__(self, data=None):
+        """Initialize the object."""
+        self.extra = None
+        if data is not None:
+            for key, value in data.items():
+                self[key] = value
+
+    def __getitem__(self, key):
+        """Get a field, fetching a stored archive if the field holds a handle."""
+        value = self.raw(key)
+        if isinstance(value, VersionPayload):
+            return value.read()
+        return value
+
+    def __setitem__(self, key, value):
+        """Set a field."""
+        if key in VERSION_FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        """Remove a field."""
+        if key in VERSION_FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        """Check whether a field is set, without fetching a stored archive."""
+        if key in VERSION_FIELDS:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        """Iterate over the names of the fields which are set."""
+        for key in VERSION_FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        """Get the number of fields which are set."""
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        """Show the fields, with handles rather than archives."""
+        return 'Version({!r})'.format({key: self.raw(key) for key in self})
+
+    def raw(self, key):
+        """Get a field without fetching a stored archive."""
+        if key in VERSION_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is None or key not in self.extra:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def pop(self, key, *default):
+        """Remove a field and return its value, without fetching a stored archive."""
+        try:
+            value = self.raw(key)
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def copy(self):
+        """Get a copy of the version which shares its archive handles."""
+        return Version({key: self.raw(key) for key in self})
+
+    def metadata(self):
+        """Get the fields other than stored archives as a dict."""
+        return {key: self.raw(key) for key in self if key not in PAYLOAD_FIELDS}
+
+
+def archive_field(version_dict):
+    """Get the field in which a version stores its project folder as a zip archive, or None."""
+    for field in ('version_zipfile', 'zipfile'):
+        if field in version_dict:
+            return field
+    return None
+
+
+def version_document(version_dict):
+    """Get a version as a plain dict to be written to the database, fetching any stored archives."""
+    return {key: version_dict[key] for key in version_dict}
+
+
+def record_document(manifest):
+    """Get a project record as a plain dict to be written to the database."""
+    document = dict(manifest)
+    if 'content' in document:
+        document['content'] = [version_document(version_dict) for version_dict in document['content']]
+    return document
+
+
+def json_default(obj):
+    """Convert versions to JSON without their archives, and other values as `json_util.default` does."""
+    if isinstance(obj, Version):
+        return obj.metadata()
+    return json_util.default(obj)
+
+
+class VersionIndex():
+    """Index the version dicts in a project manifest's `content` list.
+
+    The index keeps the list itself, so the manifest and the index stay in
+    step, and adds lookups by version number, name and date with the latest
+    version tracked as versions are added and removed. The version dicts in
+    the list are replaced by `Version` objects.
+    """
+
+    def __init__(self, content=None):
+        """Initialize the object."""
+        if content is None:
+            content = []
+        elif isinstance(content, dict):
+            content = [content]
+        for i, version in enumerate(content):
+            if not isinstance(version, Version):
+                content[i] = Version(version)
+        self.versions = content
+        self.by_number = {}
+        self.by_name = {}
+        self.by_date = {}
+        self.latest_number = None
+        for version in self.versions:
+            self._index(version)
+
+    def __len__(self):
+        """Get the number of versions."""
+        return len(self.by_number)
+
+    def _index(self, version):
+        """Add a version dict to the lookup tables."""
+        number = int(version['version_number'])
+        self.by_number[number] = version
+        if 'version_name' in version:
+            self.by_name[str(version['version_name'])] = version
+        if 'version_date' in version:
+            self.by_date[str(version['version_date'])] = version
+        if self.latest_number is None or number > self.latest_number:
+            self.latest_number = number
+
+    def _unindex(self, version):
+        """Remove a version dict from the lookup tables."""
+        number = int(version['version_number'])
+        del self.by_number[number]
+        if self.by_name.get(str(version.get('version_name'))) is version:
+            del self.by_name[str(version['version_name'])]
+        if self.by_date.get(str(version.get('version_date'))) is version:
+            del self.by_date[str(version['version_date'])]
+        if number == self.latest_number:
+            self.latest_number = max(self.by_number) if self.by_number else None
+
+    def add(self, version):
+        """Add a version dict, replacing any version with the same number.
+
+        Returns the version as it is stored in the index.
+        """
+        if not isinstance(version, Version):
+            version = Version(version)
+        existing = self.by_number.get(int(version['version_number']))
+        if existing is not None:
+            self._unindex(existing)
+            self.versions[self.versions.index(existing)] = version
+        else:
+            self.versions.append(version)
+        self._index(version)
+        return version
+
+    def remove(self, number):
+        """Remove a version by number and return its dict, or None if there is no such version."""
+        version = self.by_number.get(int(number))
+        if version is not None:
+            self._unindex(version)
+            self.versions.remove(version)
+        return version
+
+    def get(self, value, key='number'):
+        """Get a version dict by 'number', 'name' or 'date', or None if there is no match."""
+        if key == 'number':
+            try:
+                return self.by_number.get(int(value))
+            except (TypeError, ValueError):
+                return None
+        elif key == 'name':
+            return self.by_name.get(str(value))
+        elif key == 'date':
+            return self.by_date.get(str(value))
+        raise ValueError('Versions can only be looked up by number, name or date.')
+
+    def latest(self):
+        """Get the dict for the latest version, or None if there are no versions."""
+        if self.latest_number is None:
+            return None
+        return self.by_number[self.latest_number]
+
+    def attach_payloads(self, collection, project_id):
+        """Add handles on the archives stored in a project record read without them.
+
+        Only the version numbers of the versions which store an archive are read.
+        """
+        for field in PAYLOAD_FIELDS:
+            pipeline = [{'$match': {'_id': project_id}}, {'$unwind': '$content'},
+                        {'$match': {'content.' + field: {'$exists': True}}},
+                        {'$project': {'_id': False, 'number': '$content.version_number'}}]
+            for item in collection.aggregate(pipeline):
+                version = self.by_number.get(int(item['number']))
+                if version is not None and field not in version:
+                    version[field] = VersionPayload(collection, project_id, item['number'], field)
@@ -0,0 +1,249 @@
+"""workspace.py.
+
+Report the disk space used in the Workspace and keep it within a budget.
+Run from the repository root with `python -m project.workspace [--enforce] [--dry-run]`.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import threading
+import time
+
+from config import config
+from project.blobstore import PENDING_FILE, load_local_manifest, scan_manifest
+from project.db import get_database
+
+# The time each Workspace's budget was last enforced in this process
+_enforced = {}
+_enforced_lock = threading.Lock()
+
+
+def disk_usage(path, links=None):
+    """Get the bytes allocated to a file or folder and the latest modification time inside it.
+
+    Hard linked files are counted once, so a project sharing its cached data
+    with the query cache is not charged for it twice. If a `links` dict is
+    given, hard linked files are not counted but recorded in it by inode, so
+    that files shared between folders can be charged to only one of them.
+    """
+    stat = os.lstat(path)
+    if not os.path.isdir(path):
+        return stat.st_blocks * 512, stat.st_mtime
+    size = 0
+    latest = stat.st_mtime
+    seen = {} if links is None else links
+    stack = [path]
+    while stack:
+        for entry in os.scandir(stack.pop()):
+            stat = entry.stat(follow_symlinks=False)
+            latest = max(latest, stat.st_mtime)
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif stat.st_nlink > 1:
+                seen[(stat.st_dev, stat.st_ino)] = stat.st_blocks * 512
+            else:
+                size += stat.st_blocks * 512
+    if links is None:
+        size += sum(seen.values())
+    return size, latest
+
+
+def enforce_due(workspace_dir, interval=None):
+    """Check whether a Workspace's budget is due to be enforced, and if so record that it is now.
+
+    Returns True at most once every `interval` seconds for each Workspace, so
+    that frequent launches and exports do not each scan the whole Workspace.
+    Defaults to `config.WORKSPACE_CHECK_INTERVAL`.
+    """
+    if interval is None:
+        interval = config.WORKSPACE_CHECK_INTERVAL
+    key = os.path.realpath(workspace_dir)
+    now = time.monotonic()
+    with _enforced_lock:
+        if key in _enforced and now - _enforced[key] < interval:
+            return False
+        _enforced[key] = now
+    return True
+
+
+def touch(project_dir):
+    """Mark a project folder as used now, so that it is the last to be evicted."""
+    try:
+        os.utime(project_dir)
+    except OSError:
+        pass
+
+
+class WorkspaceManager():
+    """Track the space used by project folders, exports and temporary files.
+
+    Parameters:
+    - workspace_dir: the Workspace folder holding the launched project folders
+    - temp_dir: the folder for temporary files
+    - max_bytes: the disk budget for all three; None reports usage without evicting
+    - temp_max_age: the age in seconds after which temporary files may be removed
+    - client: an optional MongoClient used to check that folders are versioned
+    - export_min_age: the age in seconds before which export archives are never removed
+
+    The last access time of an entry is the latest modification time of its
+    files or of the folder itself, which `touch()` updates when a folder is
+    launched. Finished export archives and old temporary files can be evicted. A
+    project folder is only evicted if it has not changed since it was saved or
+    restored and its manifest is recorded in a version in the database, since
+    `Project.launch(new=False)` can then restore it.
+    """
+
+    def __init__(self, workspace_dir=None, temp_dir=None, max_bytes=None, temp_max_age=None, client=None,
+                 export_min_age=None):
+        """Initialize the object."""
+        self.workspace_dir = workspace_dir or config.WORKSPACE_DIR
+        self.temp_dir = temp_dir or config.TEMP_DIR
+        self.exports_dir = os.path.join(self.workspace_dir, 'exports')
+        self.max_bytes = max_bytes if max_bytes is not None else config.WORKSPACE_MAX_BYTES
+        self.temp_max_age = temp_max_age if temp_max_age is not None else config.TEMP_MAX_AGE
+        self.export_min_age = export_min_age if export_min_age is not None else config.EXPORT_MIN_AGE
+        self.client = client
+
+    def scan(self):
+        """List every project folder, export archive and temporary file, least recently used first.
+
+        Each entry is a dict with its `path`, `kind` ('project', 'export' or
+        'temp'), `bytes` and `last_access` time. A file hard linked into several
+        entries is charged to the most recently used of them, since its space is
+        only freed when that entry is evicted, so the total matches `du`.
+        """
+        entries = []
+        links = {}
+        skip = {os.path.realpath(self.exports_dir), os.path.realpath(self.temp_dir)}
+        for kind, folder in [('project', self.workspace_dir), ('export', self.exports_dir), ('temp', self.temp_dir)]:
+            if not os.path.isdir(folder):
+                continue
+            for entry in os.scandir(folder):
+                if entry.name.startswith('.') or os.path.realpath(entry.path) in skip:
+                    continue
+                if kind == 'project' and not entry.is_dir(follow_symlinks=False):
+                    continue
+                links[entry.path] = {}
+                size, last_access = disk_usage(entry.path, links[entry.path])
+                entries.append({'path': entry.path, 'kind': kind, 'bytes': size, 'last_access': last_access})
+        entries.sort(key=lambda entry: entry['last_access'])
+        seen = set()
+        for entry in reversed(entries):
+            for inode, size in links[entry['path']].items():
+                if inode not in seen:
+                    seen.add(inode)
+                    entry['bytes'] += size
+        return entries
+
+    def is_versioned(self, project_dir):
+        """Check that a project folder can be restored exactly from a stored version."""
+        if os.path.exists(os.path.join(project_dir, PENDING_FILE)):
+            return False
+        local_manifest = load_local_manifest(project_dir)
+        digest = local_manifest.get('manifest')
+        if digest is None:
+            return False
+        scan = scan_manifest(project_dir, local_manifest)
+        if scan['changed'] or scan['removed']:
+            return False
+        return get_database(self.client).Projects.count_documents({'content.manifest': digest}, limit=1) > 0
+
+    def evictable(self, entry, now=None):
+        """Check whether an entry can be removed without losing anything.
+
+        Exports still being written, and exports written less than
+        `export_min_age` seconds ago, may be in use by another export or download.
+        """
+        if entry['kind'] == 'export':
+            if entry['path'].endswith(('.part', '.part.json')):
+                return False
+            return (now or time.time()) - entry['last_access'] > self.export_min_age
+        if entry['kind'] == 'temp':
+            return (now or time.time()) - entry['last_access'] > self.temp_max_age
+        return self.is_versioned(entry['path'])
+
+    def report(self):
+        """Get the entries and the space used by each kind of entry."""
+        entries = self.scan()
+        totals = {'project': 0, 'export': 0, 'temp': 0}
+        for entry in entries:
+            totals[entry['kind']] += entry['bytes']
+        return {'result': 'success', 'bytes': sum(totals.values()), 'max_bytes': self.max_bytes, 'totals': totals,
+                'entries': entries, 'errors': []}
+
+    def enforce(self, dry_run=False, keep=None):
+        """Evict least recently used entries until the Workspace is within its budget.
+
+        Old temporary files are always removed and the paths in `keep` never are.
+        Returns the report with the paths and space `evicted`; if dry_run is True,
+        nothing is removed.
+        """
+        keep = {os.path.realpath(path) for path in keep or []}
+        report = self.report()
+        now = time.time()
+        used = report['bytes']
+        evicted = []
+        errors = []
+        for entry in report['entries']:
+            over_budget = self.max_bytes is not None and used > self.max_bytes
+            expired_temp = entry['kind'] == 'temp' and now - entry['last_access'] > self.temp_max_age
+            if not (over_budget or expired_temp) or os.path.realpath(entry['path']) in keep \
+                    or not self.evictable(entry, now):
+                continue
+            if not dry_run:
+                try:
+                    if os.path.isdir(entry['path']) and not os.path.islink(entry['path']):
+                        shutil.rmtree(entry['path'])
+                    else:
+                        os.remove(entry['path'])
+                except OSError:
+                    errors.append('<p>Could not remove ' + entry['path'] + '.</p>')
+                    continue
+            used -= entry['bytes']
+            evicted.append(entry['path'])
+        if self.max_bytes is not None and used > self.max_bytes:
+            errors.append('<p>The Workspace is over its disk budget, but the remaining folders have unsaved changes.</p>')
+        report.update({'evicted': evicted, 'evicted_bytes': report['bytes'] - used, 'bytes': used, 'errors': errors})
+        if not dry_run:
+            report['entries'] = [entry for entry in report['entries'] if entry['path'] not in evicted]
+        report['result'] = 'fail' if errors else 'success'
+        return report
+
+
+def _format_bytes(size):
+    """Format a size in bytes for people."""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} TB'.format(size)
+
+
+def main():
+    """Print the space used in the Workspace, evicting entries if asked to."""
+    parser = argparse.ArgumentParser(description='Report and limit the disk space used in the Workspace.')
+    parser.add_argument('--enforce', action='store_true', help='evict entries until the Workspace is within its budget')
+    parser.add_argument('--dry-run', action='store_true', help='show what --enforce would evict')
+    parser.add_argument('--max-bytes', type=int, help='the disk budget; defaults to config.WORKSPACE_MAX_BYTES')
+    args = parser.parse_args()
+    manager = WorkspaceManager(max_bytes=args.max_bytes)
+    if args.enforce or args.dry_run:
+        report = manager.enforce(dry_run=args.dry_run)
+    else:
+        report = manager.report()
+    for entry in sorted(report['entries'], key=lambda entry: entry['bytes'], reverse=True):
+        print('{:>10}  {:<7}  {}  {}'.format(_format_bytes(entry['bytes']), entry['kind'],
+                                            time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['last_access'])),
+                                            entry['path']))
+    budget = _format_bytes(report['max_bytes']) if report['max_bytes'] is not None else 'no budget'
+    print('Total: {} ({})'.format(_format_bytes(report['bytes']), budget))
+    for path in report.get('evicted', []):
+        print(('Would evict ' if args.dry_run else 'Evicted ') + path)
+    for error in report['errors']:
+        print(error, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()